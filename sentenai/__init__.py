@@ -1,5 +1,11 @@
 from sentenai.api import *
 from sentenai.stream import Database
+from sentenai.query import CBOR, slice_params, statements, decode_columns, iter_columns, join, shard_bounds, bound, ns
+from sentenai.columns import concat, continues, record_batch
+from sentenai.cache import QueryCache, RangeCache, DiskCache, NodeCache
+from sentenai.follow import Follower
+from concurrent.futures import ThreadPoolExecutor
+from sentenai.aio import AsyncSentenai
 if PANDAS: import pandas as pd
 from datetime import datetime
 import io
@@ -9,14 +15,24 @@ from pathlib import Path
 
 import time
 
-__all__ = ['Sentenai']
+__all__ = ['Sentenai', 'AsyncSentenai', 'QueryCache', 'RangeCache', 'DiskCache', 'Compression']
 
 if PANDAS:
     def df(events):
         return pd.DataFrame([x.as_record() for x in events])
 
 class Sentenai(API):
-    def __init__(self, host=None, port=None, check=True, interactive=True):
+    def __init__(self, host=None, port=None, check=True, interactive=True, cache=None, range_cache=None, disk_cache=None,
+                 compression=None, node_ttl=30.0):
+        """`cache` may be a `QueryCache` to serve repeated view slices from
+        memory, `range_cache` a `RangeCache` so that bounded slices only
+        fetch the time ranges not seen before, and `disk_cache` a
+        `DiskCache` persisting results over historical ranges.
+        `compression` may be a `Compression` (or an encoding name) to
+        compress request bodies and negotiate compressed responses for this
+        client and the handles derived from it. Stream handles
+        remember the node of each path and the type of each node for
+        `node_ttl` seconds (`None` to look them up on every handle)."""
         ## We do this so we can programmatically pass in host/port
         if host is None:
             host = 'localhost'
@@ -25,15 +41,43 @@ class Sentenai(API):
         protocol = 'http://'
 
         self.interactive = interactive
+        self.cache = cache
+        self.range_cache = range_cache
+        self.disk_cache = disk_cache
+        self.node_cache = NodeCache(node_ttl) if node_ttl else None
 
         h = f"{protocol}{host}:{port}"
-        API.__init__(self, Credentials(h, None))
+        if isinstance(compression, str):
+            compression = Compression(compression)
+        credentials = Credentials(h, None, compression)
+        # hold the shared pool until this client is closed
+        Transport.acquire(credentials)
+        self._closed = False
+        API.__init__(self, credentials)
         if check and self.ping() > 0.5:
             print("warning: connection to this repository may be high latency or unstable.")
 
     def __repr__(self):
         return "Sentenai(host=\"{}\")".format(self._credentials.host)
 
+    @property
+    def pool(self):
+        """Connection statistics for the pool shared by this client and
+        every database, stream and view derived from it."""
+        return self._transport.stats
+
+    @property
+    def compression(self):
+        """The `Compression` settings and counters, if enabled."""
+        return self._credentials.compression
+
+    def close(self):
+        """Stop using the shared connection pool, closing it unless other
+        clients of the same host still use it."""
+        if not self._closed:
+            self._closed = True
+            self._transport.release()
+
     def __call__(self, tspl):
         return View(self, {'value': tspl}, when=None)
 
@@ -72,7 +116,9 @@ class Sentenai(API):
 
     def __delitem__(self, name):
         """Delete a stream database"""
-        self[name]._delete()
+        db = self[name]
+        db._delete()
+        db._invalidate(nodes=True)
 
     def __getitem__(self, db):
         """Get a stream database."""
@@ -94,10 +140,22 @@ class Sentenai(API):
             else:
                 return View(self, tspls, when, df=True)
 
+    if ARROW:
+        def arrow(self, tspl=None, when=None, **tspls):
+            """Arrow table"""
+            if not tspl and not tspls:
+                raise Exception("no arguments")
+            if tspl and tspls:
+                raise Exception("can't define both string TSPL and multiple TSPL statements together.")
+            elif tspl:
+                return View(self, {'value': tspl}, when, arrow=True)
+            else:
+                return View(self, tspls, when, arrow=True)
+
 
 
 class View(API):
-    def __init__(self, parent, tspl, when=None, df=False):
+    def __init__(self, parent, tspl, when=None, df=False, arrow=False):
         self._parent = parent
         API.__init__(self, parent._credentials, *parent._prefix, "tspl")
         for key in tspl:
@@ -106,7 +164,9 @@ class View(API):
         self._tspl = tspl
         self._when = when
         self._df = df
+        self._arrow = arrow
         self._info = None
+        self._shards = 1
 
     def __repr__(self):
         if len(self._tspl) == 1:
@@ -166,136 +226,129 @@ class View(API):
 
 
 
-    def __getitem__(self, i):
-        params = {}
-
-        if isinstance(i, slice):
-            #params['sort'] = 'asc'
-
-            if i.start is None:
-                pass
-            elif type(i.start) is int:
-                params['start'] = int(i.start)
-            else:
-                params['start'] = iso8601(i.start)
+    def iter(self, start=None, end=None, batch=65536, limit=None):
+        """Iterate over the events between `start` and `end` in batches of at
+        most `batch` events. The response is decoded while it downloads, so
+        memory use does not grow with the size of the result. Yields
+        DataFrames for dataframe views, `pyarrow.RecordBatch`es for arrow
+        views and `Columns` otherwise.
+        """
+        if len(self._tspl) > 1:
+            raise ValueError("iteration is only supported on single-statement views.")
+        params = slice_params(slice(start, end, limit))
+        (name, tspl), = statements(self._tspl, self._when)[1]
+        resp = self._post(json=tspl, params=params, headers=CBOR, stream=True)
+        try:
+            for cols in iter_columns(resp, batch):
+                if self._arrow:
+                    yield record_batch(cols.arrays(name))
+                elif self._df:
+                    yield cols.to_df(name)
+                else:
+                    yield cols
+        finally:
+            resp.close()
+
+    def follow(self, poll=1.0, retention=None, start=None):
+        """Return a `Follower` that keeps this view's events from `start`
+        (default: `retention` ago) up to date, querying only the time since
+        each previous refresh. Iterate it to poll every `poll` seconds.
+        """
+        return Follower(self, start, retention, poll)
 
-            if i.stop is None:
-                pass
-            elif type(i.stop) is int:
-                params['end'] = int(i.stop)
-            else:
-                params['end'] = iso8601(i.stop)
-
-            if i.step is not None:
-                params['limit'] = i.step
-                #if i.step < 0:
-                #    params['sort'] = 'desc'
-            results = []
-            if self._when is None and len(self._tspl) > 1:
-                z = []
-                for x in self._tspl.values():
-                    z.append(f'events({x})')
-                self._when = ' or '.join(z)
-
-            for name, tspl in self._tspl.items():
-                if self._when is None:
-                    resp = self._post(json=tspl, params=params, headers={'Accept': 'application/cbor'})
+    def sharded(self, shards):
+        """Return a copy of this view whose slices are split into `shards`
+        equal time ranges, fetched concurrently and stitched back together
+        in time order. Open-ended slices are bounded using the view's range.
+        """
+        v = View(self._parent, self._tspl, self._when, self._df, self._arrow)
+        v._shards = shards
+        return v
+
+    def _fetch(self, tspl, params):
+        ranges = self._parent.range_cache
+        if ranges is not None and params.get('start') is not None and params.get('end') is not None and not params.get('limit'):
+            virtual = type(params['start']) is int
+
+            def gap(lo, hi):
+                return self._query(tspl, dict(params, start=bound(lo, virtual), end=bound(hi, virtual)))
+
+            key = ranges.key(self._credentials, tspl)
+            return ranges.fetch(key, ns(params['start']), ns(params['end']), gap, tspl)
+
+        cache = self._parent.cache
+        if cache is not None:
+            key = cache.key(self._credentials, tspl, params)
+            epoch = cache.epoch
+            cols = cache.get(key)
+            if cols is not None:
+                return cols
+        cols = self._query(tspl, params)
+        if cache is not None:
+            cache.put(key, cols, tspl, epoch)
+        return cols
+
+    def _query(self, tspl, params):
+        disk = self._parent.disk_cache
+        if disk is not None and type(params.get('end', 0)) is not int and disk.immutable(ns(params['end'])):
+            key = disk.key(self._credentials, tspl, params)
+            cols = disk.get(key)
+            if cols is None:
+                cols = self._request(tspl, params)
+                disk.put(key, cols, tspl)
+            return cols
+        return self._request(tspl, params)
+
+    def _request(self, tspl, params):
+        if self._shards > 1:
+            return self._fetch_sharded(tspl, params)
+        return decode_columns(self._post(json=tspl, params=params, headers=CBOR))
+
+    def _fetch_sharded(self, tspl, params):
+        lo, hi = params.get('start'), params.get('end')
+        first, last = lo, hi
+        if lo is None or hi is None:
+            info = self._post("range", json=tspl).json()
+            if not info or info.get('start') is None:
+                return decode_columns(self._post(json=tspl, params=params, headers=CBOR))
+            first = info['start'] if lo is None else lo
+            last = info['end'] if hi is None else hi
+        virtual = type(first) is int
+        bounds = shard_bounds(ns(first), ns(last), self._shards)
+        edges = [lo] + [bound(b, virtual) for b in bounds] + [hi]
+
+        def fetch(ps):
+            return decode_columns(self._post(json=tspl, params=ps, headers=CBOR))
+
+        def joined(b):
+            # probe the boundary: a clipped event shows up as one event spanning it
+            probe = {k: v for k, v in params.items() if k != 'limit'}
+            return continues(fetch(dict(probe, start=bound(b - 1, virtual), end=bound(b + 1, virtual))), b)
+
+        with ThreadPoolExecutor(max_workers=len(edges) - 1) as pool:
+            parts = list(pool.map(fetch, [dict(params, start=a, end=b) for a, b in zip(edges, edges[1:])]))
+        cols = concat(parts, bounds, joined)
+        limit = params.get('limit')
+        if limit:
+            cols = cols[:limit] if limit > 0 else cols[limit:]
+        return cols
 
-                else:
-                    resp = self._post(json=f'({tspl}) when {self._when}', params=params, headers={'Accept': 'application/cbor'})
-
-                    
-                t = resp.headers['type']
-                if resp.headers['content-type'] == 'application/cbor':
-                    o = 0
-                    hasOrigin = False
-                    if 'origin' in resp.headers:
-                        o = int(np.datetime64(resp.headers['origin'][:-1], 'ns').astype(int))
-                        hasOrigin = True
-                    d = cbor2.loads(resp.content)
-                    data = []
-                    if hasOrigin:
-                        if t != 'event':
-                            for evt in d:
-                                ts =  np.datetime64(o + evt[0], 'ns')
-                                end = np.datetime64(o + evt[0] + evt[1], 'ns')
-                                data.append({'start': ts, 'end': end, 'value': evt[2]})
-                                if self._df:
-                                    evt = data[-1]
-                                    evt['duration'] = evt['end'] - evt['start']
-                        else:
-                            for evt in d:
-                                ts =  np.datetime64(o + evt[0], 'ns')
-                                end = np.datetime64(o + evt[0] + evt[1], 'ns')
-                                data.append({'start': ts, 'end': end})
-                                if self._df:
-                                    evt = data[-1]
-                                    evt['duration'] = evt['end'] - evt['start']
-                    else:
-                        if t != 'event':
-                            for evt in d:
-                                ts =  np.timedelta64(evt[0], 'ns')
-                                end = np.timedelta64(evt[0] + evt[1], 'ns')
-                                data.append({'start': ts, 'end': end, 'value': evt[2]})
-                                if self._df:
-                                    evt = data[-1]
-                                    evt['duration'] = evt['end'] - evt['start']
-                        else:
-                            for evt in d:
-                                ts =  np.timedelta64(evt[0], 'ns')
-                                end = np.timedelta64(evt[0] + evt[1], 'ns')
-                                data.append({'start': ts, 'end': end})
-                                if self._df:
-                                    evt = data[-1]
-                                    evt['duration'] = evt['end'] - evt['start']
-                    if self._df:
-                        if t == "event":
-                            results.append(pd.DataFrame(data, columns=["start", "end", "duration"]))
-                        else:
-                            results.append(pd.DataFrame(data, columns=["start", "end", "duration", name]))
-                    else:
-                        results.append(data)
-                else:
-                    data = resp.json()
-                    if isinstance(data, list):
-                        for evt in data:
-                            if type(evt['start']) is int:
-                                evt['start'] = np.timedelta64(evt['start'], 'ns')
-                                evt['end'] = np.timedelta64(evt['end'], 'ns')
-                            else:
-                                evt['start'] = np.datetime64(evt['start'][:-1], 'ns')
-                                evt['end'] = np.datetime64(evt['end'][:-1], 'ns')
-                            if t != "event":
-                                evt[name] = fromJSON(t, evt['value'])
-                            if self._df:
-                                evt['duration'] = evt['end'] - evt['start']
-                        if self._df:
-                            if t == "event":
-                                results.append(pd.DataFrame(data, columns=["start", "end", "duration"]))
-                            else:
-                                results.append(pd.DataFrame(data, columns=["start", "end", "duration", name]))
-                        else:
-                            results.append(data)
-                    else:
-                        print(data)
-                        raise Exception(data)
-            if len(results) == 0:
-                return None
-            elif len(results) == 1:
-                return results[0]
-            else:
-                r = results[0]
-                for x in results[1:]:
-                    r = pd.merge(r,x.drop(columns=['end', 'duration']),how='outer',left_on='start', right_on='start')
-                if i.step:
-                    return r.truncate(after=i.step-1)
-                else:
-                    return r
+    def __getitem__(self, i):
+        params = slice_params(i)
+        self._when, stmts = statements(self._tspl, self._when)
 
+        def fetch(stmt):
+            name, tspl = stmt
+            return name, self._fetch(tspl, params)
 
+        if len(stmts) == 1:
+            results = [fetch(stmts[0])]
         else:
-            raise Exception("wrong type")
-    
+            # columns are independent queries: fetch and decode them concurrently
+            with ThreadPoolExecutor(max_workers=min(len(stmts), self._transport.maxsize)) as pool:
+                results = list(pool.map(fetch, stmts))
+        return join(results, i.step, self._df, self._arrow)
+
 
 
 TEMPLATE_MERMAIDJS="""<html>
@@ -0,0 +1,395 @@
+"""Native asyncio client for Sentenai.
+
+`AsyncSentenai` mirrors `Sentenai`, `Database`, `Stream`, `View` and
+`Metadata`, but every request is a coroutine on a single `aiohttp` session.
+Query building, response decoding and ingest conversion are shared with the
+synchronous client.
+"""
+import asyncio
+from datetime import datetime, date, time
+from sentenai.api import *
+from sentenai.query import CBOR, slice_params, statements, decode_columns, join
+from sentenai.stream.streams import column_type, encode_events, first_type, node_range
+from sentenai.stream.ingest import chunks
+from sentenai.stream.metadata import decode_meta
+import cbor2
+
+try:
+    import aiohttp
+    AIOHTTP = True
+except ImportError:
+    aiohttp = None
+    AIOHTTP = False
+
+__all__ = ['AsyncSentenai']
+
+
+TYPES = {float: 'float', int: 'int', bool: 'bool', datetime: 'datetime', date: 'date', time: 'time', str: 'text'}
+
+
+class Response(object):
+    """A fully read `aiohttp` response exposing the `requests` attributes the
+    shared decoders use."""
+    def __init__(self, status, headers, content):
+        self.status_code = status
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return JSON.loads(self.content)
+
+
+class AsyncAPI(API):
+    def __init__(self, client, credentials, *prefix, params={}):
+        self._client = client
+        self._credentials = credentials
+        self._prefix = prefix
+        self._params = params
+
+    async def _req(self, method, parts, params={}, headers={}, data=None, raw=False):
+        ps, headers, body = self._prepare(params, headers, data, raw)
+        ps = {k: v.decode('utf-8') if isinstance(v, bytes) else str(v) for k, v in ps.items()}
+        session = await self._client._aiosession()
+        try:
+            async with session.request(method, self._url(parts), params=ps, headers=headers, data=body) as r:
+                resp = Response(r.status, r.headers, await r.read())
+        except aiohttp.ClientConnectionError:
+            raise ConnectionError(f"Could not connect to sentenai repository at: `{self._credentials.host}`") from None
+        return self._check(resp, parts, data)
+
+    def _get(self, *parts, params={}, headers={}):
+        return self._req('GET', parts, params, headers)
+
+    def _put(self, *parts, params={}, headers={}, json={}):
+        return self._req('PUT', parts, params, headers, data=json)
+
+    def _post(self, *parts, params={}, headers={}, json={}, raw=False):
+        return self._req('POST', parts, params, headers, data=json, raw=raw)
+
+    def _delete(self, *parts, params={}, headers={}):
+        return self._req('DELETE', parts, params, headers)
+
+    def _patch(self, *parts, params={}, headers={}, json={}):
+        return self._req('PATCH', parts, params, headers, data=json)
+
+    def _head(self, *parts, params={}, headers={}, json={}):
+        return self._req('HEAD', parts, params, headers)
+
+
+class AsyncSentenai(AsyncAPI):
+    """Asyncio counterpart of `Sentenai`.
+
+    >>> async with AsyncSentenai(host, port) as client:
+    ...     db = await client['plant']
+    ...     df = await client.df(a='plant/a', b='plant/b')[t0:t1]
+    """
+    def __init__(self, host=None, port=None, limit=100):
+        if not AIOHTTP:
+            raise ImportError("AsyncSentenai requires `aiohttp`.")
+        if host is None:
+            host = 'localhost'
+        if port is None:
+            port = 7280
+        protocol = 'http://'
+        self._limit = limit
+        self._session = None
+        AsyncAPI.__init__(self, self, Credentials(f"{protocol}{host}:{port}", None))
+
+    async def _aiosession(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self._limit))
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def __repr__(self):
+        return "AsyncSentenai(host=\"{}\")".format(self._credentials.host)
+
+    def __call__(self, tspl):
+        return AsyncView(self, {'value': tspl}, when=None)
+
+    def df(self, tspl=None, when=None, **tspls):
+        """Dataframe"""
+        if not tspl and not tspls:
+            raise Exception("no arguments")
+        if tspl and tspls:
+            raise Exception("can't define both string TSPL and multiple TSPL statements together.")
+        elif tspl:
+            return AsyncView(self, {'value': tspl}, when, df=True)
+        else:
+            return AsyncView(self, tspls, when, df=True)
+
+    async def keys(self):
+        r = await self._get('db')
+        return sorted(s for s in r.json())
+
+    async def ping(self):
+        """Ping Sentenai get back response time in seconds."""
+        t0 = asyncio.get_running_loop().time()
+        await self._get()
+        return asyncio.get_running_loop().time() - t0
+
+    async def init(self, name, origin=datetime(1970,1,1,0,0)):
+        """Initialize a new stream database. See `Sentenai.init`."""
+        if origin == None:
+            r = await self._put("db", name, json={'origin': None})
+        else:
+            r = await self._put("db", name, json={'origin': iso8601(origin)})
+        if r.status_code != 201:
+            raise Exception("Could not initialize")
+        return await self[name]
+
+    async def delete(self, name):
+        """Delete a stream database"""
+        await self._delete("db", name)
+
+    def __getitem__(self, db):
+        """Get a stream database. Returns an awaitable."""
+        return self._database(db)
+
+    async def _database(self, db):
+        x = await self._get('db', db)
+        if x.status_code != 200:
+            raise KeyError(f"`{db}` not found in {self!r}.")
+        return AsyncDatabase(self, db, dt64(x.json().get('origin')))
+
+
+class AsyncView(AsyncAPI):
+    def __init__(self, parent, tspl, when=None, df=False):
+        AsyncAPI.__init__(self, parent._client, parent._credentials, *parent._prefix, "tspl")
+        for key in tspl:
+            if key in ['start', 'end', 'duration']:
+                raise Exception("column may not be named `start`, `end`, or `duration`.")
+        self._parent = parent
+        self._tspl = tspl
+        self._when = when
+        self._df = df
+
+    def __repr__(self):
+        if len(self._tspl) == 1:
+            return repr(list(self._tspl.values())[0])
+        else:
+            return "\n".join([f'{key} = {value!r}' for key, value in self._tspl.items()])
+
+    @property
+    async def range(self):
+        info = (await self._post("range", json=self._tspl['value'])).json()
+        return {'start': dt64(info['start']), 'end': dt64(info['end'])}
+
+    @property
+    async def type(self):
+        return (await self._post("range", json=self._tspl['value'])).json().get('type')
+
+    def __getitem__(self, i):
+        """Query a time slice. Returns an awaitable; the columns of a
+        multi-column view are fetched concurrently."""
+        return self._slice(slice_params(i), i.step)
+
+    async def _slice(self, params, limit):
+        self._when, stmts = statements(self._tspl, self._when)
+
+        async def fetch(name, tspl):
+            return name, decode_columns(await self._post(json=tspl, params=params, headers=CBOR))
+
+        results = await asyncio.gather(*[fetch(name, tspl) for name, tspl in stmts])
+        return join(list(results), limit, self._df)
+
+
+class AsyncDatabase(AsyncAPI):
+    def __init__(self, parent, name, origin):
+        AsyncAPI.__init__(self, parent._client, parent._credentials, *parent._prefix, "db", name)
+        self._parent = parent
+        self._name = name
+        self._origin = origin
+
+    def __repr__(self):
+        return f"AsyncDatabase({self._parent!r}, \"{self._name}\")"
+
+    def __str__(self):
+        return str(self._name)
+
+    @property
+    def origin(self):
+        return self._origin
+
+    @property
+    def name(self):
+        return self._name
+
+    async def keys(self):
+        r = await self._get("links")
+        if r.status_code != 200:
+            raise SentenaiError("invalid response")
+        return sorted(r.json().keys())
+
+    def __getitem__(self, key):
+        """Get a stream. Returns an awaitable."""
+        return self._stream(*(key if isinstance(key, tuple) else (key,)))
+
+    async def _stream(self, *path):
+        r = await self._get('paths', *path)
+        if r.status_code == 404:
+            raise KeyError("path does not exist")
+        return AsyncStream(self, path, r.json()['node'])
+
+    async def delete(self, key):
+        """Delete a stream and its children."""
+        await self._delete('paths', *(key if isinstance(key, tuple) else (key,)))
+
+    async def set(self, key, content, workers=32, chunksize=4096):
+        """Awaitable equivalent of `Database.__setitem__`: replaces the stream
+        at `key` with `content` (a DataFrame, list of events, TSPL string,
+        value type or `None` for a directory). Up to `workers` chunks are
+        uploaded concurrently."""
+        path = key if isinstance(key, tuple) else (key,)
+        await self.delete(path)
+
+        if content is None:
+            await self._put('paths', *path, json={'kind': 'directory'})
+            return
+        elif type(content) == str:
+            await self._put('paths', *path, json={'kind': 'virtual', 'tspl': content})
+            return
+        elif isinstance(content, type) and content in TYPES:
+            nid = (await self._put('paths', *path)).json()['node']
+            await self._put('nodes', nid, 'types', TYPES[content])
+            return
+        elif PANDAS and isinstance(content, pd.DataFrame):
+            nid = (await self._put('paths', *path)).json()['node']
+            await self._put('nodes', nid, 'types', 'event')
+            cmap = {'start': nid}
+            tmap = {'start': 'event'}
+            df = content.sort_values(by='start', ignore_index=True)
+        elif isinstance(content, list):
+            cmap = {}
+            tmap = {}
+            df = pd.DataFrame(content).rename(columns={'value': path[-1]})
+            if set(df.columns) == {'start', 'end', path[-1]}:
+                pass
+            elif set(df.columns) == {'start', 'end'}:
+                cmap['start'] = (await self._put('paths', *path)).json()['node']
+                await self._put('nodes', cmap['start'], 'types', 'event')
+                tmap['start'] = 'event'
+            else:
+                raise Exception(str(df.columns))
+            df = df.sort_values(by='start', ignore_index=True)
+        else:
+            raise TypeError("invalid assignment type")
+
+        if len(df) == 0:
+            raise ValueError("Cannot index empty dataset")
+
+        async def add(cname):
+            if isinstance(content, list):
+                nid = (await self._put('paths', *path)).json()['node']
+            else:
+                nid = (await self._put('paths', *path, cname)).json()['node']
+            tm = column_type(df[cname])
+            await self._put('nodes', nid, 'types', tm)
+            return (cname, nid, tm)
+
+        for cname, nid, tm in await asyncio.gather(*[add(x) for x in df.columns if x not in ['start', 'end']]):
+            cmap[cname] = nid
+            tmap[cname] = tm
+
+        sem = asyncio.Semaphore(workers)
+        tasks = []
+
+        async def send(node, index, v):
+            try:
+                await self._index(node, index, v)
+            finally:
+                sem.release()
+
+        for a, chunk in chunks(df, tmap, self.origin, chunksize):
+            for k, v in chunk.items():
+                await sem.acquire()
+                tasks.append(asyncio.ensure_future(send(cmap[k], tmap[k], v)))
+        await asyncio.gather(*tasks)
+
+    async def _index(self, node, index, v):
+        data = cbor2.dumps(v)
+        counter = 0
+        while True:
+            try:
+                resp = await self._post('nodes', node, 'types', index,
+                        json=data, headers={'Content-Type': 'application/cbor'}, raw=True)
+            except (ConnectionError, SentenaiError):
+                counter += 1
+                if counter >= 10:
+                    raise
+                await asyncio.sleep(.1)
+            else:
+                if resp.status_code > 204:
+                    raise Exception("failed on index")
+                return
+
+
+class AsyncStream(AsyncAPI):
+    def __init__(self, parent, path, node):
+        AsyncAPI.__init__(self, parent._client, parent._credentials, *parent._prefix, "nodes", node)
+        self._parent = parent
+        self._path = path
+        self._node = node
+
+    def __repr__(self):
+        z = ", ".join(map(repr, self._path))
+        return f"AsyncStream({self._parent!r}, {z})"
+
+    def __str__(self):
+        return "/".join((self._parent.name,) + self._path)
+
+    def __getitem__(self, key):
+        """Get a child stream. Returns an awaitable."""
+        return self._parent._stream(*(self._path + (key if isinstance(key, tuple) else (key,))))
+
+    @property
+    def meta(self):
+        return AsyncMetadata(self)
+
+    @property
+    async def type(self):
+        return first_type(await self._get('types'))
+
+    @property
+    async def range(self):
+        t = await self.type
+        if t is None:
+            return None
+        return node_range(await self._get('types', t, 'range'), self._parent.origin)
+
+    async def insert(self, values):
+        vs = encode_events(values, self._parent.origin)
+        await self._post('types', await self.type,
+                json=cbor2.dumps(vs), headers={'Content-Type': 'application/cbor'}, raw=True)
+
+
+class AsyncMetadata(AsyncAPI):
+    def __init__(self, parent):
+        AsyncAPI.__init__(self, parent._client, parent._credentials, *parent._prefix, 'meta')
+        self._parent = parent
+
+    def __repr__(self):
+        return repr(self._parent) + ".meta"
+
+    async def items(self):
+        return decode_meta((await self._get()).json())
+
+    async def get(self, key, default=None):
+        for k, v in await self.items():
+            if k == key:
+                return v
+        return default
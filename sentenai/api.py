@@ -1,4 +1,5 @@
 import base64
+import gzip
 import logging
 import pytz
 import copy
@@ -6,7 +7,9 @@ import re
 import io
 import requests
 import sys
+import threading
 import time, types
+import urllib3
 import dateutil
 import dateutil.tz
 from datetime import date, time, datetime, timedelta, tzinfo
@@ -25,6 +28,20 @@ except:
     pd = None
     PANDAS = False
 
+try:
+    import pyarrow as pa
+    ARROW = True
+except:
+    pa = None
+    ARROW = False
+
+try:
+    import zstandard
+    ZSTD = True
+except:
+    zstandard = None
+    ZSTD = False
+
 
 def base64json(x):
     return base64.urlsafe_b64encode(bytes(JSON.dumps(x, ignore_nan=True, cls=SentenaiEncoder), 'UTF-8'))
@@ -175,21 +192,214 @@ class Debug(object):
 
 
 class Credentials(object):
-    def __init__(self, host, auth_key):
+    """The host and key a client connects with, and that client's
+    `Compression` settings. Only the host and key identify the shared
+    `Transport`, so clients of the same host keep their own settings."""
+    def __init__(self, host, auth_key, compression=None):
         self.host = host
         self.auth_key = auth_key
+        self.compression = compression
 
     def __repr__(self):
         return "Credentials(auth_key='{}', host='{}')".format(
             repr(self.auth_key), self.host)
 
+    def __eq__(self, other):
+        return isinstance(other, Credentials) and (self.host, self.auth_key) == (other.host, other.auth_key)
+
+    def __hash__(self):
+        return hash((self.host, self.auth_key))
+
+
+class PoolStats(object):
+    """Connection counters for a `Transport`.
+
+    `opened` counts new TCP connections, `reused` counts requests served
+    by an already open connection and `waits` counts requests that had to
+    block for a free slot because every connection was checked out.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.acquired = 0
+        self.waits = 0
+
+    def _incr(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    @property
+    def reused(self):
+        return max(self.acquired - self.opened, 0)
+
+    def as_dict(self):
+        return {'opened': self.opened, 'reused': self.reused, 'waits': self.waits}
+
+    def __repr__(self):
+        return "PoolStats(opened={}, reused={}, waits={})".format(self.opened, self.reused, self.waits)
+
+
+class _CountingPool(object):
+    _stats = None
+
+    def _new_conn(self):
+        self._stats._incr('opened')
+        return super()._new_conn()
+
+    def _get_conn(self, timeout=None):
+        if self.pool is not None and self.pool.empty():
+            self._stats._incr('waits')
+        self._stats._incr('acquired')
+        return super()._get_conn(timeout=timeout)
+
+
+class _PoolAdapter(requests.adapters.HTTPAdapter):
+    def __init__(self, stats, **kwargs):
+        self._stats = stats
+        requests.adapters.HTTPAdapter.__init__(self, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        requests.adapters.HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': type('HTTPConnectionPool', (_CountingPool, urllib3.HTTPConnectionPool), {'_stats': self._stats}),
+            'https': type('HTTPSConnectionPool', (_CountingPool, urllib3.HTTPSConnectionPool), {'_stats': self._stats}),
+        }
+
+
+class Compression(object):
+    """Compression of request bodies and negotiation of compressed responses.
+
+    Request bodies of at least `threshold` bytes are compressed with
+    `encoding` (`'gzip'`, or `'zstd'` when `zstandard` is installed) at
+    `level`. Responses are requested in any encoding available here and
+    decoded as they are read, including by the streaming decoders. If a
+    server rejects a compressed body, the request is repeated uncompressed
+    and request bodies are no longer compressed for that host (listed in
+    `rejected`); set `enabled` to turn request compression off everywhere.
+
+    `sent_raw` and `sent_wire` count request body bytes before and after
+    compression; `received_wire` and `received_raw` count the bytes of
+    (non-streamed) response bodies on the wire and after decoding.
+    """
+    def __init__(self, encoding='gzip', level=None, threshold=1024):
+        if encoding not in ('gzip', 'zstd'):
+            raise ValueError("encoding must be 'gzip' or 'zstd'")
+        if encoding == 'zstd' and not ZSTD:
+            raise ImportError("zstd compression requires the zstandard package")
+        self.encoding = encoding
+        self.level = level
+        self.threshold = threshold
+        self.enabled = True
+        self.rejected = set()
+        self._lock = threading.Lock()
+        self.sent_raw = 0
+        self.sent_wire = 0
+        self.received_wire = 0
+        self.received_raw = 0
+
+    @property
+    def accept(self):
+        return 'zstd, gzip, deflate' if ZSTD else 'gzip, deflate'
+
+    def compress(self, body, host=None):
+        """Return the body to send to `host` and its content encoding, if any."""
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        if not self.enabled or host in self.rejected or not isinstance(body, bytes) or len(body) < self.threshold:
+            return body, None
+        if self.encoding == 'zstd':
+            out = zstandard.ZstdCompressor(level=3 if self.level is None else self.level).compress(body)
+        else:
+            out = gzip.compress(body, 6 if self.level is None else self.level, mtime=0)
+        with self._lock:
+            self.sent_raw += len(body)
+            self.sent_wire += len(out)
+        return out, self.encoding
+
+    def reject(self, host):
+        """Stop compressing request bodies sent to `host`."""
+        with self._lock:
+            self.rejected.add(host)
+
+    def received(self, resp):
+        """Count the body of a fully read response."""
+        with self._lock:
+            self.received_wire += resp.raw.tell()
+            self.received_raw += len(resp.content)
+
+    @property
+    def ratio(self):
+        """Uncompressed over compressed bytes sent."""
+        return self.sent_raw / self.sent_wire if self.sent_wire else 1.0
+
+    def __repr__(self):
+        return "Compression({!r}, sent_raw={}, sent_wire={}, received_wire={}, received_raw={})".format(
+            self.encoding, self.sent_raw, self.sent_wire, self.received_wire, self.received_raw)
+
+
+class Transport(object):
+    """A thread-safe, pooled HTTP session shared by every API handle
+    created from the same `Credentials`. Clients `acquire` it and
+    `release` it when closed; it is closed with the last of them.
+    """
+    _registry = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, credentials, maxsize=100):
+        self.credentials = credentials
+        self.maxsize = maxsize
+        self.stats = PoolStats()
+        self.clients = 0
+        self.session = requests.Session()
+        a = _PoolAdapter(self.stats, pool_connections=maxsize, pool_maxsize=maxsize, pool_block=True)
+        self.session.mount('http://', a)
+        self.session.mount('https://', a)
+
+    @classmethod
+    def for_credentials(cls, credentials, acquire=False):
+        """Return the transport registered for `credentials`, creating it if
+        needed. With `acquire`, count one more client using it."""
+        with cls._registry_lock:
+            t = cls._registry.get(credentials)
+            if t is None:
+                t = cls._registry[credentials] = cls(credentials)
+            if acquire:
+                t.clients += 1
+            return t
+
+    @classmethod
+    def acquire(cls, credentials):
+        """Return the transport for `credentials` for a client to use until
+        it calls `release`."""
+        return cls.for_credentials(credentials, acquire=True)
+
+    def release(self):
+        """Count one client fewer, closing the transport once none is left."""
+        with self._registry_lock:
+            self.clients -= 1
+            if self.clients > 0:
+                return
+            if self._registry.get(self.credentials) is self:
+                del self._registry[self.credentials]
+        self.session.close()
+
+    def close(self):
+        """Close all pooled connections and forget this transport, whatever
+        clients still use it."""
+        with self._registry_lock:
+            if self._registry.get(self.credentials) is self:
+                del self._registry[self.credentials]
+        self.session.close()
+
+    def __repr__(self):
+        return "Transport({!r}, {!r})".format(self.credentials, self.stats)
+
 
 class API(object):
     def __init__(self, credentials, *prefix, params={}):
         self._credentials = credentials
-        self._session = requests.Session()
-        a = requests.adapters.HTTPAdapter(pool_connections=100, pool_maxsize=100)
-        self._session.mount('', a)
+        self._transport = Transport.for_credentials(credentials)
+        self._session = self._transport.session
         self._prefix = prefix
         self._params = params
 
@@ -215,9 +425,14 @@ class API(object):
         """Return an unambiguous representation of the object."""
         return "API({})".format(repr(self._credentials))
 
-    def _req(self, method, parts, params={}, headers={}, data=None, raw=False):
+    def _url(self, parts):
+        return "/".join([self._credentials.host]+list(self._prefix)+list(parts))
+
+    def _prepare(self, params, headers, data, raw):
+        """Encode query parameters and request body the way the server expects."""
         params = copy.copy(params)
         params.update(self._params)
+        headers = copy.copy(headers)
         if data and not raw:
             if isinstance(data, types.GeneratorType) or isinstance(data, io.IOBase):
                 headers['Content-Type'] = 'application/x-ndjson'
@@ -239,22 +454,16 @@ class API(object):
                 ps[k] = params[k]
         if self.debug.debugging:
             print("----------\n")
-        try:
-            if data is None:
-                r = method("/".join([self._credentials.host]+list(self._prefix)+list(parts)), params=ps, headers=headers)
-            elif isinstance(data, types.GeneratorType) or isinstance(data, io.IOBase):
-                r = method("/".join([self._credentials.host]+list(self._prefix)+list(parts)), params=ps, headers=headers, data=data)
-            elif isinstance(data, str):
-                r = method("/".join([self._credentials.host]+list(self._prefix)+list(parts)), params=ps, headers=headers, data=data)
-            elif isinstance(data, bytes):
-                r = method("/".join([self._credentials.host]+list(self._prefix)+list(parts)), params=ps, headers=headers, data=data)
-            else:
-                r = method("/".join([self._credentials.host]+list(self._prefix)+list(parts)), params=ps, headers=headers, data=JSON.dumps(data, ignore_nan=True, cls=SentenaiEncoder))
-        except requests.ConnectionError:
-            raise ConnectionError(f"Could not connect to sentenai repository at: `{self._credentials.host}`") from None
-
-        resp = self.debug.cache(r)
+        if data is None:
+            body = None
+        elif isinstance(data, (types.GeneratorType, io.IOBase, str, bytes)):
+            body = data
+        else:
+            body = JSON.dumps(data, ignore_nan=True, cls=SentenaiEncoder)
+        return ps, headers, body
 
+    def _check(self, resp, parts, data=None):
+        """Raise the matching `SentenaiException` for an error response."""
         if resp.status_code == 400:
             x = "/".join(list(self._prefix)+list(parts))
             print("bad request:", x, data)
@@ -266,14 +475,43 @@ class API(object):
         else:
             return resp
 
+    def _req(self, method, parts, params={}, headers={}, data=None, raw=False, stream=False):
+        ps, headers, body = self._prepare(params, headers, data, raw)
+        compression = self._credentials.compression
+        encoding = None
+        if compression is not None:
+            headers['Accept-Encoding'] = compression.accept
+            if body is not None:
+                plain = body
+                body, encoding = compression.compress(body, self._credentials.host)
+                if encoding:
+                    headers['Content-Encoding'] = encoding
+        try:
+            if body is None:
+                r = method(self._url(parts), params=ps, headers=headers, stream=stream)
+            else:
+                r = method(self._url(parts), params=ps, headers=headers, data=body, stream=stream)
+            if encoding and r.status_code == 415:
+                # the server does not accept compressed bodies
+                compression.reject(self._credentials.host)
+                r.close()
+                del headers['Content-Encoding']
+                r = method(self._url(parts), params=ps, headers=headers, data=plain, stream=stream)
+        except requests.ConnectionError:
+            raise ConnectionError(f"Could not connect to sentenai repository at: `{self._credentials.host}`") from None
+
+        if compression is not None and not stream:
+            compression.received(r)
+        return self._check(self.debug.cache(r), parts, data)
+
     def _get(self, *parts, params={}, headers={}):
         return self._req(self._session.get, parts, params, headers)
 
     def _put(self, *parts, params={}, headers={}, json={}):
         return self._req(self._session.put, parts, params, headers, data=json)
 
-    def _post(self, *parts, params={}, headers={}, json={}, raw=False):
-        return self._req(self._session.post, parts, params, headers, data=json, raw=raw)
+    def _post(self, *parts, params={}, headers={}, json={}, raw=False, stream=False):
+        return self._req(self._session.post, parts, params, headers, data=json, raw=raw, stream=stream)
 
     def _delete(self, *parts, params={}, headers={}):
         return self._req(self._session.delete, parts, params, headers)
@@ -0,0 +1,443 @@
+"""Caching of decoded query results."""
+from collections import OrderedDict
+from pathlib import Path
+from sentenai.columns import Columns, concat, continues
+import simplejson as JSON
+import numpy as np
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+
+def databases(tspl):
+    """Names a TSPL statement may refer to as a database: every path
+    segment followed by `/`. Over-approximating is safe, since it only
+    widens invalidation."""
+    return frozenset(re.findall(r'([\w.-]+)/', tspl))
+
+
+class QueryCache(object):
+    """An LRU cache of decoded query results bounded by their size in bytes.
+
+    Entries are keyed by the canonical request (host, TSPL statement and
+    query parameters) and remember which databases the statement refers to,
+    so writes through `Stream.insert` or `Database.__setitem__` /
+    `__delitem__` drop the entries they may affect. A result fetched before
+    such a write is not stored after it: take `epoch` before fetching and
+    pass it to `put`.
+    """
+    def __init__(self, max_bytes=256 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._epoch = 0
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(credentials, tspl, params):
+        return (credentials.host, tspl, tuple(sorted((k, str(v)) for k, v in params.items() if v is not None)))
+
+    @property
+    def epoch(self):
+        """Counts invalidations; a result fetched under an older epoch may be stale."""
+        with self._lock:
+            return self._epoch
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, cols, tspl, epoch=None):
+        size = cols.nbytes
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            # don't resurrect data a concurrent write has invalidated
+            if epoch is not None and epoch != self._epoch:
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._entries[key] = (cols, size, databases(tspl))
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (c, n, dbs) = self._entries.popitem(last=False)
+                self.bytes -= n
+                self.evictions += 1
+
+    def invalidate(self, database):
+        """Drop every entry whose statement may read from `database`."""
+        with self._lock:
+            self._epoch += 1
+            for key in [k for k, (c, n, dbs) in self._entries.items() if database in dbs]:
+                self.bytes -= self._entries.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return "QueryCache(entries={}, bytes={}, max_bytes={}, hits={}, misses={}, evictions={})".format(
+            len(self), self.bytes, self.max_bytes, self.hits, self.misses, self.evictions)
+
+
+def gaps(covered, lo, hi):
+    """The parts of `[lo, hi)` not covered by the sorted, disjoint
+    `(start, end)` intervals in `covered`."""
+    out = []
+    for a, b in covered:
+        if b <= lo:
+            continue
+        if a >= hi:
+            break
+        if a > lo:
+            out.append((lo, a))
+        lo = max(lo, b)
+    if lo < hi:
+        out.append((lo, hi))
+    return out
+
+
+def coalesce(segments, joined=None):
+    """Merge sorted, disjoint `(start, end, Columns)` segments that touch
+    into single segments, stitching events split at the shared boundary
+    when `joined` confirms them, as for `concat`."""
+    out = []
+    for a, b, cols in segments:
+        if out and out[-1][1] == a:
+            start, _, prev = out[-1]
+            out[-1] = (start, b, concat([prev, cols], [a], joined))
+        else:
+            out.append((a, b, cols))
+    return out
+
+
+def window(cols, lo, hi):
+    """The events of time-ordered `cols` that overlap `[lo, hi)`, found by
+    binary search."""
+    o = cols.origin or 0
+    reach = np.maximum.accumulate(cols.end) if len(cols) else cols.end
+    i = int(np.searchsorted(reach, lo - o, 'right'))
+    j = int(np.searchsorted(cols.start, hi - o, 'left'))
+    sub = cols[i:j]
+    if len(sub) and not np.all(sub.end > lo - o):
+        keep = np.nonzero(sub.end > lo - o)[0]
+        sub = Columns(sub.type, sub.start[keep], sub.duration[keep],
+                      None if sub.value is None else sub.value[keep], sub.origin)
+    return sub
+
+
+class RangeCache(object):
+    """Remembers which time ranges of each statement have been fetched.
+
+    A slice that overlaps cached coverage only requests the uncovered
+    gaps; the answer is stitched together from the cached arrays. Events
+    overlapping the edges of a slice are returned whole when their full
+    extent is known. Statements are evicted least-recently-used once the
+    cached arrays exceed `max_bytes`, and writes invalidate them like
+    `QueryCache`.
+    """
+    def __init__(self, max_bytes=256 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self._series = OrderedDict()
+        self._lock = threading.Lock()
+        self._epoch = 0
+        self.bytes = 0
+        self.hits = 0
+        self.partial = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(credentials, tspl):
+        return (credentials.host, tspl)
+
+    def fetch(self, key, lo, hi, get, tspl):
+        """Return the events of `key` overlapping `[lo, hi)` (absolute int64
+        ns), calling `get(start, end)` for each uncovered gap."""
+        with self._lock:
+            segments = self._series[key][0] if key in self._series else []
+            epoch = self._epoch
+        if lo >= hi:
+            # an empty or reversed slice; only ask for the type if unknown
+            if segments:
+                return Columns.empty(segments[0][2].type, segments[0][2].origin)
+            return get(lo, hi)[:0]
+        missing = gaps([(a, b) for a, b, c in segments], lo, hi)
+        with self._lock:
+            if not missing:
+                self.hits += 1
+            elif missing == [(lo, hi)]:
+                self.misses += 1
+            else:
+                self.partial += 1
+        fetched = [(a, b, get(a, b)) for a, b in missing]
+
+        def joined(t):
+            # a clipped event shows up as one event spanning the boundary
+            return continues(get(t - 1, t + 1), t)
+
+        merged = coalesce(sorted(segments + fetched, key=lambda s: s[0]), joined)
+        with self._lock:
+            # don't resurrect data a concurrent write has invalidated
+            if epoch == self._epoch:
+                self._store(key, merged, tspl)
+        for a, b, cols in merged:
+            if a <= lo and hi <= b:
+                return window(cols, lo, hi)
+        return get(lo, hi)
+
+    def _store(self, key, segments, tspl):
+        if key in self._series:
+            self.bytes -= self._series.pop(key)[2]
+        size = sum(c.nbytes for a, b, c in segments)
+        if size > self.max_bytes:
+            return
+        self._series[key] = (segments, databases(tspl), size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            self.bytes -= self._series.popitem(last=False)[1][2]
+
+    def invalidate(self, database):
+        """Forget every statement that may read from `database`."""
+        with self._lock:
+            self._epoch += 1
+            for key in [k for k, (s, dbs, n) in self._series.items() if database in dbs]:
+                self.bytes -= self._series.pop(key)[2]
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._series.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._series)
+
+    def __repr__(self):
+        return "RangeCache(statements={}, bytes={}, max_bytes={}, hits={}, partial={}, misses={})".format(
+            len(self), self.bytes, self.max_bytes, self.hits, self.partial, self.misses)
+
+
+class DiskCache(object):
+    """A persistent cache of query results over immutable historical ranges.
+
+    Results of slices ending more than `horizon` in the past are written as
+    one `.npy` file per column under `path`, keyed by a hash of the host,
+    TSPL statement and query parameters, and survive process restarts. Hits
+    are memory-mapped rather than parsed (text values are copied into an
+    object array). Results whose values are neither native numbers nor
+    strings are not stored. When `max_bytes` is set the
+    oldest entries are removed once the cache grows past it.
+
+    The keys of the entries that may read from each database are listed in
+    an index file, so a write only touches the entries it invalidates. An
+    entry that cannot be removed yet (for instance while it is memory-mapped
+    on Windows) is marked invalid instead and no longer served.
+    """
+    def __init__(self, path, horizon=np.timedelta64(1, 'D'), max_bytes=None):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.horizon = int(np.timedelta64(horizon, 'ns').astype(np.int64))
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._index = self.path / '.index'
+        if not self._index.exists():
+            self._reindex()
+
+    @staticmethod
+    def key(credentials, tspl, params):
+        return hashlib.sha256(repr(QueryCache.key(credentials, tspl, params)).encode('utf-8')).hexdigest()
+
+    def immutable(self, end):
+        """Whether a slice ending at `end` (absolute int64 ns) is old enough to store."""
+        return end <= int(np.datetime64('now', 'ns').astype(np.int64)) - self.horizon
+
+    def get(self, key):
+        d = self.path / key
+        try:
+            if (d / 'invalid').exists():
+                raise FileNotFoundError(key)
+            meta = JSON.loads((d / 'meta.json').read_text())
+            start = np.load(d / 'start.npy', mmap_mode='r')
+            duration = np.load(d / 'duration.npy', mmap_mode='r')
+            value = np.load(d / 'value.npy', mmap_mode='r') if meta['value'] else None
+            if value is not None and value.dtype.kind == 'U':
+                value = value.astype(object)
+        except (FileNotFoundError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return Columns(meta['type'], start, duration, value, meta['origin'])
+
+    def put(self, key, cols, tspl):
+        value = cols.value
+        if value is not None and value.dtype == object:
+            if not all(isinstance(v, str) for v in value):
+                return
+            value = value.astype(str)
+        d = self.path / key
+        if d.exists():
+            if not (d / 'invalid').exists():
+                return
+            self._remove(d)
+            if d.exists():
+                return
+        dbs = sorted(databases(tspl))
+        # index before storing, so an invalidation can't miss the entry
+        self._record(key, dbs)
+        tmp = Path(tempfile.mkdtemp(prefix='.tmp-', dir=self.path))
+        np.save(tmp / 'start.npy', cols.start)
+        np.save(tmp / 'duration.npy', cols.duration)
+        if value is not None:
+            np.save(tmp / 'value.npy', value)
+        meta = {'type': cols.type, 'origin': cols.origin, 'value': value is not None, 'databases': dbs}
+        (tmp / 'meta.json').write_text(JSON.dumps(meta))
+        try:
+            os.replace(tmp, d)
+        except OSError:
+            # another process stored the same result first
+            shutil.rmtree(tmp, ignore_errors=True)
+        if self.max_bytes is not None:
+            self._evict()
+
+    def _entries(self):
+        for d in self.path.iterdir():
+            if not d.name.startswith('.') and d.is_dir():
+                yield d
+
+    def _record(self, key, dbs):
+        """Add `key` to the index of each database in `dbs`."""
+        self._index.mkdir(exist_ok=True)
+        with self._lock:
+            for db in dbs:
+                with open(self._index / f'{db}.keys', 'a') as f:
+                    f.write(key + '\n')
+
+    def _reindex(self):
+        """Build the index from the entries' metadata, for a cache written
+        before it was kept."""
+        self._index.mkdir(exist_ok=True)
+        for d in list(self._entries()):
+            try:
+                meta = JSON.loads((d / 'meta.json').read_text())
+            except (FileNotFoundError, ValueError):
+                continue
+            self._record(d.name, meta['databases'])
+
+    @staticmethod
+    def _remove(d):
+        """Delete entry `d`, or mark it invalid if it can't be deleted yet."""
+        shutil.rmtree(d, ignore_errors=True)
+        if d.exists():
+            try:
+                (d / 'invalid').touch()
+            except OSError:
+                pass
+
+    def _evict(self):
+        entries = sorted(((d.stat().st_mtime, d, sum(f.stat().st_size for f in d.iterdir())) for d in self._entries()),
+                         key=lambda e: e[0])
+        total = sum(n for t, d, n in entries)
+        for t, d, n in entries:
+            if total <= self.max_bytes:
+                break
+            self._remove(d)
+            total -= n
+
+    def invalidate(self, database):
+        """Remove stored results whose statement may read from `database`."""
+        index = self._index / f'{database}.keys'
+        taken = index.with_name(f'.{database}.{uuid.uuid4().hex}')
+        with self._lock:
+            try:
+                # keys indexed from now on go to a fresh file
+                os.replace(index, taken)
+            except FileNotFoundError:
+                return
+        try:
+            keys = set(taken.read_text().split())
+        finally:
+            taken.unlink()
+        for key in keys:
+            d = self.path / key
+            if d.exists():
+                self._remove(d)
+
+    def clear(self):
+        for d in list(self._entries()):
+            self._remove(d)
+        shutil.rmtree(self._index, ignore_errors=True)
+        self._index.mkdir(exist_ok=True)
+
+    def __repr__(self):
+        return "DiskCache(path='{}', hits={}, misses={})".format(self.path, self.hits, self.misses)
+
+
+class NodeCache(object):
+    """Remembers the node of each path and the type of each node for `ttl`
+    seconds, so stream handles resolve without a request per access.
+
+    Entries are kept per database, and writes through `Database` drop the
+    entries of the database they change, like the query caches.
+    """
+    def __init__(self, ttl=30.0):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, database, key):
+        with self._lock:
+            entry = self._entries.get((database, key))
+            if entry is not None and entry[1] < time.monotonic():
+                del self._entries[(database, key)]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[0]
+
+    def put(self, database, key, value):
+        with self._lock:
+            self._entries[(database, key)] = (value, time.monotonic() + self.ttl)
+
+    def invalidate(self, database):
+        """Forget every path and type of `database`."""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == database]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return "NodeCache(entries={}, ttl={}, hits={}, misses={})".format(len(self), self.ttl, self.hits, self.misses)
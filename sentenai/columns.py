@@ -0,0 +1,270 @@
+"""Columnar query results.
+
+A `Columns` holds a decoded TSPL result as parallel numpy arrays instead of
+one dict per event, so large results are converted to DataFrames (or other
+containers) with array arithmetic rather than per-event Python work.
+"""
+from operator import itemgetter
+from sentenai.api import fromJSON, PANDAS, ARROW
+import numpy as np
+if PANDAS: import pandas as pd
+if ARROW: import pyarrow as pa
+
+
+DTYPES = {'float': np.float64, 'int': np.int64, 'bool': np.bool_}
+
+
+def frame(cols):
+    """Build a DataFrame from a dict of output columns."""
+    return pd.DataFrame(cols, columns=list(cols))
+
+
+def table(cols):
+    """Build a `pyarrow.Table` from a dict of output columns. Numeric and
+    time columns are wrapped without copying; `NaN` and `NaT` become nulls."""
+    return pa.table({k: pa.array(v, from_pandas=True) for k, v in cols.items()})
+
+
+def record_batch(cols):
+    """Build a `pyarrow.RecordBatch` from a dict of output columns."""
+    return pa.record_batch({k: pa.array(v, from_pandas=True) for k, v in cols.items()})
+
+
+def values_array(vtype, values, n):
+    """Build the value column for `vtype`, falling back to an object array
+    when values are missing or not representable natively."""
+    values = list(values)
+    if vtype in DTYPES and not any(v is None for v in values):
+        try:
+            return np.fromiter(values, DTYPES[vtype], n)
+        except (TypeError, ValueError, OverflowError):
+            pass
+    return np.fromiter(values, object, n)
+
+
+class Columns(object):
+    """Parallel `start`, `duration` and `value` arrays for one query result.
+
+    `start` and `duration` are int64 nanoseconds; `start` is relative to
+    `origin` (int64 nanoseconds since the epoch), or virtual time when
+    `origin` is `None`. `value` is `None` for event results.
+    """
+    def __init__(self, vtype, start, duration, value=None, origin=None):
+        self.type = vtype
+        self.start = start
+        self.duration = duration
+        self.value = value
+        self.origin = origin
+
+    @classmethod
+    def from_cbor(cls, vtype, events, origin=None):
+        """Build columns from decoded CBOR `[start, duration(, value)]` triples."""
+        n = len(events)
+        start = np.fromiter(map(itemgetter(0), events), np.int64, n)
+        duration = np.fromiter(map(itemgetter(1), events), np.int64, n)
+        if vtype == 'event':
+            value = None
+        else:
+            value = values_array(vtype, map(itemgetter(2), events), n)
+        return cls(vtype, start, duration, value, origin)
+
+    @classmethod
+    def from_json(cls, vtype, events):
+        """Build columns from JSON `{'start', 'end'(, 'value')}` events."""
+        n = len(events)
+        if n and type(events[0]['start']) is not int:
+            start = np.array([e['start'][:-1] for e in events], dtype='datetime64[ns]').view(np.int64)
+            end = np.array([e['end'][:-1] for e in events], dtype='datetime64[ns]').view(np.int64)
+            origin = 0
+        else:
+            start = np.fromiter((e['start'] for e in events), np.int64, n)
+            end = np.fromiter((e['end'] for e in events), np.int64, n)
+            origin = None
+        if vtype == 'event':
+            value = None
+        else:
+            value = values_array(vtype, (fromJSON(vtype, e['value']) for e in events), n)
+        return cls(vtype, start, end - start, value, origin)
+
+    @classmethod
+    def empty(cls, vtype, origin=None):
+        return cls(vtype, np.empty(0, np.int64), np.empty(0, np.int64),
+                   None if vtype == 'event' else np.empty(0, DTYPES.get(vtype, object)), origin)
+
+    def __len__(self):
+        return len(self.start)
+
+    def __getitem__(self, i):
+        """Slice events by position."""
+        if not isinstance(i, slice):
+            raise TypeError("Columns can only be sliced")
+        return Columns(self.type, self.start[i], self.duration[i],
+                       None if self.value is None else self.value[i], self.origin)
+
+    def __repr__(self):
+        return f"Columns(type={self.type!r}, events={len(self)})"
+
+    @property
+    def head_value(self):
+        return None if self.value is None else self.value[0]
+
+    @property
+    def tail_value(self):
+        return None if self.value is None else self.value[-1]
+
+    @property
+    def end(self):
+        return self.start + self.duration
+
+    @property
+    def nbytes(self):
+        """Approximate memory held by the arrays."""
+        n = self.start.nbytes + self.duration.nbytes
+        if self.value is not None:
+            n += self.value.nbytes
+            if self.value.dtype == object:
+                n += sum(len(v) if isinstance(v, (str, bytes)) else 16 for v in self.value)
+        return n
+
+    def _times(self, offsets):
+        if self.origin is None:
+            return offsets.view('timedelta64[ns]')
+        else:
+            return (offsets + self.origin).view('datetime64[ns]')
+
+    @property
+    def starts(self):
+        """Start times as `datetime64[ns]` (or `timedelta64[ns]` in virtual time)."""
+        return self._times(self.start)
+
+    @property
+    def ends(self):
+        """End times as `datetime64[ns]` (or `timedelta64[ns]` in virtual time)."""
+        return self._times(self.end)
+
+    def arrays(self, name='value'):
+        """Return the `start`, `end`, `duration`(, `name`) output columns."""
+        cols = {'start': self.starts, 'end': self.ends, 'duration': self.duration.view('timedelta64[ns]')}
+        if self.value is not None:
+            cols[name] = self.value
+        return cols
+
+    def to_df(self, name='value'):
+        """Build a `start`, `end`, `duration`(, `name`) DataFrame directly from the arrays."""
+        return frame(self.arrays(name))
+
+    def to_arrow(self, name='value'):
+        """Build a `pyarrow.Table` with `timestamp[ns]` (or `duration[ns]` in
+        virtual time) `start` and `end` columns directly from the arrays."""
+        return table(self.arrays(name))
+
+    def to_records(self, name='value'):
+        """Return a list of `{'start', 'end'(, name)}` dicts."""
+        starts, ends = list(self.starts), list(self.ends)
+        if self.value is None:
+            return [{'start': s, 'end': e} for s, e in zip(starts, ends)]
+        else:
+            return [{'start': s, 'end': e, name: v} for s, e, v in zip(starts, ends, self.value.tolist())]
+
+
+
+def continues(cols, t):
+    """Whether an event of `cols` starts before absolute time `t` (int64
+    ns) and ends after it."""
+    t = t - (cols.origin or 0)
+    return bool(np.any((cols.start < t) & (cols.end > t)))
+
+
+def concat(parts, boundaries=None, joined=None):
+    """Concatenate consecutive time-ordered results into one `Columns`.
+
+    When `boundaries` is given, `boundaries[k]` is the absolute time (int64
+    ns) separating `parts[k]` from `parts[k+1]`, and copies of events that
+    began before a boundary are dropped from the later part. A server that
+    clips events to the queried range returns an event straddling a
+    boundary as two pieces touching there, which look just like two
+    separate adjacent events. Touching pieces with the same value are
+    merged back into one only when `joined(b)` confirms that a single
+    event continues across boundary `b`; without `joined` they are kept.
+    """
+    out = [parts[0]]
+    for k, p in enumerate(parts[1:]):
+        if boundaries is not None and len(p):
+            b = boundaries[k] - (p.origin or 0)
+            p = p[int(np.searchsorted(p.start, b)):]
+            i = max((j for j, q in enumerate(out) if len(q)), default=None)
+            if (joined is not None and len(p) and i is not None and out[i].end[-1] == b == p.start[0]
+                    and out[i].tail_value == p.head_value and joined(boundaries[k])):
+                q = out[i][:]
+                q.duration = q.duration.copy()
+                q.duration[-1] += p.duration[0]
+                out[i], p = q, p[1:]
+        out.append(p)
+    base = out[0]
+    value = None if base.value is None else np.concatenate([q.value for q in out])
+    return Columns(base.type, np.concatenate([q.start for q in out]),
+                   np.concatenate([q.duration for q in out]), value, base.origin)
+
+
+def merge_keys(starts):
+    """Merge sorted int64 start arrays into their sorted distinct union.
+
+    Returns the union and, for each input, the position in the union of
+    each of its entries.
+    """
+    if all(len(x) == len(starts[0]) and np.array_equal(x, starts[0]) for x in starts[1:]):
+        # columns of a `when`-aligned view usually share the same starts
+        return starts[0], [np.arange(len(starts[0]))] * len(starts)
+    merged = np.concatenate(starts)
+    # each input is sorted, so a stable sort of their concatenation is a k-way merge
+    order = np.argsort(merged, kind='stable')
+    ordered = merged[order]
+    new = np.empty(len(ordered), bool)
+    new[:1] = True
+    np.not_equal(ordered[1:], ordered[:-1], out=new[1:])
+    position = np.empty(len(merged), np.int64)
+    position[order] = np.cumsum(new) - 1
+    return ordered[new], np.split(position, np.cumsum([len(x) for x in starts])[:-1])
+
+
+def align(named, limit=None):
+    """Outer-join `(name, Columns)` results on their start times,
+    returning a dict of output columns.
+
+    The already sorted start arrays are merged in a single pass, `limit`
+    (the first `limit` rows, or the last `-limit` rows when negative) is
+    applied to the merged keys, and each output column is allocated once
+    and filled by position. `end` and `duration` come from the first column
+    and are `NaT` on rows it has no event for; missing values are `NaN`.
+    """
+    if limit:
+        # no more than `limit` events of any column can reach the result
+        named = [(name, c[:limit] if limit > 0 else c[limit:]) for name, c in named]
+    keys, positions = merge_keys([c.start + (c.origin or 0) for _, c in named])
+    n = len(keys)
+    if limit and n > abs(limit):
+        lo = 0 if limit > 0 else n + limit
+        keys, n = keys[lo:lo + abs(limit)], abs(limit)
+        positions = [p - lo for p in positions]
+    unit = 'timedelta64[ns]' if named[0][1].origin is None else 'datetime64[ns]'
+
+    cols = {'start': keys.view(unit)}
+    for k, ((name, c), pos) in enumerate(zip(named, positions)):
+        rows = np.nonzero((pos >= 0) & (pos < n))[0] if limit else slice(None)
+        pos = pos[rows]
+        if k == 0:
+            end = np.full(n, np.iinfo(np.int64).min, np.int64)
+            duration = end.copy()
+            duration[pos] = c.duration[rows]
+            end[pos] = keys[pos] + duration[pos]
+            cols['end'] = end.view(unit)
+            cols['duration'] = duration.view('timedelta64[ns]')
+        if c.value is None:
+            continue
+        if len(pos) == n:
+            out = np.empty(n, c.value.dtype)
+        else:
+            out = np.full(n, np.nan, np.float64 if c.value.dtype.kind in 'fiu' else object)
+        out[pos] = c.value[rows]
+        cols[name] = out
+    return cols
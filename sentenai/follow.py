@@ -0,0 +1,100 @@
+"""Incremental following of live views."""
+from sentenai.columns import Columns, concat
+from sentenai.query import CBOR, bound, decode_columns, render, statements
+import numpy as np
+import time
+
+
+def timestamp(t):
+    """Absolute int64 nanoseconds for a point in time."""
+    return int(np.datetime64(t, 'ns').astype(np.int64))
+
+
+def unchanged(a, b, i):
+    """Whether event `i` is the same in `Columns` `a` and `b`."""
+    return (a.start[i] == b.start[i] and a.duration[i] == b.duration[i]
+            and (a.value is None or a.value[i] == b.value[i]))
+
+
+class Follower(object):
+    """Keeps the recent events of a single-statement view up to date.
+
+    Each `refresh` only queries the time since the previous one. When the
+    last buffered event reached the end of the previous query it may still
+    be open, so the query starts at that event instead and its extended
+    version replaces it. Events are kept in a columnar buffer, and those
+    that ended more than `retention` before the latest refresh are dropped.
+    Iterating refreshes every `poll` seconds and yields the events added or
+    extended by each refresh that found any.
+    """
+    def __init__(self, view, start=None, retention=None, poll=1.0):
+        if len(view._tspl) > 1:
+            raise ValueError("follow is only supported on single-statement views.")
+        (self._name, self._tspl), = statements(view._tspl, view._when)[1]
+        self._view = view
+        self.retention = None if retention is None else int(np.timedelta64(retention, 'ns').astype(np.int64))
+        self.poll = poll
+        self._cols = None
+        if start is not None:
+            self._last = timestamp(start)
+        else:
+            self._last = time.time_ns() - (self.retention or 0)
+
+    def _render(self, cols):
+        return render(cols, self._name, self._view._df, self._view._arrow)
+
+    @property
+    def data(self):
+        """All buffered events."""
+        if self._cols is None:
+            self.refresh()
+        return self._render(self._cols)
+
+    def refresh(self, until=None):
+        """Fetch the events up to `until` (default: now) and return the ones
+        that were added or extended."""
+        hi = time.time_ns() if until is None else timestamp(until)
+        lo = self._last
+        kept = prev = self._cols
+        if kept is not None and len(kept):
+            o = kept.origin or 0
+            if kept.end[-1] + o >= lo:
+                # the tail may still be open: query it again from its start
+                lo = int(kept.start[-1]) + o
+            kept = kept[:int(np.searchsorted(kept.start, lo - o, 'left'))]
+        if hi <= lo and kept is not None:
+            return self._render(kept[:0])
+
+        new = decode_columns(self._view._post(json=self._tspl, params={'start': bound(lo, False), 'end': bound(hi, False)}, headers=CBOR))
+        if kept is None:
+            kept = Columns.empty(new.type, new.origin)
+        elif new.origin != kept.origin:
+            new = Columns(new.type, new.start + ((new.origin or 0) - (kept.origin or 0)), new.duration, new.value, kept.origin)
+        o = kept.origin or 0
+        if len(kept):
+            # every kept event ends by `lo`: one reaching past it would be the
+            # open tail, which is re-queried whole, so the server never clipped
+            # a kept event at `lo` and events touching it are left separate
+            merged = concat([kept, new], [lo])
+            first = len(kept)
+        else:
+            merged, first = new, 0
+        if prev is not None:
+            # a re-queried tail that has not changed is not news
+            while first < min(len(prev), len(merged)) and unchanged(prev, merged, first):
+                first += 1
+
+        if self.retention is not None and len(merged):
+            reach = np.maximum.accumulate(merged.end)
+            dropped = int(np.searchsorted(reach, hi - self.retention - o, 'right'))
+            merged, first = merged[dropped:], max(first - dropped, 0)
+        self._cols = merged
+        self._last = hi
+        return self._render(merged[first:])
+
+    def __iter__(self):
+        while True:
+            new = self.refresh()
+            if len(new):
+                yield new
+            time.sleep(self.poll)
@@ -0,0 +1,155 @@
+"""TSPL query building and result decoding shared by `View` and `AsyncView`."""
+from sentenai.api import iso8601, dt64
+from sentenai.columns import Columns, align, frame, table
+import numpy as np
+import cbor2
+import io
+
+
+CBOR = {'Accept': 'application/cbor'}
+
+
+def slice_params(i):
+    """Translate a time slice into `start`, `end` and `limit` query parameters."""
+    if not isinstance(i, slice):
+        raise Exception("wrong type")
+    params = {}
+
+    if i.start is None:
+        pass
+    elif type(i.start) is int:
+        params['start'] = int(i.start)
+    else:
+        params['start'] = iso8601(i.start)
+
+    if i.stop is None:
+        pass
+    elif type(i.stop) is int:
+        params['end'] = int(i.stop)
+    else:
+        params['end'] = iso8601(i.stop)
+
+    if i.step is not None:
+        params['limit'] = i.step
+    return params
+
+
+def ns(t):
+    """Absolute int64 nanoseconds for a query bound (an int in virtual time
+    or an ISO8601 timestamp)."""
+    if type(t) is int:
+        return t
+    return int(dt64(t).astype('datetime64[ns]').astype(np.int64))
+
+
+def bound(t, virtual):
+    """Format absolute int64 nanoseconds `t` as a query bound."""
+    return t if virtual else iso8601(np.datetime64(t, 'ns'))
+
+
+def shard_bounds(lo, hi, shards):
+    """Split `[lo, hi)` into `shards` equal ranges and return the distinct
+    inner boundaries."""
+    return sorted(set(lo + (hi - lo) * k // shards for k in range(1, shards)) - {lo, hi})
+
+
+def statements(tspl, when=None):
+    """Return the `when` clause and the `(name, statement)` pairs to run for
+    a view with columns `tspl`. Multi-column views without an explicit
+    `when` are aligned on the union of their events."""
+    if when is None and len(tspl) > 1:
+        when = ' or '.join(f'events({x})' for x in tspl.values())
+    if when is None:
+        return when, list(tspl.items())
+    else:
+        return when, [(name, f'({x}) when {when}') for name, x in tspl.items()]
+
+
+def decode_columns(resp):
+    """Decode a TSPL query response into `Columns`."""
+    t = resp.headers['type']
+    if resp.headers['content-type'] == 'application/cbor':
+        origin = None
+        if 'origin' in resp.headers:
+            origin = int(np.datetime64(resp.headers['origin'][:-1], 'ns').astype(np.int64))
+        return Columns.from_cbor(t, cbor2.loads(resp.content), origin)
+    else:
+        data = resp.json()
+        if isinstance(data, list):
+            return Columns.from_json(t, data)
+        else:
+            print(data)
+            raise Exception(data)
+
+
+def iter_cbor(fp, batch):
+    """Read a top-level CBOR array incrementally from `fp`, yielding lists of
+    at most `batch` items without holding the whole document in memory."""
+    head = fp.read(1)
+    if not head:
+        return
+    major, info = head[0] >> 5, head[0] & 0x1f
+    if major != 4:
+        raise ValueError("expected a CBOR array")
+    if info == 31:
+        # indefinite length: the decoder must not read ahead of the break marker
+        fp = fp if hasattr(fp, 'peek') else io.BufferedReader(fp)
+        dec = cbor2.CBORDecoder(fp, read_size=1)
+        n = None
+    else:
+        n = info if info < 24 else int.from_bytes(fp.read(1 << (info - 24)), 'big')
+        dec = cbor2.CBORDecoder(fp)
+    items = []
+    while n is None or n > 0:
+        if n is None:
+            if fp.peek(1)[:1] in (b'\xff', b''):
+                break
+        else:
+            n -= 1
+        items.append(dec.decode())
+        if len(items) >= batch:
+            yield items
+            items = []
+    if items:
+        yield items
+
+
+def iter_columns(resp, batch):
+    """Decode a streamed TSPL query response into `Columns` batches of at
+    most `batch` events as the body arrives."""
+    t = resp.headers['type']
+    if resp.headers['content-type'] != 'application/cbor':
+        cols = decode_columns(resp)
+        for i in range(0, len(cols), batch):
+            yield cols[i:i+batch]
+        return
+    origin = None
+    if 'origin' in resp.headers:
+        origin = int(np.datetime64(resp.headers['origin'][:-1], 'ns').astype(np.int64))
+    resp.raw.decode_content = True
+    for events in iter_cbor(resp.raw, batch):
+        yield Columns.from_cbor(t, events, origin)
+
+
+def render(cols, name, df=False, arrow=False):
+    """Present decoded columns as an Arrow table, a DataFrame or a list of events."""
+    if arrow:
+        return cols.to_arrow(name)
+    elif df:
+        return cols.to_df(name)
+    else:
+        return cols.to_records()
+
+
+def join(named, limit=None, df=False, arrow=False):
+    """Combine the decoded `(name, Columns)` results of each column of a view."""
+    if len(named) == 0:
+        return None
+    elif len(named) == 1:
+        name, cols = named[0]
+        return render(cols, name, df, arrow)
+    elif arrow:
+        return table(align(named, limit))
+    else:
+        r = frame(align(named, limit))
+        return r if df else r.to_dict('records')
@@ -1,8 +1,13 @@
 import math
 from copy import copy
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from collections import namedtuple
 import numpy as np
-from sentenai.api import API, dt64, td64, iso8601
+import simplejson as JSON
+import cbor2
+from sentenai.api import API, dt64, td64, iso8601, SentenaiEncoder, SentenaiError
 
 import collections
 
@@ -16,22 +21,124 @@ def flatten(d, parent_key='', sep='_'):
             items.append((new_key, v))
     return dict(items)
 
+class Event(object):
+    def __init__(self, id=None, ts=None, duration=None, data=None):
+        self.id = id
+        self.ts = ts
+        self.duration = duration
+        self.data = data
+
+    def __eq__(self, other):
+        return isinstance(other, Event) and (self.id, self.ts, self.duration, self.data) == \
+            (other.id, other.ts, other.duration, other.data)
+
+    def __repr__(self):
+        return f"Event(id={self.id!r}, ts={self.ts!r}, duration={self.duration!r}, data={self.data!r})"
+
+
+Record = namedtuple('Record', ['id', 'ts', 'duration', 'data'])
+
+
+def timestamp(ej):
+    try:
+        return int(ej['ts'])
+    except:
+        return ej['ts']
+
+
+def event_columns(page, virtual):
+    """A page of listed events as a dict of arrays: `id` and `data` as
+    object arrays, `ts` as int64 (virtual time) or `datetime64[ns]`, and
+    `duration` as float64 with `NaN` where there is none."""
+    n = len(page)
+    ids, data = np.empty(n, object), np.empty(n, object)
+    ids[:] = [ej['id'] for ej in page]
+    data[:] = [ej['event'] or None for ej in page]
+    if virtual:
+        ts = np.fromiter((int(ej['ts']) for ej in page), np.int64, n)
+    else:
+        ts = np.array([str(ej['ts']).rstrip('Z') for ej in page], 'datetime64[ns]')
+    duration = np.fromiter((np.nan if ej.get('duration') is None else float(ej['duration']) for ej in page),
+                           np.float64, n)
+    return {'id': ids, 'ts': ts, 'duration': duration, 'data': data}
+
+
 class Updates(API):
     def __init__(self, parent):
         API.__init__(self, parent._credentials, *parent._prefix, "events", params=parent._params)
         self._parent = parent
 
+    @property
+    def _t0(self):
+        return self._parent.t0 if hasattr(self._parent, 't0') else self._parent.origin
+
     def __iter__(self):
-        i = 0
-        n = 100
-        while True:
-            e = self[i::n]
-            if len(e) == 0:
-                raise StopIteration
-            else:
-                for x in e:
-                    yield e
-                i += n
+        return self.scan()
+
+    def scan(self, start=None, end=None, page=1000, form='events'):
+        """Iterate over the events from `start` to `end` in time order.
+
+        Pages of `page` events are requested with a cursor on the last
+        timestamp seen, skipping the ids already returned at that
+        timestamp, and the next page is fetched in the background while
+        the current one is consumed. `form` selects what is yielded:
+        `'events'` for `Event` objects, `'records'` for compact `Record`
+        tuples, or `'columns'` for one dict of arrays per page (see
+        `event_columns`).
+        """
+        if form not in ('events', 'records', 'columns'):
+            raise ValueError("form must be 'events', 'records' or 'columns'")
+        virtual = self._t0 is None
+        params = copy(self._params)
+        params['sort'] = 'asc'
+        if end is not None:
+            params['end'] = int(end) if virtual else iso8601(end)
+        cursor = None if start is None else (int(start) if virtual else iso8601(start))
+        seen = set()
+
+        def fetch(cursor, limit):
+            ps = dict(params, limit=limit)
+            if cursor is not None:
+                ps['start'] = cursor
+            return self._page(ps)
+
+        limit = page
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            pending = pool.submit(fetch, cursor, limit)
+            while True:
+                raw = pending.result()
+                new = [ej for ej in raw if not (ej['ts'] == cursor and ej['id'] in seen)]
+                full = len(raw) >= limit
+                if full:
+                    if new:
+                        cursor, limit = raw[-1]['ts'], page
+                        seen = {ej['id'] for ej in raw if ej['ts'] == cursor}
+                    else:
+                        # more events share the cursor's timestamp than fit in a page
+                        limit *= 2
+                    pending = pool.submit(fetch, cursor, limit)
+                if new:
+                    if form == 'columns':
+                        yield event_columns(new, virtual)
+                    elif form == 'records':
+                        yield from (Record(ej['id'], timestamp(ej), ej.get('duration'), ej['event'] or None)
+                                    for ej in new)
+                    else:
+                        yield from self._events(new)
+                if not full:
+                    return
+
+    def _page(self, params):
+        resp = self._get(params=params)
+        if resp.status_code == 200:
+            return resp.json()
+        else:
+            raise Exception(resp.status_code)
+
+    @staticmethod
+    def _events(page):
+        return [Event(id=ej['id'], ts=timestamp(ej), duration=ej.get("duration"), data=ej['event'] or None)
+                for ej in page]
 
     def __delitem__(self, i):
         res = self._delete(i)
@@ -52,18 +159,10 @@ class Updates(API):
 
         if isinstance(i, str):
             # this is get by id
-            res = self._get(i)
-            if res.status_code == 200:
-                ej = res.json()
-                try:
-                    ts = int(res.headers['timestamp'])
-                except:
-                    ts = res.headers['timestamp']
-                return Event(id=i, ts=ts, duration=res.headers.get('duration'), data=ej)
-            elif res.status_code == 404:
+            evt = self._event(i)
+            if evt is None:
                 raise KeyError("Updates does not exist")
-            else:
-                raise Exception(res.status_code)
+            return evt
 
         params = copy(self._params)
 
@@ -72,7 +171,7 @@ class Updates(API):
 
         elif isinstance(i, slice):
             # time slice
-            t0 = self._parent.t0
+            t0 = self._t0
             params['sort'] = 'asc'
             if i.start is not None:
                 if t0 is None:
@@ -93,28 +192,98 @@ class Updates(API):
                     params['start'], params['end'] = params['end'], params['start']
                     params['sort'] = 'desc'
 
-            resp = self._get(params=params)
-            if resp.status_code == 200:
-                evts = []
-                for ej in resp.json():
-                    try:
-                        ts = int(ej['ts'])
-                    except:
-                        ts = ej['ts']
-                    evts.append(
-                        Event(
-                            id=ej['id'],
-                            ts=ts,
-                            duration=ej.get("duration"),
-                            data=ej['event'] or None
-                        )
-                    )
-                return evts
-            else:
-                raise Exception(resp.status_code)
+            return self._events(self._page(params))
         else:
             raise ValueError("input must be either string or slice")
 
+    def _event(self, i):
+        """Fetch the event with id `i`, or `None` if it does not exist."""
+        res = self._get(i)
+        if res.status_code == 200:
+            ej = res.json()
+            try:
+                ts = int(res.headers['timestamp'])
+            except:
+                ts = res.headers['timestamp']
+            return Event(id=i, ts=ts, duration=res.headers.get('duration'), data=ej)
+        elif res.status_code == 404:
+            return None
+        else:
+            raise Exception(res.status_code)
+
+    def _concurrently(self, f, ids):
+        ids = list(ids)
+        if len(ids) < 2:
+            return [f(i) for i in ids]
+        with ThreadPoolExecutor(max_workers=min(len(ids), self._transport.maxsize)) as pool:
+            return list(pool.map(f, ids))
+
+    def get_many(self, ids):
+        """Fetch the events with the given ids concurrently over the shared
+        connection pool. Returns them in order, with `None` for ids that
+        do not exist."""
+        return self._concurrently(self._event, ids)
+
+    def delete_many(self, ids):
+        """Delete the events with the given ids concurrently over the
+        shared connection pool. Returns the ids that did not exist."""
+        def delete(i):
+            res = self._delete(i)
+            if res.status_code == 404:
+                return i
+            elif res.status_code != 204:
+                raise Exception(res.status_code)
+
+        return [i for i in self._concurrently(delete, ids) if i is not None]
+
+    @staticmethod
+    def _record(evt):
+        """The bulk representation of an event, as listed by a time slice."""
+        rec = {'event': evt.data}
+        if evt.id is not None:
+            rec['id'] = evt.id
+        if evt.ts is not None:
+            rec['ts'] = evt.ts if isinstance(evt.ts, int) else iso8601(evt.ts)
+        if evt.duration is not None:
+            rec['duration'] = td64(evt.duration).astype('timedelta64[ns]').astype(float) / 1000000000.
+        return rec
+
+    def insert_many(self, events, batch=10000, format='ndjson'):
+        """Insert `events`, any iterable of `Event`s, with one request per
+        `batch` events, encoded as newline-delimited JSON (`'ndjson'`) or a
+        CBOR array (`'cbor'`). Only one batch is held in memory at a time.
+        Returns the ids of the inserted events; events without an id are
+        given the ones the server assigned. Raises `SentenaiError` if the
+        server stores a batch with such events without returning its ids,
+        leaving the batches before it and that batch inserted."""
+        if format not in ('ndjson', 'cbor'):
+            raise ValueError("format must be 'ndjson' or 'cbor'")
+        events = iter(events)
+        ids = []
+        while True:
+            chunk = list(islice(events, batch))
+            if not chunk:
+                return ids
+            records = [self._record(evt) for evt in chunk]
+            if format == 'cbor':
+                body = cbor2.dumps(records)
+                hdrs = {'Content-Type': 'application/cbor'}
+            else:
+                lines = (JSON.dumps(r, ignore_nan=True, cls=SentenaiEncoder) + "\n" for r in records)
+                body = "".join(lines).encode('utf-8')
+                hdrs = {'Content-Type': 'application/x-ndjson'}
+            r = self._post(json=body, headers=hdrs, raw=True)
+            if r.status_code not in [200, 201, 204]:
+                raise Exception(r.status_code)
+            assigned = r.json() if r.status_code in [200, 201] and r.content else None
+            if assigned is not None and len(assigned) == len(chunk):
+                ids.extend(assigned)
+            elif all(evt.id is not None for evt in chunk):
+                ids.extend(evt.id for evt in chunk)
+            else:
+                raise SentenaiError(f"server did not return the ids of {len(chunk)} inserted events "
+                                    f"({len(ids)} inserted before them)")
+
     def update(self, evt):
         hdrs = {}
         if evt.id is None:
@@ -0,0 +1,801 @@
+"""Ingestion of DataFrames into a database.
+
+Timestamps, durations, missing-value masks and per-type value conversions
+are computed for whole columns with numpy; chunks are then sliced out of
+the resulting arrays. Chunks flow through a pipeline of convert, encode
+and send stages connected by bounded buffers, so a slow server blocks the
+producer instead of letting pending chunks pile up in memory.
+"""
+from sentenai.api import PANDAS, ARROW
+from collections import deque, OrderedDict
+from multiprocessing import shared_memory
+from pathlib import Path
+from tqdm import tqdm
+import simplejson as JSON
+import numpy as np
+import cbor2
+import os
+import threading
+import time
+if PANDAS: import pandas as pd
+if ARROW: import pyarrow as pa
+
+
+def utc(col):
+    """A column of times as naive UTC `datetime64[ns]` values."""
+    t = pd.to_datetime(col)
+    if t.dt.tz is not None:
+        t = t.dt.tz_convert('UTC').dt.tz_localize(None)
+    return t.to_numpy().astype('datetime64[ns]')
+
+
+def nanoseconds(col, origin):
+    """int64 nanoseconds since `origin` for a column of times, or virtual
+    nanoseconds when `origin` is `None`."""
+    if origin is not None:
+        return utc(col).view(np.int64) - np.datetime64(origin, 'ns').astype(np.int64)
+    elif col.dtype.kind == 'm':
+        return col.to_numpy().astype('timedelta64[ns]').view(np.int64)
+    elif col.dtype.kind == 'f':
+        # seconds, as `td64` reads floats
+        return np.round(col.to_numpy() * 1e9).astype(np.int64)
+    else:
+        return col.to_numpy().astype(np.int64)
+
+
+def event_times(df, origin):
+    """Start offsets and durations of a start-sorted DataFrame as int64
+    nanoseconds. Without an `end` column each event lasts until the next
+    one starts, and the last lasts 1ns."""
+    ts = nanoseconds(df['start'], origin)
+    if 'end' in df.columns:
+        dur = nanoseconds(df['end'], origin) - ts
+    else:
+        dur = np.ones_like(ts)
+        dur[:-1] = np.diff(ts)
+    return ts, dur
+
+
+def column_values(col, vtype):
+    """The wire representation of a column stored as `vtype`, and a mask of
+    its non-missing entries."""
+    valid = ~np.asarray(pd.isna(col), bool)
+    if vtype == 'datetime':
+        values = np.char.add(np.datetime_as_string(utc(col), unit='ns'), 'Z')
+    elif vtype == 'timedelta':
+        values = col.to_numpy().astype('timedelta64[ns]').view(np.int64)
+    elif vtype in ('point', 'point3'):
+        import shapely
+        geoms = col.to_numpy(dtype=object)
+        values = np.full((len(col), 3 if vtype == 'point3' else 2), np.nan)
+        values[valid] = shapely.get_coordinates(geoms[valid], include_z=vtype == 'point3')
+    elif vtype == 'date':
+        values = np.datetime_as_string(np.where(valid, col.to_numpy(dtype=object), None).astype('datetime64[D]'))
+    elif vtype == 'time':
+        values = np.array([v.isoformat() if ok else None for v, ok in zip(col, valid)], dtype=object)
+    else:
+        values = col.to_numpy()
+    return values, valid
+
+
+class Runs(object):
+    """Counts of the values read and of the events left after merging runs
+    of equal values, with the `tolerance` used to compare floats."""
+    def __init__(self, tolerance=0.0):
+        self.tolerance = tolerance
+        self.values = 0
+        self.events = 0
+
+    @property
+    def ratio(self):
+        """Values read per event uploaded."""
+        return self.values / self.events if self.events else 1.0
+
+    def __repr__(self):
+        return "Runs(tolerance={}, values={}, events={}, ratio={:.1f})".format(
+            self.tolerance, self.values, self.events, self.ratio)
+
+
+def coalesce(ts, dur, values, mask, tolerance=0.0):
+    """Merge runs of back-to-back events with equal values into single
+    longer events. Floats are equal when within `tolerance` of the first
+    value of the run, which is the value the merged event keeps; points
+    are compared coordinate by coordinate. Returns the mask of the events
+    that start a run and the durations to send."""
+    idx = np.flatnonzero(mask)
+    if len(idx) < 2:
+        return mask, dur
+    v = values[idx]
+    end = ts[idx] + dur[idx]
+    drift = tolerance and v.dtype.kind == 'f'
+
+    def within(diff):
+        near = np.abs(diff) <= tolerance
+        return near.all(axis=-1) if v.ndim > 1 else near
+
+    if drift:
+        same = within(np.diff(v, axis=0))
+    else:
+        same = np.asarray(v[1:] == v[:-1], bool)
+        if v.ndim > 1:
+            same = same.all(axis=1)
+    head = np.ones(len(idx), bool)
+    head[1:] = ~((end[:-1] == ts[idx[1:]]) & same)
+    if drift:
+        # neighbours within tolerance can still drift away from the run's value
+        starts = np.flatnonzero(head)
+        spread = np.maximum.reduceat(v, starts) - np.minimum.reduceat(v, starts)
+        for k in np.flatnonzero(~within(spread)):
+            a, b = starts[k], starts[k + 1] if k + 1 < len(starts) else len(v)
+            first = v[a]
+            for i in range(a + 1, b):
+                if not within(v[i] - first):
+                    head[i] = True
+                    first = v[i]
+    starts = np.flatnonzero(head)
+    last = np.append(starts[1:], len(idx)) - 1
+    out = np.zeros_like(mask)
+    out[idx[starts]] = True
+    dur = dur.copy()
+    dur[idx[starts]] = end[last] - ts[idx[starts]]
+    return out, dur
+
+
+def columns(df, tmap, origin, runs=None):
+    """The start offsets and durations of a start-sorted DataFrame and, for
+    each column in `tmap`, its values (`None` for the events themselves),
+    mask of events to send and durations to send. With `runs`, runs of
+    equal values are coalesced and counted in it."""
+    ts, dur = event_times(df, origin)
+    keep = dur > 0
+    cols = {}
+    for name, vtype in tmap.items():
+        if name == 'start':
+            cols[name] = (None, keep, dur)
+            continue
+        values, valid = column_values(df[name], vtype)
+        mask, d = valid & keep, dur
+        if runs is not None:
+            n = int(np.count_nonzero(mask))
+            mask, d = coalesce(ts, dur, values, mask, runs.tolerance)
+            runs.values += n
+            runs.events += int(np.count_nonzero(mask))
+        cols[name] = (values, mask, d)
+    return ts, dur, cols
+
+
+def row_ranges(n, chunksize):
+    """Split `n` rows into `[a, b)` ranges of `chunksize` rows, which may be
+    a callable asked for the size of each range as it is produced."""
+    a = 0
+    while a < n:
+        b = a + max(1, int(chunksize() if callable(chunksize) else chunksize))
+        yield a, b
+        a = b
+
+
+def chunks(df, tmap, origin, chunksize, runs=None):
+    """Convert a start-sorted DataFrame into `{column: [(ts, dur[, value])]}`
+    chunks covering at most `chunksize` rows each, for each column in
+    `tmap`, yielding each with the index of its first row. The `'start'`
+    entry, when present, stands for the events themselves. Missing values
+    and rows with a non-positive duration are skipped, and chunks with no
+    events are not yielded. `chunksize` may be a callable, see
+    `row_ranges`; `runs` is as for `columns`."""
+    ts, _, cols = columns(df, tmap, origin, runs)
+    for a, b in row_ranges(len(df), chunksize):
+        chunk = {}
+        for name, (values, mask, dur) in cols.items():
+            m = mask[a:b]
+            s, d = ts[a:b][m].tolist(), dur[a:b][m].tolist()
+            if not s:
+                continue
+            if values is None:
+                chunk[name] = list(zip(s, d))
+            else:
+                chunk[name] = list(zip(s, d, values[a:b][m].tolist()))
+        if chunk:
+            yield a, chunk
+
+
+class SharedArrays(object):
+    """Copies of named numpy arrays in one shared memory block.
+
+    The block is unlinked once it is sealed (no more chunks will refer to
+    it) and every acquired chunk has been released."""
+    def __init__(self, arrays):
+        self.layout = {}
+        size = 0
+        for name, a in arrays.items():
+            size = -(-size // 16) * 16
+            self.layout[name] = (size, a.dtype.str, a.shape)
+            size += a.nbytes
+        self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        for name, a in arrays.items():
+            offset, dtype, shape = self.layout[name]
+            np.ndarray(shape, dtype, self.shm.buf, offset)[...] = a
+        self._refs = 0
+        self._sealed = False
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            self._refs += 1
+
+    def release(self):
+        with self._lock:
+            self._refs -= 1
+            if self._sealed and self._refs == 0:
+                self.close()
+
+    def seal(self):
+        with self._lock:
+            self._sealed = True
+            if self._refs == 0:
+                self.close()
+
+    def close(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+_attached = OrderedDict()
+
+
+def attach(name, layout):
+    """Map the arrays of a `SharedArrays` block in a worker process. The
+    most recently used blocks stay mapped."""
+    if name not in _attached:
+        # pool workers share the creating process's resource tracker, which
+        # forgets the block when the creating process unlinks it
+        _attached[name] = shared_memory.SharedMemory(name)
+        while len(_attached) > 8:
+            _attached.popitem(last=False)[1].close()
+    _attached.move_to_end(name)
+    buf = _attached[name].buf
+    return {k: np.ndarray(shape, dtype, buf, offset) for k, (offset, dtype, shape) in layout.items()}
+
+
+class SharedChunk(object):
+    """Rows `[a, b)` of one column, to be converted and encoded in a worker
+    process from the arrays of a `SharedArrays` block. Object values, which
+    can't be shared, are carried along instead."""
+    def __init__(self, owner, a, b, column, n, values=None):
+        self.owner = owner
+        self.block = owner.shm.name
+        self.layout = owner.layout
+        self.a, self.b = a, b
+        self.column = column
+        self.n = n
+        self.values = values
+
+    def __len__(self):
+        return self.n
+
+    def __getstate__(self):
+        return {k: v for k, v in self.__dict__.items() if k != 'owner'}
+
+    def events(self):
+        arrays = attach(self.block, self.layout)
+        a, b = self.a, self.b
+        m = arrays['mask:' + self.column][a:b]
+        dur = arrays.get('dur:' + self.column, arrays['dur'])
+        s, d = arrays['ts'][a:b][m].tolist(), dur[a:b][m].tolist()
+        if self.column == 'start':
+            return list(zip(s, d))
+        values = self.values if self.values is not None else arrays['value:' + self.column][a:b][m].tolist()
+        return list(zip(s, d, values))
+
+
+def encode_shared(chunk):
+    return cbor2.dumps(chunk.events())
+
+
+def shared_chunks(df, tmap, origin, chunksize, blocks, runs=None):
+    """Like `chunks`, but yield `{column: SharedChunk}` chunks whose arrays
+    are placed in shared memory, one block per DataFrame. Created blocks
+    are appended to `blocks`."""
+    ts, dur, cols = columns(df, tmap, origin, runs)
+    arrays = {'ts': ts, 'dur': dur}
+    objects = {}
+    for name, (values, mask, d) in cols.items():
+        arrays['mask:' + name] = mask
+        if d is not dur:
+            arrays['dur:' + name] = d
+        if values is None:
+            continue
+        if values.dtype == object:
+            objects[name] = values
+        else:
+            arrays['value:' + name] = values
+    owner = SharedArrays(arrays)
+    blocks.append(owner)
+    try:
+        for a, b in row_ranges(len(df), chunksize):
+            chunk = {}
+            for name in tmap:
+                m = arrays['mask:' + name][a:b]
+                n = int(np.count_nonzero(m))
+                if not n:
+                    continue
+                values = objects[name][a:b][m].tolist() if name in objects else None
+                owner.acquire()
+                chunk[name] = SharedChunk(owner, a, b, name, n, values)
+            if chunk:
+                yield a, chunk
+    finally:
+        owner.seal()
+
+
+FORMATS = {'.parquet': 'parquet', '.pq': 'parquet', '.arrow': 'arrow', '.feather': 'arrow',
+           '.ipc': 'arrow', '.csv': 'csv'}
+
+
+def source_format(source):
+    """Guess the format of a file from its name, ignoring compression suffixes."""
+    for suffix in reversed(Path(str(source)).suffixes):
+        if suffix.lower() in FORMATS:
+            return FORMATS[suffix.lower()]
+    raise ValueError(f"cannot tell the format of {source}, pass `format`")
+
+
+def arrow_frame(data):
+    """A DataFrame over the columns of a `pyarrow.Table` or `RecordBatch`.
+    Numeric and timestamp columns without nulls are wrapped as numpy views
+    of the Arrow buffers rather than copied; timestamps come back as naive
+    UTC."""
+    return pd.DataFrame({name: data.column(name).to_numpy(zero_copy_only=False) for name in data.column_names},
+                        copy=False)
+
+
+def read_frames(source, fmt, batch_rows, columns=None):
+    """Read a Parquet, Arrow IPC or CSV file as a sequence of DataFrames of
+    at most about `batch_rows` rows. Parquet and Arrow files are
+    memory-mapped, so only the batch being converted is materialized."""
+    if fmt == 'csv':
+        with pd.read_csv(source, usecols=columns, chunksize=batch_rows) as reader:
+            yield from reader
+        return
+    if not ARROW:
+        raise ImportError(f"reading {fmt} files requires pyarrow")
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        batches = pq.ParquetFile(source, memory_map=True).iter_batches(batch_rows, columns=columns)
+    elif fmt == 'arrow':
+        mm = pa.memory_map(str(source))
+        try:
+            reader = pa.ipc.open_file(mm)
+            batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+        except pa.ArrowInvalid:
+            mm.seek(0)
+            batches = pa.ipc.open_stream(mm)
+    else:
+        raise ValueError(f"unknown format {fmt}")
+    for batch in batches:
+        if columns is not None and fmt == 'arrow':
+            batch = batch.select(columns)
+        # Arrow batches may be larger than requested
+        for i in range(0, batch.num_rows, batch_rows):
+            yield arrow_frame(batch.slice(i, batch_rows))
+
+
+def ordered(frames):
+    """Sort each DataFrame by `start`. Without an `end` column an event
+    lasts until the next one starts, so each row is given the following
+    row's start as its `end` and the last row of a frame is held back
+    until the next frame arrives; the source is then expected to be
+    ordered by `start` across frames."""
+    tail = None
+    for df in frames:
+        df = df.sort_values(by='start', ignore_index=True)
+        if 'end' in df.columns:
+            if len(df):
+                yield df
+            continue
+        if tail is not None:
+            df = pd.concat([tail, df], ignore_index=True)
+        tail = df.iloc[-1:].reset_index(drop=True)
+        if len(df) > 1:
+            out = df.iloc[:-1].copy()
+            out['end'] = df['start'].to_numpy()[1:]
+            yield out
+    if tail is not None:
+        yield tail
+
+
+class Journal(object):
+    """A local, append-only record of the chunks of an ingestion that the
+    server has acknowledged, so an interrupted ingestion can be resumed.
+
+    The first line describes the ingestion (target, source fingerprint,
+    chunk size and the node and type of each column); each further line
+    marks one chunk of one column, identified by its frame and first row,
+    as acknowledged. A last line marks the ingestion complete. A line cut
+    short by a crash is ignored.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.header = None
+        self.done = set()
+        self.complete = False
+        self._fp = None
+        self._lock = threading.Lock()
+        if self.path.exists():
+            with open(self.path) as fp:
+                for line in fp:
+                    try:
+                        entry = JSON.loads(line)
+                    except ValueError:
+                        break
+                    if self.header is None:
+                        self.header = entry
+                    elif entry.get('complete'):
+                        self.complete = True
+                    else:
+                        self.done.add((entry['frame'], entry['row'], entry['column']))
+
+    def resumes(self, target, source):
+        """Whether this journal records an ingestion of `source` into `target`."""
+        if self.header is None:
+            return False
+        if self.header['target'] != target or self.header['source'] != source:
+            raise ValueError(f"journal {self.path} records a different ingestion; remove it to start over")
+        return True
+
+    def start(self, target, source, chunksize, nodes):
+        self.header = {'target': target, 'source': source, 'chunksize': chunksize, 'nodes': nodes}
+        self.done = set()
+        self.complete = False
+        with self._lock:
+            self._fp = open(self.path, 'w')
+            self._write(self.header)
+
+    def _write(self, entry):
+        self._fp.write(JSON.dumps(entry) + "\n")
+        self._fp.flush()
+
+    def ack(self, frame, row, column):
+        with self._lock:
+            if self._fp is None:
+                self._fp = open(self.path, 'a')
+            self.done.add((frame, row, column))
+            self._write({'frame': frame, 'row': row, 'column': column})
+
+    def finish(self):
+        with self._lock:
+            if self._fp is None:
+                self._fp = open(self.path, 'a')
+            if not self.complete:
+                self._write({'complete': True})
+                self.complete = True
+
+    def close(self):
+        with self._lock:
+            if self._fp is not None:
+                self._fp.close()
+                self._fp = None
+
+
+def fingerprint(df):
+    """Identify the contents of a DataFrame."""
+    return [len(df), [str(c) for c in df.columns], int(pd.util.hash_pandas_object(df, index=False).sum())]
+
+
+def file_fingerprint(source, batch_rows, columns=None):
+    """Identify a file and how it is split into DataFrames."""
+    st = os.stat(source)
+    return [str(Path(source).resolve()), st.st_size, st.st_mtime_ns, batch_rows, columns]
+
+
+class StageStats(object):
+    """Throughput counters for one pipeline stage. `seconds` is the time
+    spent working, summed over the stage's threads, and `depth` /
+    `max_depth` describe the buffer feeding the next stage."""
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.events = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.depth = 0
+        self.max_depth = 0
+        self._lock = threading.Lock()
+
+    def add(self, events, nbytes, seconds):
+        with self._lock:
+            self.items += 1
+            self.events += events
+            self.bytes += nbytes
+            self.seconds += seconds
+
+    @property
+    def rate(self):
+        """Events processed per second of work."""
+        return self.events / self.seconds if self.seconds else 0.0
+
+    def __repr__(self):
+        return "StageStats({!r}, items={}, events={}, bytes={}, seconds={:.3f}, max_depth={})".format(
+            self.name, self.items, self.events, self.bytes, self.seconds, self.max_depth)
+
+
+class IngestStats(object):
+    """Per-stage statistics of an ingestion, and the `Tuner` and `Runs`
+    if they were used."""
+    def __init__(self, tuner=None):
+        self.convert = StageStats('convert')
+        self.encode = StageStats('encode')
+        self.send = StageStats('send')
+        self.tuner = tuner
+        self.runs = None
+        self.elapsed = 0.0
+
+    @property
+    def stages(self):
+        return (self.convert, self.encode, self.send)
+
+    def __repr__(self):
+        return "IngestStats(elapsed={:.3f}, {})".format(self.elapsed, ", ".join(
+            "{}={:.0f} events/s".format(s.name, s.rate) for s in self.stages))
+
+
+class Tuner(object):
+    """Adapts the number of requests in flight and the size of each request
+    to the observed throughput and error rate.
+
+    Every `window` seconds the bytes acknowledged per second are compared
+    with the previous window. While the rate holds up, concurrency grows by
+    one request and the chunk size by `chunk_step` bytes (additive
+    increase); when it drops by more than a tenth the last concurrency step
+    is undone. A server error or timeout halves both (multiplicative
+    decrease), at most once per window. `history` records the settings and
+    rate of each window. Time is read from `clock`.
+    """
+    def __init__(self, concurrency=4, max_concurrency=64, chunk_bytes=256 * 2 ** 10,
+                 min_chunk_bytes=16 * 2 ** 10, max_chunk_bytes=8 * 2 ** 20, chunk_step=64 * 2 ** 10, window=1.0,
+                 clock=time.monotonic):
+        self.concurrency = concurrency
+        self.max_concurrency = max_concurrency
+        self.chunk_bytes = chunk_bytes
+        self.min_chunk_bytes = min_chunk_bytes
+        self.max_chunk_bytes = max_chunk_bytes
+        self.chunk_step = chunk_step
+        self.window = window
+        self.clock = clock
+        self.rate = 0.0
+        self.errors = 0
+        self.history = []
+        self._active = 0
+        self._cond = threading.Condition()
+        self._event_bytes = None
+        self._start = clock()
+        self._bytes = 0
+        self._window_errors = 0
+        self._decreased = None
+
+    def rows(self, default):
+        """Rows per chunk expected to make requests of `chunk_bytes`."""
+        with self._cond:
+            if self._event_bytes is None:
+                return default
+            return max(1, int(self.chunk_bytes / self._event_bytes))
+
+    def acquire(self):
+        """Wait for a request slot."""
+        with self._cond:
+            while self._active >= self.concurrency:
+                self._cond.wait()
+            self._active += 1
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    def success(self, events, nbytes):
+        with self._cond:
+            if events:
+                per = nbytes / events
+                self._event_bytes = per if self._event_bytes is None else 0.8 * self._event_bytes + 0.2 * per
+            self._bytes += nbytes
+            self._tick()
+
+    def failure(self):
+        """Record a server error or timeout."""
+        with self._cond:
+            self.errors += 1
+            self._window_errors += 1
+            now = self.clock()
+            if self._decreased is None or now - self._decreased >= self.window:
+                self._decreased = now
+                self.concurrency = max(1, self.concurrency // 2)
+                self.chunk_bytes = max(self.min_chunk_bytes, self.chunk_bytes // 2)
+            self._tick()
+
+    def _tick(self):
+        now = self.clock()
+        elapsed = now - self._start
+        if elapsed < self.window:
+            return
+        rate = self._bytes / elapsed
+        if not self._window_errors:
+            if rate >= 0.9 * self.rate:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+                self.chunk_bytes = min(self.max_chunk_bytes, self.chunk_bytes + self.chunk_step)
+            else:
+                self.concurrency = max(1, self.concurrency - 1)
+        self.history.append((self.concurrency, self.chunk_bytes, rate, self._window_errors))
+        self.rate = rate
+        self._start, self._bytes, self._window_errors = now, 0, 0
+        self._cond.notify_all()
+
+    def __repr__(self):
+        return "Tuner(concurrency={}, chunk_bytes={}, rate={:.0f} B/s, errors={})".format(
+            self.concurrency, self.chunk_bytes, self.rate, self.errors)
+
+
+class Buffer(object):
+    """A FIFO between two pipeline stages.
+
+    `put` blocks while the buffer holds `maxsize` items or, when `max_bytes`
+    is set, while the bytes reserved by earlier items would exceed it.
+    Reserved bytes stay reserved after `get` until `release`, so a consumer
+    can keep holding an item's memory until it is done with it. `get`
+    returns `None` once the buffer is finished and drained, or aborted.
+    """
+    def __init__(self, stats, maxsize, max_bytes=None):
+        self.stats = stats
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._items = deque()
+        self._cond = threading.Condition()
+        self._finished = False
+        self._aborted = False
+
+    def _full(self, size):
+        if len(self._items) >= self.maxsize:
+            return True
+        return self.max_bytes is not None and self.bytes > 0 and self.bytes + size > self.max_bytes
+
+    def put(self, item, size=0):
+        """Append `item`, reserving `size` bytes; returns `False` if aborted."""
+        with self._cond:
+            while self._full(size) and not self._aborted:
+                self._cond.wait()
+            if self._aborted:
+                return False
+            self._items.append((item, size))
+            self.bytes += size
+            self.stats.depth = len(self._items)
+            self.stats.max_depth = max(self.stats.max_depth, self.stats.depth)
+            self._cond.notify_all()
+            return True
+
+    def get(self):
+        with self._cond:
+            while not self._items and not self._finished and not self._aborted:
+                self._cond.wait()
+            if self._aborted or not self._items:
+                return None
+            entry = self._items.popleft()
+            self.stats.depth = len(self._items)
+            self._cond.notify_all()
+            return entry
+
+    def release(self, size):
+        with self._cond:
+            self.bytes -= size
+            self._cond.notify_all()
+
+    def finish(self):
+        with self._cond:
+            self._finished = True
+            self._cond.notify_all()
+
+    def abort(self):
+        with self._cond:
+            self._aborted = True
+            self._cond.notify_all()
+
+
+def pipeline(batches, send, workers=32, depth=32, max_bytes=64 * 2 ** 20, progress=None,
+             encode=cbor2.dumps, encoders=1, tuner=None):
+    """Upload `batches`, an iterable of `[(key, events)]` lists, by calling
+    `send(key, data)` with `encode(events)`, by default their CBOR encoding.
+
+    Converting batches runs in the calling thread, encoding in `encoders`
+    threads and sending in `workers` threads. At most `depth` converted
+    lists wait to be encoded, and at most `max_bytes` of encoded data (plus
+    one item per sender) is buffered or in flight; the earlier stages block
+    when these limits are reached. With a `Tuner`, each send waits for one
+    of its request slots and reports the bytes acknowledged. The first
+    error raised by a stage stops the pipeline and is re-raised. Returns
+    the `IngestStats`.
+    """
+    stats = IngestStats(tuner)
+    converted = Buffer(stats.convert, depth)
+    encoded = Buffer(stats.encode, max(depth, workers), max_bytes)
+    errors = []
+    lock = threading.Lock()
+    running = [encoders]
+    bar = tqdm(total=progress, unit=" values") if progress else None
+
+    def fail(e):
+        errors.append(e)
+        converted.abort()
+        encoded.abort()
+
+    def encoder():
+        try:
+            while True:
+                entry = converted.get()
+                if entry is None:
+                    break
+                (key, events), _ = entry
+                t = time.perf_counter()
+                data = encode(events)
+                stats.encode.add(len(events), len(data), time.perf_counter() - t)
+                if not encoded.put((key, len(events), data), len(data)):
+                    break
+        except Exception as e:
+            fail(e)
+        finally:
+            with lock:
+                running[0] -= 1
+                if not running[0]:
+                    encoded.finish()
+
+    def sender():
+        try:
+            while True:
+                entry = encoded.get()
+                if entry is None:
+                    break
+                (key, n, data), size = entry
+                t = time.perf_counter()
+                if tuner is not None:
+                    tuner.acquire()
+                try:
+                    send(key, data)
+                finally:
+                    if tuner is not None:
+                        tuner.release()
+                    encoded.release(size)
+                if tuner is not None:
+                    tuner.success(n, size)
+                stats.send.add(n, size, time.perf_counter() - t)
+                if bar is not None:
+                    bar.update(n)
+        except Exception as e:
+            fail(e)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=encoder, daemon=True) for _ in range(encoders)]
+    threads += [threading.Thread(target=sender, daemon=True) for _ in range(workers)]
+    for th in threads:
+        th.start()
+    try:
+        batches = iter(batches)
+        while not errors:
+            t = time.perf_counter()
+            try:
+                batch = next(batches)
+            except StopIteration:
+                break
+            stats.convert.add(sum(len(v) for k, v in batch), 0, time.perf_counter() - t)
+            if not all(converted.put(item) for item in batch):
+                break
+    except BaseException as e:
+        fail(e)
+    finally:
+        converted.finish()
+        for th in threads:
+            th.join()
+        if bar is not None:
+            bar.close()
+    stats.elapsed = time.perf_counter() - start
+    if errors:
+        raise errors[0]
+    return stats
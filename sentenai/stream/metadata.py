@@ -5,6 +5,23 @@ import base64
 import numpy as np
 if PANDAS: import pandas as pd
 
+def decode_meta(data):
+    """Convert a metadata response into a list of typed `(key, value)` pairs."""
+    meta = []
+    for k, md in data.items():
+        if md['type'] == 'int':
+            meta.append((k, int(md['value'])))
+        elif md['type'] == 'float':
+            meta.append((k, float(md['value'])))
+        elif md['type'] == 'datetime':
+            meta.append((k, dt64(md['value'])))
+        elif md['type'] == 'bool':
+            meta.append((k, bool(md['value'])))
+        else:
+            meta.append((k, str(md['value'])))
+    return meta
+
+
 class Metadata(API):
     def __init__(self, parent, metadata=None):
         self._parent = parent
@@ -20,19 +37,7 @@ class Metadata(API):
         return iter(v for k, v in self.items())
     
     def items(self):
-        meta = []
-        for k, md in self._get().json().items():
-            if md['type'] == 'int':
-                meta.append((k, int(md['value'])))
-            elif md['type'] == 'float':
-                meta.append((k, float(md['value'])))
-            elif md['type'] == 'datetime':
-                meta.append((k, dt64(md['value'])))
-            elif md['type'] == 'bool':
-                meta.append((k, bool(md['value'])))
-            else:
-                meta.append((k, str(md['value'])))
-        return meta
+        return decode_meta(self._get().json())
 
 
     def __repr__(self):
@@ -1,10 +1,14 @@
 from sentenai.stream.metadata import Metadata
+from sentenai.stream.ingest import chunks, shared_chunks, encode_shared, pipeline, read_frames, ordered, source_format, \
+    Tuner, Journal, fingerprint, file_fingerprint, nanoseconds, Runs, arrow_frame
+from sentenai.stream.writer import StreamWriter
+from sentenai.columns import Columns
 from sentenai.api import *
 if PANDAS:
     import pandas as pd
 from datetime import datetime, time, date
 import simplejson as JSON
-import re, io, math
+import re, io, math, itertools, random
 from collections import namedtuple
 from multiprocessing import Pool
 from tqdm import tqdm, tqdm_notebook
@@ -12,57 +16,114 @@ from time import sleep
 import cbor2
 from shapely.geometry import Point
 
-from queue import Queue
-from threading import Thread
-from concurrent.futures import ThreadPoolExecutor
-
-
-
-def worker(q, workers, total, progress, position=None):
-    with ThreadPoolExecutor(max_workers=workers) as pool:
-        if progress:
-            v = 0
-            with tqdm(total=total, unit=" values", position=position) as pbar:
-                while True:
-                    data = q.get()
-                    if not data:
-                        pbar.update(total - v)
-                        break # exit on empty list
-                    list(pool.map(index_data, data))
-                    n = sum([len(v) for d, n, i, v in data])
-                    v += n
-                    pbar.update(n)
-        else:
-            while True:
-                data = q.get()
-                if not data:
-                    break # exit on empty list
-                list(pool.map(index_data, data))
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 
-def index_data(args):
-    db, node, index, v = args
-    counter = 0
-    while counter < 10:
-        try:
-            data = cbor2.dumps(v)
-        except Exception as e:
-            print(e)
-            print(db, node, index)
-            print(v[-1])
 
+def post_events(db, node, index, data, tuner=None):
+    """Post CBOR encoded events to a node's index, retrying failed requests
+    and server errors with exponential backoff; rejected requests are not
+    retried. Failures are reported to
+    `tuner` if given."""
+    counter = 0
+    while True:
         try:
             resp = db._post('nodes', node, 'types', index,
                     json=data, headers={'Content-Type': 'application/cbor'}, raw=True)
-        except:
-            counter += 1
-            sleep(.1)
+        except (BadRequest, AccessDenied):
+            raise
+        except Exception as e:
+            error = e
         else:
-            if resp.status_code > 204:
-                resp.close()
-                raise Exception(f"failed on index")
             resp.close()
-            break
+            if resp.status_code < 300:
+                return
+            elif resp.status_code < 500:
+                raise Exception(f"failed on index")
+            error = Exception(f"failed on index: {resp.status_code}")
+        if tuner is not None:
+            tuner.failure()
+        counter += 1
+        if counter >= 10:
+            raise error
+        sleep(min(0.1 * 2 ** counter, 10) * random.uniform(0.5, 1.5))
+
+
+def column_type(col):
+    """Return the Sentenai type used to store a DataFrame column."""
+    if col.dtype == np.dtype('float32'):
+        return 'float'
+    elif col.dtype == np.dtype('float64'):
+        return 'float'
+    elif col.dtype == np.dtype('int32'):
+        return 'int'
+    elif col.dtype == np.dtype('int64'):
+        return 'int'
+    elif col.dtype == bool:
+        return 'bool'
+    elif col.dtype.kind == 'M':
+        return 'datetime'
+    elif col.dtype.kind == 'm':
+        return 'timedelta'
+    elif type(col[0]) == date:
+        return 'date'
+    elif type(col[0]) == time:
+        return 'time'
+    elif type(col[0]) == Point and col[0].has_z:
+        return 'point3'
+    elif type(col[0]) == Point:
+        return 'point'
+    else:
+        return 'text'
+
+
+def encode_events(values, origin):
+    """Convert `{'start', 'end'[, 'value']}` dicts into `(ts, dur[, value])`
+    tuples relative to `origin`."""
+    vs = []
+    if origin is not None:
+        for v in values:
+            start = (dt64(v['start']) - origin) // np.timedelta64(1, 'ns')
+            end = (dt64(v['end']) - origin) // np.timedelta64(1, 'ns')
+            if 'value' in v:
+                vs.append((int(start), int(end - start), v['value']))
+            else:
+                vs.append((int(start), int(end - start)))
+    else:
+        for v in values:
+            start = td64(v['start']) // np.timedelta64(1, 'ns')
+            end = td64(v['end']) // np.timedelta64(1, 'ns')
+            if 'value' in v:
+                vs.append((int(start), int(end - start), v['value']))
+            else:
+                vs.append((int(start), int(end - start)))
+    return vs
+
+
+def first_type(r):
+    """Return the primary type of a node from a `types` response."""
+    if r.status_code == 200:
+        ts = r.json()
+        if not ts:
+            return None
+        else:
+            return ts[0]
+    else:
+        return None
+
+
+def node_range(r, origin):
+    """Return the `(start, end)` of a node from a `range` response."""
+    if r.status_code == 200:
+        e = r.json()
+        if e is None:
+            return None
+        if origin is None:
+            return (e['start'], e['end'])
+        else:
+            return (origin + np.timedelta64(e['start'], 'ns'), origin + np.timedelta64(e['end'], 'ns'))
+    else:
+        return None
 
 
 class Database(API):
@@ -136,29 +197,29 @@ class Database(API):
             if isinstance(key[-1], slice):
                 path = key[:-1]
                 path += key[-1].start
-                workers = key[-1].stop
+                workers = key[-1].stop or workers
                 chunksize = key.step or chunksize
             else:
                 path = key
         elif isinstance(key, slice):
-            workers = key.stop
+            workers = key.stop or workers
             chunksize = key.step or chunksize
             path = (key.start,)
         else:
             path = (key,)
 
+        if ARROW and isinstance(content, (pa.Table, pa.RecordBatch)):
+            content = arrow_frame(content)
+
+        if (PANDAS and isinstance(content, pd.DataFrame)) or isinstance(content, list):
+            self.ingest(path, content, workers=workers, chunksize=chunksize)
+            return
+
         del self[path]
 
         if content is None:
             nid = self._put('paths', *path, json={'kind': 'directory'})
             return
-        elif PANDAS and isinstance(content, pd.DataFrame):
-            nid = self._put('paths', *path).json()['node']
-            self._put('nodes', nid, 'types', 'event')
-            cmap = {'start': nid}
-            tmap = {'start': 'event'}
-            dmap = {'start': []}
-            df = content.sort_values(by='start', ignore_index=True)
         elif type(content) == str:
             nid = self._put('paths', *path, json={'kind': 'virtual', 'tspl': content})
             return
@@ -199,153 +260,312 @@ class Database(API):
                 if isinstance(key, tuple) and len(key) > 1:
                     key = key[0]
                 self._put('links', key, nid)
+            self._invalidate(nodes=True)
             return
-        elif isinstance(content, list):
-                cmap = {}
-                tmap = {}
-                dmap = {}
-                df = pd.DataFrame(content).rename(columns={'value': path[-1]})
-                if set(df.columns) == {'start', 'end', path[-1]}:
-                    pass
-                elif set(df.columns) == {'start', 'end'}:
-                    dmap = {'start': []}
-                else:
-                    raise Exception(str(df.columns))
-                df = df.sort_values(by='start', ignore_index=True)
         else:
             raise TypeError("invalid assignment type")
 
+    def ingest(self, path, content, workers=32, chunksize=4096, depth=32, max_bytes=64 * 2 ** 20, processes=None,
+               tune=False, journal=None, coalesce=None):
+        """Replace `path` with the events of `content`, a DataFrame with a
+        `start` (and optionally `end`) column and one column per stream, or
+        a list of `{'start', 'end'[, 'value']}` dicts.
+
+        Events are uploaded in chunks of `chunksize` rows by a pipeline of
+        convert, encode and send stages with `workers` concurrent requests.
+        At most `depth` converted chunks and `max_bytes` of encoded data are
+        held at once; conversion blocks until the server catches up. With
+        `processes`, chunks are converted and encoded by a pool of that many
+        processes reading the column arrays from shared memory, leaving the
+        threads only the network I/O. With `tune` (`True` or a `Tuner`), the
+        number of requests in flight and the chunk size are adapted to the
+        observed throughput and errors instead, starting from `chunksize`
+        rows and never exceeding `workers` requests.
+
+        With `journal` (a file name or `Journal`), every chunk the server
+        acknowledges is recorded in that file. Calling `ingest` again with
+        the same content and journal after a failure keeps what was already
+        stored and only sends the chunks that were not acknowledged; with a
+        journal, `tune` only adapts the number of requests in flight.
+
+        With `coalesce`, consecutive back-to-back events of a column with
+        equal values are merged into one event spanning them before they
+        are encoded. Floats are equal within a tolerance of `coalesce`
+        (`True` for exact equality). The returned stats' `runs` counts the
+        values read and events sent. Returns the pipeline's `IngestStats`.
+        """
+        path = path if isinstance(path, tuple) else (path,)
+        df, nested = self._frame(path, content)
+        if len(df) == 0:
+            raise ValueError("Cannot index empty dataset")
+
+        cmap, tmap, chunksize, journal = self._begin(path, df, nested, journal, fingerprint(df), chunksize)
+        total = len(df) * (len(df.columns) - 1) if self._parent.interactive else None
+        return self._upload([df], cmap, tmap, workers, chunksize, depth, max_bytes, total, processes, tune, journal,
+                            coalesce)
+
+    def append(self, path, content, workers=32, chunksize=4096, depth=32, max_bytes=64 * 2 ** 20, processes=None,
+               tune=False, coalesce=None):
+        """Add the events of `content`, as for `ingest`, to `path` without
+        deleting what is already stored there.
+
+        Columns that already exist keep their node and type, columns that
+        don't are created beside them, and existing columns missing from
+        `content` are left untouched. The other arguments are as for
+        `ingest`. Returns the pipeline's `IngestStats`.
+        """
+        path = path if isinstance(path, tuple) else (path,)
+        df, nested = self._frame(path, content)
         if len(df) == 0:
             raise ValueError("Cannot index empty dataset")
 
+        cmap, tmap = self._setup(path, df, nested, keep=True)
+        total = len(df) * (len(df.columns) - 1) if self._parent.interactive else None
+        return self._upload([df], cmap, tmap, workers, chunksize, depth, max_bytes, total, processes, tune,
+                            coalesce=coalesce)
+
+    def replace(self, path, start, end, content, workers=32, chunksize=4096, depth=32, max_bytes=64 * 2 ** 20,
+                processes=None, tune=False, coalesce=None):
+        """Replace the events of `path` starting in `[start, end)` with the
+        events of `content`, as for `append`. Either bound may be `None`
+        to leave that side of the range open.
+
+        The range is cleared from the events and from each column in
+        `content` before uploading; other columns of `path` keep their
+        events. Every event of `content` must start within the range.
+        Returns the pipeline's `IngestStats`, or `None` when `content` is
+        empty and the range is only cleared.
+        """
+        path = path if isinstance(path, tuple) else (path,)
+        df, nested = self._frame(path, content)
+        ts = nanoseconds(df['start'], self.origin)
+        lo, hi = (None if t is None else nanoseconds(pd.Series([t]), self.origin)[0] for t in (start, end))
+        if (lo is not None and (ts < lo).any()) or (hi is not None and (ts >= hi).any()):
+            raise ValueError("events outside of the replaced range")
+
+        cmap, tmap = self._setup(path, df, nested, keep=True)
+        params = {k: iso8601(t) for k, t in (('start', start), ('end', end)) if t is not None}
+        for k in cmap:
+            self._delete('nodes', cmap[k], 'types', tmap[k], params=params)
+        self._invalidate()
+        if len(df) == 0:
+            return None
+        total = len(df) * (len(df.columns) - 1) if self._parent.interactive else None
+        return self._upload([df], cmap, tmap, workers, chunksize, depth, max_bytes, total, processes, tune,
+                            coalesce=coalesce)
+
+    @staticmethod
+    def _frame(path, content):
+        """The start-sorted DataFrame of events in `content`, and whether
+        its columns are stored below `path` rather than at it."""
+        if PANDAS and isinstance(content, pd.DataFrame):
+            return content.sort_values(by='start', ignore_index=True), True
+        elif isinstance(content, list):
+            df = pd.DataFrame(content, columns=None if content else ['start', 'end'])
+            df = df.rename(columns={'value': path[-1]})
+            if set(df.columns) not in ({'start', 'end', path[-1]}, {'start', 'end'}):
+                raise Exception(str(df.columns))
+            return df.sort_values(by='start', ignore_index=True), False
+        else:
+            raise TypeError("invalid assignment type")
+
+    def load(self, path, source, format=None, columns=None, batch_rows=65536,
+             workers=32, chunksize=4096, depth=32, max_bytes=64 * 2 ** 20, processes=None, tune=False, journal=None,
+             coalesce=None):
+        """Replace `path` with the events in a Parquet, Arrow IPC or CSV
+        file, like assigning a DataFrame read from it.
+
+        The file is read `batch_rows` rows at a time (memory-mapped for
+        Parquet and Arrow) and each batch is sorted and uploaded through the
+        `ingest` pipeline, so only a few batches are resident at once. The
+        format is guessed from the file name unless `format` is given, and
+        `columns` selects which columns to read (including `start` and
+        `end`). Without an `end` column the file must be ordered by `start`.
+        `processes`, `tune`, `journal` and `coalesce` are as for `ingest`,
+        though runs are not merged across batches; a journal only resumes a
+        load of the same, unmodified file with the same `columns` and
+        `batch_rows`. Returns the pipeline's `IngestStats`.
+        """
+        path = path if isinstance(path, tuple) else (path,)
+        source_id = file_fingerprint(source, batch_rows, columns) if journal is not None else None
+        frames = ordered(read_frames(source, format or source_format(source), batch_rows, columns))
+        first = next(frames, None)
+        if first is None:
+            raise ValueError("Cannot index empty dataset")
+
+        cmap, tmap, chunksize, journal = self._begin(path, first, True, journal, source_id, chunksize)
+        return self._upload(itertools.chain([first], frames), cmap, tmap, workers, chunksize, depth, max_bytes,
+                            processes=processes, tune=tune, journal=journal, coalesce=coalesce)
+
+    def _begin(self, path, df, nested, journal, source, chunksize):
+        """Replace `path` with the nodes for `df`'s columns, or take up the
+        interrupted upload of `source` recorded in `journal`. Returns the
+        nodes, types and chunk size to upload with, and the `Journal`."""
+        if journal is None:
+            del self[path]
+            cmap, tmap = self._setup(path, df, nested)
+            return cmap, tmap, chunksize, None
+        journal = journal if isinstance(journal, Journal) else Journal(journal)
+        target = [self._name, list(path)]
+        if journal.resumes(target, source):
+            nodes = journal.header['nodes']
+            return ({k: n for k, (n, t) in nodes.items()}, {k: t for k, (n, t) in nodes.items()},
+                    journal.header['chunksize'], journal)
+        del self[path]
+        cmap, tmap = self._setup(path, df, nested)
+        journal.start(target, source, chunksize, {k: [cmap[k], tmap[k]] for k in cmap})
+        return cmap, tmap, chunksize, journal
+
+    def _setup(self, path, df, nested, keep=False):
+        """Create the nodes for a DataFrame's columns and return the node and
+        type of each. The events themselves are stored at `path` with each
+        column below it when `nested`; otherwise the single value column, if
+        any, is stored at `path`. With `keep`, nodes that already exist are
+        used with the type they already have."""
+        cmap, tmap = {}, {}
+        values = [x for x in df.columns if x not in ['start', 'end']]
+
+        def node(parts, vtype):
+            if keep:
+                r = self._get('paths', *parts)
+                if r.status_code == 200:
+                    nid = r.json()['node']
+                    current = first_type(self._get('nodes', nid, 'types'))
+                    if current is not None:
+                        return nid, current
+                    self._put('nodes', nid, 'types', vtype)
+                    return nid, vtype
+            nid = self._put('paths', *parts).json()['node']
+            self._put('nodes', nid, 'types', vtype)
+            return nid, vtype
+
+        if nested or not values:
+            cmap['start'], tmap['start'] = node(path, 'event')
+
         def add(cname):
             retries = 100
             while retries > 0:
                 try:
-                    if isinstance(content, list):
-                        nid = self._put('paths', *path).json()['node']
-                    else:
-                        nid = self._put('paths', *path, cname).json()['node']
-                    if df[cname].dtype == np.dtype('float32'):
-                        tm = 'float'
-                    elif df[cname].dtype == np.dtype('float64'):
-                        tm = 'float'
-                    elif df[cname].dtype == np.dtype('int32'):
-                        tm = 'int'
-                    elif df[cname].dtype == np.dtype('int64'):
-                        tm = 'int'
-                    elif df[cname].dtype == bool:
-                        tm = 'bool'
-                    elif df[cname].dtype == np.dtype('datetime64[ns]'):
-                        tm = 'datetime'
-                    elif df[cname].dtype == np.dtype('timedelta64[ns]'):
-                        tm = 'timedelta'
-                    elif type(df[cname][0]) == date:
-                        tm = 'date'
-                    elif type(df[cname][0]) == time:
-                        tm = 'time'
-                    elif type(df[cname][0]) == Point and df[cname][0].has_z:
-                        tm = 'point3'
-                    elif type(df[cname][0]) == Point:
-                        tm = 'point'
-                    else:
-                        tm = 'text'
-
-                    self._put('nodes', nid, 'types', tm)
-                    #cmap[cname] = nid
-                    #dmap[cname] = []
-                    #tmap[cname] = tm
+                    nid, tm = node(path + (cname,) if nested else path, column_type(df[cname]))
                     return (cname, nid, tm)
                 except Exception as e:
                     retries -= 1
                     sleep(0.5)
             raise Exception("failed to create node/index")
 
-
-        with ThreadPoolExecutor(max_workers=1) as pool:
-            res = pool.map(add, [x for x in df.columns if x not in ['start', 'end']])
-            for cname, nid, tm in res:
-                cmap[cname] = nid
-                dmap[cname] = []
-                tmap[cname] = tm
-
+        for cname, nid, tm in map(add, values):
+            cmap[cname] = nid
+            tmap[cname] = tm
+        self._invalidate(nodes=True)
+        return cmap, tmap
+
+    def _upload(self, frames, cmap, tmap, workers, chunksize, depth, max_bytes, total=None, processes=None, tune=False,
+                journal=None, coalesce=None):
+        """Send the events of a sequence of start-sorted DataFrames to the
+        nodes set up by `_setup`, skipping chunks `journal` has recorded
+        and recording the ones sent."""
+        runs = None if coalesce is None or coalesce is False else Runs(0.0 if coalesce is True else coalesce)
+        tuner = None
+        if tune:
+            tuner = tune if isinstance(tune, Tuner) else Tuner(max_concurrency=workers)
+            if journal is None:
+                # resuming relies on the same rows falling in the same chunks
+                rows = chunksize
+                chunksize = lambda: tuner.rows(rows)
+            workers = tuner.max_concurrency
+
+        def send(key, data):
+            node, vtype, mark = key
+            post_events(self, node, vtype, data, tuner=tuner)
+            if journal is not None:
+                journal.ack(*mark)
+
+        def pending(f, a, chunk):
+            batch = []
+            for k, v in chunk.items():
+                if journal is not None and (f, a, k) in journal.done:
+                    if processes:
+                        v.owner.release()
+                    continue
+                batch.append(((cmap[k], tmap[k], (f, a, k)), v))
+            return batch
 
         origin = self.origin
-        res = []
-        q = Queue()
-        wt = Thread(target=worker, args=(q, workers, len(df) * (len(df.columns) - 1), self._parent.interactive))
-        wt.start()
-
-        for i, row in df.iterrows():
-            if origin is not None:
-                ts = int((dt64(row['start']) - origin) // np.timedelta64(1, 'ns'))
+        try:
+            if not processes:
+                batches = (pending(f, a, chunk)
+                           for f, df in enumerate(frames) for a, chunk in chunks(df, tmap, origin, chunksize, runs))
+                try:
+                    stats = pipeline(batches, send, workers, depth, max_bytes, total, tuner=tuner)
+                finally:
+                    self._invalidate()
             else:
-                ts = int(td64(row['start']) // np.timedelta64(1, 'ns'))
-            try:
-                if 'end' in row and origin is not None:
-                    dur = int((dt64(row['end']) - dt64(row['start'])) // np.timedelta64(1, 'ns'))
-                elif origin is not None:
-                    dur = int((dt64(df['start'].iloc[i+1]) - dt64(row['start'])) // np.timedelta64(1, 'ns'))
-                elif 'end' in row:
-                    dur = int((td64(row['end']) - td64(row['start'])) // np.timedelta64(1, 'ns'))
-                else:
-                    dur = int((td64(df['start'].iloc[i+1]) - td64(row['start'])) // np.timedelta64(1, 'ns'))
-            except IndexError:
-                dur = 1
-
-            if dur <= 0: continue
-            for col, val in dict(row).items():
-                if col == 'start' and 'start' in dmap:
-                    dmap[col].append((ts, dur))
-                elif type(val) == float and math.isnan(val): # skip nans
-                    pass
-                elif val is pd.NaT or val is None:
-                    pass
-                elif col not in tmap:
-                    pass
-                elif tmap[col] == 'point3':
-                    dmap[col].append((ts, dur, (val.x, val.y, val.z)))
-                elif tmap[col] == 'point':
-                    dmap[col].append((ts, dur, (val.x, val.y)))
-                elif tmap[col] == 'date':
-                    dmap[col].append((ts, dur, val.isoformat()))
-                elif tmap[col] == 'time':
-                    dmap[col].append((ts, dur, val.isoformat()))
-                elif tmap[col] == 'datetime':
-                    dmap[col].append((ts, dur, iso8601(val)))
-                elif tmap[col] == 'timedelta':
-                    dmap[col].append((ts, dur, val // np.timedelta64(1, 'ns')))
-                else:
-                    dmap[col].append((ts, dur, val))
-
-            if 'start' in dmap and len(dmap['start']) >= chunksize:
-                q.put([(self, cmap[k], tmap[k], dmap[k]) for k, v in dmap.items()])
-                for k, v in dmap.items():
-                    dmap[k] = []
-            elif len(list(dmap.values())[0]) >= chunksize:
-                q.put([(self, cmap[k], tmap[k], dmap[k]) for k, v in dmap.items()])
-                for k, v in dmap.items():
-                    dmap[k] = []
-
-        if 'start' in dmap and len(dmap['start']) > 0:
-            q.put([(self, cmap[k], tmap[k], dmap[k]) for k, v in dmap.items()])
-            for k, v in dmap.items():
-                dmap[k] = []
-        elif len(list(dmap.values())[0]) > 0:
-            q.put([(self, cmap[k], tmap[k], dmap[k]) for k, v in dmap.items()])
-            for k, v in dmap.items():
-                dmap[k] = []
-        q.put([])
-        wt.join()
-        
-            
-
+                blocks = []
+                batches = (pending(f, a, chunk)
+                           for f, df in enumerate(frames)
+                           for a, chunk in shared_chunks(df, tmap, origin, chunksize, blocks, runs))
+                with ProcessPoolExecutor(processes) as pool:
+                    def encode(chunk):
+                        try:
+                            return pool.submit(encode_shared, chunk).result()
+                        finally:
+                            chunk.owner.release()
+
+                    try:
+                        stats = pipeline(batches, send, workers, depth, max_bytes, total, encode, processes, tuner)
+                    finally:
+                        batches.close()
+                        for block in blocks:
+                            block.close()
+                        self._invalidate()
+            if journal is not None:
+                journal.finish()
+            stats.runs = runs
+            return stats
+        finally:
+            if journal is not None:
+                journal.close()
 
     def __delitem__(self, key):
         if isinstance(key, tuple):
             self._delete('paths', *key)
         else:
             self._delete('paths', key)
+        self._invalidate(nodes=True)
+
+    def _resolve(self, path):
+        """The node of `path`, from the client's `NodeCache` if it is there."""
+        cache = self._parent.node_cache
+        node = None if cache is None else cache.get(self._name, ('path',) + path)
+        if node is None:
+            r = self._get('paths', *path)
+            if r.status_code == 404:
+                raise KeyError("path does not exist")
+            node = r.json()['node']
+            if cache is not None:
+                cache.put(self._name, ('path',) + path, node)
+        return node
+
+    def _node_type(self, node):
+        """The primary type of `node`, from the client's `NodeCache` if it is there."""
+        cache = self._parent.node_cache
+        vtype = None if cache is None else cache.get(self._name, ('type', node))
+        if vtype is None:
+            vtype = first_type(self._get('nodes', node, 'types'))
+            if cache is not None and vtype is not None:
+                cache.put(self._name, ('type', node), vtype)
+        return vtype
+
+    def _invalidate(self, nodes=False):
+        """Drop cached query results that may read from this database, and
+        with `nodes` its cached paths and types, after paths were created
+        or deleted."""
+        caches = [self._parent.cache, self._parent.range_cache, self._parent.disk_cache]
+        if nodes:
+            caches.append(self._parent.node_cache)
+        for cache in caches:
+            if cache is not None:
+                cache.invalidate(self._name)
 
     def __repr__(self):
         return f"Database({self._parent!r}, \"{self._name}\")"
@@ -374,14 +594,30 @@ class Stream(API):
     def __init__(self, parent, *path):
         self._parent = parent
         self._path = path
-        r = self._parent._get('paths', *path)
-        if r.status_code == 404:
-            raise KeyError("path does not exist")
-        else:
-            self._node = r.json()['node']
-        API.__init__(self, parent._credentials, *parent._prefix, "nodes", self._node)
+        self._nid = None
+        API.__init__(self, parent._credentials, *parent._prefix, "nodes")
+
+    @property
+    def _node(self):
+        """The node of the stream's path, looked up when first needed.
+        Raises `KeyError` if the path does not exist."""
+        if self._nid is None:
+            self._nid = self._parent._resolve(self._path)
+        return self._nid
+
+    @property
+    def _prefix(self):
+        return self._base + (self._node,)
+
+    @_prefix.setter
+    def _prefix(self, prefix):
+        self._base = prefix
 
     def __setitem__(self, key, v):
+        if isinstance(key, slice) and not isinstance(key.start, str):
+            # a time range rather than a child path
+            self._parent.replace(self._path, key.start, key.stop, v)
+            return
         if not isinstance(key, tuple):
             key = (key,)
 
@@ -404,28 +640,26 @@ class Stream(API):
         return iter(sorted(data.keys()))
 
     def insert(self, values):
-        vs = []
-        origin = self._parent.origin
-        if origin is not None:
-            for v in values:
-                start = (dt64(v['start']) - origin) // np.timedelta64(1, 'ns')
-                end = (dt64(v['end']) - origin) // np.timedelta64(1, 'ns')
-                if 'value' in v:
-                    vs.append((int(start), int(end - start), v['value']))
-                else:
-                    vs.append((int(start), int(end - start)))
-        else:
-            for v in values:
-                start = td64(v['start']) // np.timedelta64(1, 'ns')
-                end = td64(v['end']) // np.timedelta64(1, 'ns')
-                if 'value' in v:
-                    vs.append((int(start), int(end - start), v['value']))
-                else:
-                    vs.append((int(start), int(end - start)))
+        vs = encode_events(values, self._parent.origin)
         self._post('types', self.type,
                 json=cbor2.dumps(vs), headers={'Content-Type': 'application/cbor'}, raw=True)
+        self._parent._invalidate()
+
+    def writer(self, max_batch=4096, max_latency=0.5, max_pending=None):
+        """Return a `StreamWriter` that buffers appended events and sends
+        them in batches of up to `max_batch` events, at most `max_latency`
+        seconds after they were appended."""
+        vtype = self.type
+        if vtype is None:
+            raise ValueError("stream has no type")
+        db = self._parent
+
+        def send(data):
+            post_events(db, self._node, vtype, data)
 
-    def export(self, start=None, end=None, limit=None, exclude=tuple(), origin=datetime(1970,1,1), when=None):
+        return StreamWriter(send, vtype, db.origin, max_batch, max_latency, max_pending, db._invalidate)
+
+    def export(self, start=None, end=None, limit=None, exclude=tuple(), origin=datetime(1970,1,1), when=None, arrow=False):
         exp = API(self._credentials, "export")
         o = iso8601(self._parent.origin or origin)[:-1] + 'Z'
         co = ["start", "end"]
@@ -442,6 +676,16 @@ class Stream(API):
             params['origin'] = o
 
         r = exp._post(json={'when': when, 'select': co+cols}, params=params)
+        if arrow:
+            names = co + [x for x in list(self) if x not in exclude]
+            rows = r.json()
+            data = [list(c) for c in zip(*rows)] if rows else [[] for n in names]
+            start, end = (np.char.rstrip(np.array(c, dtype=str), 'Z').astype('datetime64[ns]').view(np.int64)
+                          for c in data[:2])
+            table = Columns('event', start, end - start, None, 0).to_arrow().select(co)
+            for n, c in zip(names[2:], data[2:]):
+                table = table.append_column(n, pa.array(c, from_pandas=True))
+            return table
         df = pd.DataFrame( r.json(), columns = co + [x for x in list(self) if x not in exclude])
         df.start = df.start.apply(pd.Timestamp)
         df.end = df.end.apply(pd.Timestamp)
@@ -490,31 +734,13 @@ class Stream(API):
 
     @property
     def type(self):
-        r = self._get('types')
-        if r.status_code == 200:
-            ts = r.json()
-            if not ts:
-                return None
-            else:
-                return ts[0]
-        else:
-            return None
+        return self._parent._node_type(self._node)
 
     @property
     def range(self):
         if self.type is None:
             return None
-        r = self._get('types', self.type, 'range')
-        if r.status_code == 200:
-            e = r.json()
-            if e is None:
-                return None
-            if self._parent.origin is None:
-                return (e['start'], e['end'])
-            else:
-                return (self._parent.origin + np.timedelta64(e['start'], 'ns'), self._parent.origin + np.timedelta64(e['end'], 'ns'))
-        else:
-            return None
+        return node_range(self._get('types', self.type, 'range'), self._parent.origin)
 
     def __repr__(self):
         z = ", ".join(map(repr, self._path))
@@ -542,6 +768,10 @@ class Stream(API):
     def df(self):
         return StreamData(self, self.type, True)
 
+    @property
+    def arrow(self):
+        return StreamData(self, self.type, arrow=True)
+
     @property
     def first(self):
         try:
@@ -669,9 +899,10 @@ class StreamStats(object):
 
     
 class StreamData(API):
-    def __init__(self, parent, index, df=False, resample=None, rolling=None, origin=''):
+    def __init__(self, parent, index, df=False, resample=None, rolling=None, origin='', arrow=False):
         self._parent = parent
         self._df = df
+        self._arrow = arrow
         self._type = index
         self._origin = origin
         self._resample = resample
@@ -680,20 +911,27 @@ class StreamData(API):
 
     def origin(self, o=None):
         if not o:
-            return StreamData(self._parent, self._type, self._df, self._resample, self._rolling, '')
+            return StreamData(self._parent, self._type, self._df, self._resample, self._rolling, '', self._arrow)
         else:
-            return StreamData(self._parent, self._type, self._df, self._resample, self._rolling, 'origin ' + iso8601(o))
+            return StreamData(self._parent, self._type, self._df, self._resample, self._rolling, 'origin ' + iso8601(o), self._arrow)
 
     def resample(self, period, aggregator=None):
         if self._type == 'event':
             aggregator = "count"
-        return StreamData(self._parent, self._type, self._df, (period, aggregator), self._rolling)
+        return StreamData(self._parent, self._type, self._df, (period, aggregator), self._rolling, arrow=self._arrow)
 
     def rolling(self, period):
-        return StreamData(self._parent, self._type, self._df, self._resample, (period, "trailing"))
+        return StreamData(self._parent, self._type, self._df, self._resample, (period, "trailing"), arrow=self._arrow)
 
 
     def __getitem__(self, tr):
+        return self._view()[tr]
+
+    def follow(self, poll=1.0, retention=None, start=None):
+        """Follow this stream's data incrementally, see `View.follow`."""
+        return self._view().follow(poll, retention, start)
+
+    def _view(self):
         if self._rolling:
             r = f'window {self._rolling[0]} {self._rolling[1]}'
         else:
@@ -706,10 +944,12 @@ class StreamData(API):
         else:
             rs = f'{"when " if self._type == "event" else ""}{self._parent!s} {r}'
 
-        if self._df:
-            return self._parent._parent._parent.df(rs + self._origin)[tr]
+        if self._arrow:
+            return self._parent._parent._parent.arrow(rs + self._origin)
+        elif self._df:
+            return self._parent._parent._parent.df(rs + self._origin)
         else:
-            return self._parent._parent._parent(rs + self._origin)[tr]
+            return self._parent._parent._parent(rs + self._origin)
 
 
 
@@ -0,0 +1,159 @@
+"""Buffered appends to a single stream."""
+import numpy as np
+import cbor2
+import threading
+import time
+
+
+def offsets(times, origin):
+    """int64 nanoseconds since `origin` (or virtual nanoseconds when it is
+    `None`) for an array of times."""
+    if origin is None:
+        t = np.asarray(times)
+        return t.astype('timedelta64[ns]').view(np.int64) if t.dtype.kind == 'm' else t.astype(np.int64)
+    return np.asarray(times, 'datetime64[ns]').view(np.int64) - origin
+
+
+class StreamWriter(object):
+    """Coalesces appended events into batches sent from a background thread.
+
+    Events are sent once `max_batch` of them are pending or the oldest has
+    waited `max_latency` seconds, in the order they were appended. Appending
+    blocks while `max_pending` events are waiting to be sent. An error
+    raised while sending is re-raised by the next call to `append`,
+    `extend`, `flush` or `close`. Use as a context manager to flush and
+    stop the thread on exit.
+    """
+    def __init__(self, send, vtype, origin, max_batch=4096, max_latency=0.5, max_pending=None, on_send=None):
+        self._send = send
+        self._on_send = on_send
+        self.type = vtype
+        self._origin = None if origin is None else int(np.datetime64(origin, 'ns').astype(np.int64))
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.max_pending = max_pending or 16 * max_batch
+        self._pending = []
+        self._since = None
+        self._cond = threading.Condition()
+        self._closed = False
+        self._flushing = 0
+        self._error = None
+        self.written = 0
+        self.acknowledged = 0
+        self.batches = 0
+        self.bytes = 0
+        self._started = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def rate(self):
+        """Acknowledged events per second since the first append."""
+        if self._started is None:
+            return 0.0
+        return self.acknowledged / max(time.perf_counter() - self._started, 1e-9)
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+        if self._closed:
+            raise ValueError("writer is closed")
+
+    def _add(self, events):
+        with self._cond:
+            self._check()
+            while len(self._pending) >= self.max_pending and self._error is None:
+                self._cond.wait()
+            self._check()
+            if self._started is None:
+                self._started = time.perf_counter()
+            if not self._pending:
+                self._since = time.monotonic()
+            self._pending.extend(events)
+            self.written += len(events)
+            if len(self._pending) >= self.max_batch:
+                self._cond.notify_all()
+
+    def append(self, start, end, value=None):
+        """Append one event."""
+        s, e = offsets([start, end], self._origin).tolist()
+        self._add([(s, e - s)] if self.type == 'event' else [(s, e - s, value)])
+
+    def extend(self, starts, ends, values=None):
+        """Append arrays of events."""
+        s = offsets(starts, self._origin)
+        d = (offsets(ends, self._origin) - s).tolist()
+        s = s.tolist()
+        if self.type == 'event':
+            self._add(list(zip(s, d)))
+        else:
+            values = values.tolist() if isinstance(values, np.ndarray) else list(values)
+            self._add(list(zip(s, d, values)))
+
+    def _due(self):
+        if not self._pending:
+            return False
+        return (self._closed or self._flushing or len(self._pending) >= self.max_batch
+                or time.monotonic() - self._since >= self.max_latency)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._due() and not (self._closed and not self._pending):
+                    timeout = None if not self._pending else self.max_latency - (time.monotonic() - self._since)
+                    self._cond.wait(timeout)
+                if not self._pending:
+                    return
+                batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+                self._since = time.monotonic()
+                self._cond.notify_all()
+            try:
+                data = cbor2.dumps(batch)
+                self._send(data)
+                if self._on_send is not None:
+                    self._on_send()
+            except Exception as e:
+                with self._cond:
+                    self._error = e
+                    self._pending = []
+                    self._cond.notify_all()
+                return
+            with self._cond:
+                self.acknowledged += len(batch)
+                self.batches += 1
+                self.bytes += len(data)
+                self._cond.notify_all()
+
+    def flush(self):
+        """Send all pending events and wait until they are acknowledged."""
+        with self._cond:
+            self._flushing += 1
+            self._cond.notify_all()
+            try:
+                while self.acknowledged < self.written and self._error is None:
+                    self._cond.wait()
+            finally:
+                self._flushing -= 1
+            if self._error is not None:
+                raise self._error
+
+    def close(self):
+        """Flush pending events and stop the background thread."""
+        if not self._closed:
+            try:
+                self.flush()
+            finally:
+                with self._cond:
+                    self._closed = True
+                    self._cond.notify_all()
+                self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __repr__(self):
+        return "StreamWriter(type={!r}, written={}, acknowledged={}, batches={}, rate={:.0f}/s)".format(
+            self.type, self.written, self.acknowledged, self.batches, self.rate)
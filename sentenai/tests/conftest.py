@@ -11,3 +11,154 @@ def client(request):
     host = request.config.getoption("--host")
     auth = request.config.getoption("--auth")
     return sentenai.Client(auth_key=auth, host=host)
+
+
+class FakeServer(object):
+    """A tiny local stand-in for a Sentenai repository.
+
+    Routes map `(method, path)` to either a `(status, headers, body)` tuple
+    or a callable taking the recorded request and returning one.
+    """
+    def __init__(self):
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        from urllib.parse import urlsplit, parse_qs
+        import threading
+
+        fake = self
+        self.routes = {('GET', '/'): (200, {}, b'')}
+        self.requests = []
+        self.lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _serve(self):
+                u = urlsplit(self.path)
+                n = int(self.headers.get('Content-Length') or 0)
+                wire = self.rfile.read(n) if n else b''
+                body = fake.decode(wire, self.headers.get('Content-Encoding'))
+                req = {
+                    'method': self.command, 'path': u.path,
+                    'query': {k: v[-1] for k, v in parse_qs(u.query).items()},
+                    'headers': dict(self.headers), 'body': body, 'wire': wire,
+                }
+                with fake.lock:
+                    fake.requests.append(req)
+                route = fake.routes.get((self.command, u.path), (404, {}, b''))
+                status, headers, out = route(req) if callable(route) else route
+                if isinstance(out, str):
+                    out = out.encode('utf-8')
+                self.send_response(status)
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.send_header('Content-Length', str(len(out)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(out)
+
+            do_GET = do_PUT = do_POST = do_DELETE = do_PATCH = do_HEAD = _serve
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.host, self.port = self.httpd.server_address
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def decode(body, encoding):
+        """Decompress a request body sent with `Content-Encoding`."""
+        if encoding == 'gzip':
+            import gzip
+            return gzip.decompress(body)
+        elif encoding == 'zstd':
+            import zstandard
+            return zstandard.ZstdDecompressor().decompress(body)
+        return body
+
+    def route(self, method, path, response):
+        self.routes[(method, path)] = response
+
+    def database(self, db, path, columns, origin='1970-01-01T00:00:00Z', existing=()):
+        """Routes for uploading a DataFrame to `db/path`, where `columns` maps
+        each column to its type. The path's node is `path` and each column's
+        node is `path-column`. The path and the columns in `existing` can
+        also be looked up, as if already stored."""
+        json = {'Content-Type': 'application/json'}
+        self.route('GET', f'/db/{db}', (200, json, '{"origin": "%s"}' % origin))
+        self.route('DELETE', f'/db/{db}/paths/{path}', (204, {}, b''))
+        nodes = {path: (path, 'event')}
+        nodes.update({f'{path}/{c}': (f'{path}-{c}', t) for c, t in columns.items()})
+        for p, (node, vtype) in nodes.items():
+            self.route('PUT', f'/db/{db}/paths/{p}', (200, json, '{"node": "%s"}' % node))
+            self.route('PUT', f'/db/{db}/nodes/{node}/types/{vtype}', (204, {}, b''))
+            self.route('POST', f'/db/{db}/nodes/{node}/types/{vtype}', (204, {}, b''))
+            self.route('DELETE', f'/db/{db}/nodes/{node}/types/{vtype}', (204, {}, b''))
+            if existing and (p == path or p.split('/')[-1] in existing):
+                self.route('GET', f'/db/{db}/paths/{p}', (200, json, '{"node": "%s"}' % node))
+                self.route('GET', f'/db/{db}/nodes/{node}/types', (200, json, '["%s"]' % vtype))
+
+    def uploaded(self, db):
+        """The events posted to each node of `db`, in order."""
+        import cbor2
+        out = {}
+        for r in self.requests:
+            if r['method'] == 'POST' and r['path'].startswith(f'/db/{db}/nodes/'):
+                out.setdefault(r['path'].split('/')[4], []).extend(cbor2.loads(r['body']))
+        return out
+
+    @staticmethod
+    def cbor(vtype, events, origin='1970-01-01T00:00:00Z'):
+        """A TSPL query response carrying `events` as CBOR."""
+        import cbor2
+        headers = {'Content-Type': 'application/cbor', 'type': vtype}
+        if origin is not None:
+            headers['origin'] = origin
+        return 200, headers, cbor2.dumps(events)
+
+    @staticmethod
+    def windowed(events, clip=False, vtype='float'):
+        """A /tspl route answering with the (virtual time) events overlapping
+        the requested `[start, end)`, optionally clipped to it."""
+        import cbor2
+
+        def respond(req):
+            q = req['query']
+            lo = int(q.get('start', -2 ** 62))
+            hi = int(q.get('end', 2 ** 62))
+            out = []
+            for e in events:
+                s, d = e[0], e[1]
+                if s < hi and s + d > lo:
+                    if clip:
+                        s2, e2 = max(s, lo), min(s + d, hi)
+                        out.append([s2, e2 - s2] + list(e[2:]))
+                    else:
+                        out.append(list(e))
+            limit = int(q.get('limit', 0))
+            if limit > 0:
+                out = out[:limit]
+            elif limit < 0:
+                out = out[limit:]
+            return 200, {'Content-Type': 'application/cbor', 'type': vtype}, cbor2.dumps(out)
+        return respond
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def server():
+    s = FakeServer()
+    yield s
+    s.close()
+
+
+@pytest.fixture
+def sentenai_client(server):
+    c = sentenai.Sentenai(host=server.host, port=server.port, check=False, interactive=False)
+    yield c
+    c.close()
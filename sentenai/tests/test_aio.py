@@ -0,0 +1,58 @@
+import asyncio
+import cbor2
+import pandas as pd
+import numpy as np
+import pytest
+from sentenai import Sentenai, AsyncSentenai
+
+aiohttp = pytest.importorskip("aiohttp")
+
+ORIGIN = '1970-01-01T00:00:00Z'
+
+
+def tspl_route(events):
+    def respond(req):
+        stmt = req['body'].decode('utf-8')
+        name = 'b' if 'b' in stmt.split(' when ')[0] else 'a'
+        return 200, {'Content-Type': 'application/cbor', 'type': 'float', 'origin': ORIGIN}, cbor2.dumps(events[name])
+    return respond
+
+
+EVENTS = {
+    'a': [[0, 10, 1.0], [10, 10, 2.0]],
+    'b': [[0, 10, 5.0], [10, 10, 6.0]],
+}
+
+
+def test_async_view_matches_sync(server):
+    server.route('POST', '/tspl', tspl_route(EVENTS))
+    sync = Sentenai(host=server.host, port=server.port, check=False)
+    try:
+        expected = sync.df(a='db/a', b='db/b')[0:100]
+    finally:
+        sync.close()
+
+    async def run():
+        async with AsyncSentenai(host=server.host, port=server.port) as client:
+            return await client.df(a='db/a', b='db/b')[0:100]
+
+    result = asyncio.run(run())
+    pd.testing.assert_frame_equal(result, expected)
+    assert list(result['b']) == [5.0, 6.0]
+
+
+def test_async_stream_insert(server):
+    server.route('GET', '/db/foo', (200, {'Content-Type': 'application/json'}, '{"origin": "1970-01-01T00:00:00Z"}'))
+    server.route('GET', '/db/foo/paths/x', (200, {'Content-Type': 'application/json'}, '{"node": "n1"}'))
+    server.route('GET', '/db/foo/nodes/n1/types', (200, {'Content-Type': 'application/json'}, '["float"]'))
+    server.route('POST', '/db/foo/nodes/n1/types/float', (204, {}, b''))
+
+    async def run():
+        async with AsyncSentenai(host=server.host, port=server.port) as client:
+            stream = await (await client['foo'])['x']
+            assert await stream.type == 'float'
+            await stream.insert([{'start': np.datetime64(5, 'ns'), 'end': np.datetime64(7, 'ns'), 'value': 1.5}])
+
+    asyncio.run(run())
+    posted = [r for r in server.requests if r['method'] == 'POST']
+    assert cbor2.loads(posted[0]['body']) == [[5, 2, 1.5]]
@@ -0,0 +1,250 @@
+import numpy as np
+import pytest
+import sentenai
+from sentenai import QueryCache
+from sentenai.columns import Columns
+
+
+def cols(n):
+    return Columns('float', np.arange(n, dtype=np.int64), np.ones(n, np.int64), np.zeros(n), 0)
+
+
+def test_lru_eviction_by_bytes():
+    c = QueryCache(max_bytes=cols(10).nbytes * 2)
+    c.put('a', cols(10), 'db/a')
+    c.put('b', cols(10), 'db/b')
+    assert c.get('a') is not None
+    c.put('c', cols(10), 'db/c')
+    assert c.get('b') is None
+    assert c.get('a') is not None and c.get('c') is not None
+    assert c.evictions == 1
+    assert (c.hits, c.misses) == (3, 1)
+    assert c.bytes <= c.max_bytes
+
+
+def test_put_after_invalidate_is_dropped():
+    c = QueryCache()
+    epoch = c.epoch
+    assert c.get('a') is None
+    c.invalidate('db')
+    c.put('a', cols(10), 'db/a', epoch)
+    assert c.get('a') is None and len(c) == 0
+    c.put('a', cols(10), 'db/a', c.epoch)
+    assert c.get('a') is not None
+
+
+def test_writes_during_a_fetch_are_not_cached_over(server, cached):
+    server.route('GET', '/db/foo/paths/x', (200, {'Content-Type': 'application/json'}, '{"node": "n1"}'))
+    server.route('GET', '/db/foo/nodes/n1/types', (200, {'Content-Type': 'application/json'}, '["float"]'))
+    server.route('POST', '/db/foo/nodes/n1/types/float', (204, {}, b''))
+    db = cached['foo']
+
+    def respond(req):
+        # a write lands while the query is in flight
+        db['x'].insert([{'start': np.datetime64(1, 'ns'), 'end': np.datetime64(2, 'ns'), 'value': 1.0}])
+        return server.cbor('float', [[0, 10, 1.0]])
+
+    server.route('POST', '/tspl', respond)
+    cached.df('foo/x')[0:100]
+    assert len(cached.cache) == 0
+
+
+def test_oversized_results_are_not_cached():
+    c = QueryCache(max_bytes=10)
+    c.put('a', cols(10), 'db/a')
+    assert len(c) == 0
+
+
+@pytest.fixture
+def cached(server):
+    server.route('GET', '/db/foo', (200, {'Content-Type': 'application/json'}, '{"origin": "1970-01-01T00:00:00Z"}'))
+    server.route('POST', '/tspl', server.cbor('float', [[0, 10, 1.0]]))
+    c = sentenai.Sentenai(host=server.host, port=server.port, check=False, interactive=False, cache=QueryCache())
+    yield c
+    c.close()
+
+
+def queries(server):
+    return len([r for r in server.requests if r['path'] == '/tspl'])
+
+
+def test_repeated_slices_hit_cache(server, cached):
+    a = cached.df('foo/x')[0:100]
+    b = cached.df('foo/x')[0:100]
+    assert a.equals(b)
+    assert queries(server) == 1
+    cached.df('foo/x')[0:200]
+    assert queries(server) == 2
+    assert cached.cache.hits == 1
+
+
+def test_writes_invalidate(server, cached):
+    server.route('GET', '/db/foo/paths/x', (200, {'Content-Type': 'application/json'}, '{"node": "n1"}'))
+    server.route('GET', '/db/foo/nodes/n1/types', (200, {'Content-Type': 'application/json'}, '["float"]'))
+    server.route('POST', '/db/foo/nodes/n1/types/float', (204, {}, b''))
+    server.route('DELETE', '/db/foo/paths/y', (204, {}, b''))
+    cached.df('foo/x')[0:100]
+    cached.df('bar/x')[0:100]
+    db = cached['foo']
+    db['x'].insert([{'start': np.datetime64(1, 'ns'), 'end': np.datetime64(2, 'ns'), 'value': 1.0}])
+    assert len(cached.cache) == 1
+    cached.df('foo/x')[0:100]
+    assert queries(server) == 3
+    del db['y']
+    assert len(cached.cache) == 1
+
+
+EVENTS = [[i * 10, 10, float(i)] for i in range(100)]
+# runs of back-to-back events with equal values
+RUNS = [[i * 10, 10, float(i // 3)] for i in range(100)]
+
+
+@pytest.mark.parametrize('events', [EVENTS, RUNS])
+@pytest.mark.parametrize('clip', [False, True])
+def test_range_cache_fetches_only_gaps(server, clip, events):
+    from sentenai import RangeCache
+    server.route('POST', '/tspl', server.windowed(events, clip))
+    plain = sentenai.Sentenai(host=server.host, port=server.port, check=False)
+    c = sentenai.Sentenai(host=server.host, port=server.port, check=False, range_cache=RangeCache())
+    asked = []
+    for lo, hi in [(100, 500), (150, 550), (50, 600), (100, 500), (605, 700)]:
+        expected = plain.df('db/x')[lo:hi]
+        n = len(server.requests)
+        got = c.df('db/x')[lo:hi]
+        if clip:
+            assert list(got['value']) == list(expected['value'])
+        else:
+            assert got.equals(expected)
+        asked.append([(r['query']['start'], r['query']['end']) for r in server.requests[n:]
+                      if int(r['query']['end']) - int(r['query']['start']) > 2])
+    assert asked == [[('100', '500')], [('500', '550')], [('50', '100'), ('550', '600')], [], [('605', '700')]]
+    assert (c.range_cache.hits, c.range_cache.partial, c.range_cache.misses) == (1, 2, 2)
+
+
+@pytest.mark.parametrize('clip', [False, True])
+def test_range_cache_keeps_adjacent_equal_events(server, clip):
+    from sentenai import RangeCache
+    server.route('POST', '/tspl', server.windowed([[0, 10, 1.0], [10, 10, 1.0], [20, 10, 2.0], [30, 20, 2.0]], clip))
+    c = sentenai.Sentenai(host=server.host, port=server.port, check=False, range_cache=RangeCache())
+    c.df('db/x')[0:10]
+    c.df('db/x')[10:40]
+    got = c.df('db/x')[0:40]
+    assert list(got['value']) == [1.0, 1.0, 2.0, 2.0]
+    # the event clipped at 40 is whole when the range is extended
+    assert list(c.df('db/x')[0:50]['duration'].astype('int64')) == [10, 10, 10, 20]
+
+
+def test_range_cache_empty_and_reversed_slices(server):
+    from sentenai import RangeCache
+    server.route('POST', '/tspl', server.windowed(EVENTS))
+    c = sentenai.Sentenai(host=server.host, port=server.port, check=False, range_cache=RangeCache())
+    for lo, hi in [(200, 200), (300, 200)]:
+        assert len(c.df('db/x')[lo:hi]) == 0
+    c.df('db/x')[100:500]
+    n = len(server.requests)
+    for lo, hi in [(200, 200), (300, 200)]:
+        got = c.df('db/x')[lo:hi]
+        assert len(got) == 0 and list(got.columns) == ['start', 'end', 'duration', 'value']
+    assert len(server.requests) == n
+
+
+def test_disk_cache_persists_historical_slices(server, tmp_path):
+    from sentenai import DiskCache
+    server.route('POST', '/tspl', server.cbor('text', [[0, 10, 'a'], [10, 10, 'bc']]))
+    old, new = np.datetime64('2020-01-01'), np.datetime64('now') + np.timedelta64(1, 'D')
+    for run in range(2):
+        c = sentenai.Sentenai(host=server.host, port=server.port, check=False, disk_cache=DiskCache(tmp_path))
+        got = c.df('db/x')[np.datetime64('2019-01-01'):old]
+        assert list(got['value']) == ['a', 'bc']
+        assert list(got['duration']) == [np.timedelta64(10, 'ns')] * 2
+        c.df('db/x')[old:new]
+        c.close()
+    assert queries(server) == 3
+    assert (c.disk_cache.hits, c.disk_cache.misses) == (1, 0)
+    c.disk_cache.invalidate('db')
+    assert [d.name for d in tmp_path.iterdir()] == ['.index']
+
+
+def test_disk_cache_invalidates_through_its_index(tmp_path, monkeypatch):
+    import shutil
+    import sentenai.cache
+    from sentenai import DiskCache
+    c = DiskCache(tmp_path)
+    c.put('a', cols(10), 'foo/x')
+    c.put('b', cols(10), 'bar/x')
+    c.put('c', cols(10), 'join(foo/x, bar/y)')
+    # no entry's metadata is read
+    with monkeypatch.context() as m:
+        m.setattr(sentenai.cache.JSON, 'loads', None)
+        c.invalidate('foo')
+    assert sorted(d.name for d in c._entries()) == ['b']
+    # an entry that can't be removed is no longer served
+    with monkeypatch.context() as m:
+        m.setattr(shutil, 'rmtree', lambda *args, **kwargs: None)
+        c.invalidate('bar')
+    assert (tmp_path / 'b').exists() and c.get('b') is None
+    c.put('b', cols(10), 'bar/x')
+    assert c.get('b') is not None
+    # a cache written without an index is indexed when opened
+    shutil.rmtree(tmp_path / '.index')
+    DiskCache(tmp_path).invalidate('bar')
+    assert c.get('b') is None
+
+
+def test_disk_cache_counts_concurrent_lookups(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+    from sentenai import DiskCache
+    c = DiskCache(tmp_path)
+    c.put('a', cols(10), 'db/a')
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        found = list(pool.map(lambda i: c.get('a' if i % 2 else 'b') is not None, range(400)))
+    assert sum(found) == 200
+    assert (c.hits, c.misses) == (200, 200)
+
+
+def test_node_cache_expires():
+    import time
+    from sentenai.cache import NodeCache
+    c = NodeCache(ttl=0.05)
+    c.put('foo', ('path', 'x'), 'n1')
+    c.put('bar', ('path', 'x'), 'n2')
+    assert c.get('foo', ('path', 'x')) == 'n1'
+    c.invalidate('foo')
+    assert c.get('foo', ('path', 'x')) is None and c.get('bar', ('path', 'x')) == 'n2'
+    time.sleep(0.06)
+    assert c.get('bar', ('path', 'x')) is None
+    assert (c.hits, c.misses, len(c)) == (2, 2, 0)
+
+
+def test_stream_handles_resolve_lazily(server):
+    json = {'Content-Type': 'application/json'}
+    server.route('GET', '/db/foo', (200, json, '{"origin": "1970-01-01T00:00:00Z"}'))
+    server.route('GET', '/db/foo/paths/x', (200, json, '{"node": "n1"}'))
+    server.route('GET', '/db/foo/paths/x/a', (200, json, '{"node": "n2"}'))
+    server.route('GET', '/db/foo/nodes/n1/types', (200, json, '["float"]'))
+    server.route('POST', '/db/foo/nodes/n1/types/float', (204, {}, b''))
+    server.route('DELETE', '/db/foo/paths/x', (204, {}, b''))
+    c = sentenai.Sentenai(host=server.host, port=server.port, check=False, interactive=False)
+
+    def lookups():
+        return [r['path'] for r in server.requests if r['path'] not in ('/', '/db/foo')]
+
+    db = c['foo']
+    s = db['x']
+    missing = db['y']
+    assert lookups() == []
+    assert s.type == 'float' and s.type == 'float' and db['x'].type == 'float'
+    assert s['a']._node == 'n2'
+    assert lookups() == ['/db/foo/paths/x', '/db/foo/nodes/n1/types', '/db/foo/paths/x/a']
+    # writing events keeps the paths and types
+    s.insert([{'start': np.datetime64(1, 'ns'), 'end': np.datetime64(2, 'ns'), 'value': 1.0}])
+    with db['x'].writer() as w:
+        w.append(np.datetime64(2, 'ns'), np.datetime64(3, 'ns'), 2.0)
+    assert db['x'].type == 'float' and db['x']['a']._node == 'n2'
+    assert lookups()[3:] == ['/db/foo/nodes/n1/types/float'] * 2
+    del db['x']
+    assert db['x'].type == 'float'
+    assert lookups()[-2:] == ['/db/foo/paths/x', '/db/foo/nodes/n1/types']
+    with pytest.raises(KeyError):
+        missing.type
+    c.close()
@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+from sentenai.columns import Columns
+
+ORIGIN = int(np.datetime64('2020-01-01T00:00:00', 'ns').astype(np.int64))
+
+
+def test_from_cbor_to_df():
+    c = Columns.from_cbor('float', [[0, 10, 1.5], [10, 5, 2.5]], ORIGIN)
+    df = c.to_df('temp')
+    assert list(df.columns) == ['start', 'end', 'duration', 'temp']
+    assert df['start'][1] == np.datetime64('2020-01-01T00:00:00.000000010')
+    assert df['end'][1] == np.datetime64('2020-01-01T00:00:00.000000015')
+    assert df['duration'][1] == pd.Timedelta(5, 'ns')
+    assert df['temp'].dtype == np.float64
+
+
+def test_virtual_time_records():
+    c = Columns.from_cbor('int', [[3, 2, 7]])
+    assert c.to_records() == [{'start': np.timedelta64(3, 'ns'), 'end': np.timedelta64(5, 'ns'), 'value': 7}]
+
+
+def test_event_columns():
+    df = Columns.from_cbor('event', [[0, 1], [5, 1]], ORIGIN).to_df()
+    assert list(df.columns) == ['start', 'end', 'duration']
+    assert len(df) == 2
+
+
+def test_missing_values_fall_back_to_objects():
+    c = Columns.from_cbor('float', [[0, 1, None], [1, 1, 2.0]], ORIGIN)
+    assert c.value.dtype == object
+    assert c.to_records()[1]['value'] == 2.0
+
+
+def test_from_json():
+    c = Columns.from_json('int', [{'start': '2020-01-01T00:00:00Z', 'end': '2020-01-01T00:00:01Z', 'value': '4'}])
+    assert c.duration[0] == 10 ** 9
+    assert c.value[0] == 4
+    assert c.starts[0] == np.datetime64('2020-01-01T00:00:00')
+
+
+def merged(named, limit=None):
+    """The pairwise pd.merge alignment `align` replaces."""
+    r = named[0][1].to_df(named[0][0])
+    for name, c in named[1:]:
+        r = pd.merge(r, c.to_df(name).drop(columns=['end', 'duration']), how='outer', on='start')
+    return r if not limit else r.iloc[:limit].reset_index(drop=True)
+
+
+def test_align_matches_pairwise_merge():
+    from sentenai.columns import frame, align
+    named = [
+        ('a', Columns.from_cbor('float', [[0, 10, 1.0], [20, 10, 2.0], [40, 5, 3.0]], ORIGIN)),
+        ('b', Columns.from_cbor('int', [[10, 10, 7], [20, 10, 8]], ORIGIN)),
+        ('c', Columns.from_cbor('text', [[0, 50, 'x']], ORIGIN)),
+        ('d', Columns.from_cbor('event', [[45, 1]], ORIGIN)),
+    ]
+    pd.testing.assert_frame_equal(frame(align(named)), merged(named), check_dtype=False)
+    pd.testing.assert_frame_equal(frame(align(named, 3)), merged(named, 3), check_dtype=False)
+    assert list(align(named, -2)['start'].astype('int64') - ORIGIN) == [40, 45]
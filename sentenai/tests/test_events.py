@@ -128,3 +128,80 @@ def test_events_range_full(client, evts_stream):
     assert len(x) == 20
     for i, e in zip(range(25), x):
         assert i == x[i].data['i']
+
+
+@pytest.mark.parametrize('fmt', ['ndjson', 'cbor'])
+def test_insert_many_sends_batches(server, sentenai_client, fmt):
+    import cbor2, json
+    server.route('GET', '/db/foo', (200, {'Content-Type': 'application/json'}, '{"origin": "1970-01-01T00:00:00Z"}'))
+
+    def bulk(req):
+        if fmt == 'cbor':
+            records = cbor2.loads(req['body'])
+        else:
+            records = [json.loads(line) for line in req['body'].decode('utf-8').splitlines()]
+        ids = [r.get('id', f"new-{r['event']['n']}") for r in records]
+        return 201, {'Content-Type': 'application/json'}, json.dumps(ids)
+
+    server.route('POST', '/db/foo/events', bulk)
+    from sentenai.stream.events import Updates
+    events = (Event(id='given' if n == 0 else None, ts=datetime(2020, 1, 1, 0, 0, n), data={'n': n}) for n in range(5))
+    ids = Updates(sentenai_client['foo']).insert_many(events, batch=2, format=fmt)
+    assert ids == ['given', 'new-1', 'new-2', 'new-3', 'new-4']
+    posts = [r for r in server.requests if r['method'] == 'POST']
+    assert len(posts) == 3
+    assert posts[0]['headers']['Content-Type'] == ('application/cbor' if fmt == 'cbor' else 'application/x-ndjson')
+
+
+def test_insert_many_requires_assigned_ids(server, sentenai_client):
+    from sentenai.api import SentenaiError
+    from sentenai.stream.events import Updates
+    server.route('GET', '/db/foo', (200, {'Content-Type': 'application/json'}, '{"origin": "1970-01-01T00:00:00Z"}'))
+    server.route('POST', '/db/foo/events', (204, {}, b''))
+    updates = Updates(sentenai_client['foo'])
+    given = [Event(id=f'e{n}', ts=datetime(2020, 1, 1, 0, 0, n), data={'n': n}) for n in range(3)]
+    assert updates.insert_many(given, batch=2) == ['e0', 'e1', 'e2']
+    with pytest.raises(SentenaiError):
+        updates.insert_many(given + [Event(ts=datetime(2020, 1, 1, 0, 0, 3), data={'n': 3})], batch=2)
+    assert len([r for r in server.requests if r['method'] == 'POST']) == 4
+
+
+def test_get_and_delete_many(server, sentenai_client):
+    json = {'Content-Type': 'application/json'}
+    server.route('GET', '/db/foo', (200, json, '{"origin": "1970-01-01T00:00:00Z"}'))
+    for i in range(4):
+        server.route('GET', f'/db/foo/events/e{i}', (200, dict(json, timestamp=str(i)), '{"n": %d}' % i))
+        server.route('DELETE', f'/db/foo/events/e{i}', (204, {}, b''))
+    from sentenai.stream.events import Updates
+    updates = Updates(sentenai_client['foo'])
+    got = updates.get_many(['e0', 'missing', 'e3'])
+    assert got == [Event(id='e0', ts=0, data={'n': 0}), None, Event(id='e3', ts=3, data={'n': 3})]
+    assert updates.delete_many([f'e{i}' for i in range(4)] + ['missing']) == ['missing']
+    assert len([r for r in server.requests if r['method'] == 'DELETE']) == 5
+
+
+def test_scan_pages_with_a_cursor(server, sentenai_client):
+    import json
+    import numpy as np
+    from sentenai.stream.events import Updates, Record
+    server.route('GET', '/db/foo', (200, {'Content-Type': 'application/json'}, '{"origin": "1970-01-01T00:00:00Z"}'))
+    ts = ['2020-01-01T00:00:0%dZ' % s for s in (0, 1, 1, 1, 2, 3, 4)]
+    log = [{'id': f'e{i}', 'ts': t, 'event': {'i': i}} for i, t in enumerate(ts)]
+
+    def listing(req):
+        q = req['query']
+        page = [e for e in log if e['ts'] >= q.get('start', '')][:int(q['limit'])]
+        return 200, {'Content-Type': 'application/json'}, json.dumps(page)
+
+    server.route('GET', '/db/foo/events', listing)
+    updates = Updates(sentenai_client['foo'])
+    assert [e.data['i'] for e in updates.scan(page=2)] == list(range(7))
+    # three events share a timestamp, so one page is re-requested with a larger limit
+    assert [int(r['query']['limit']) for r in server.requests if r['path'] == '/db/foo/events'] == [2, 2, 2, 4, 2, 2, 2]
+
+    records = list(updates.scan(start=np.datetime64('2020-01-01T00:00:02'), page=10, form='records'))
+    assert records == [Record(f'e{i}', ts[i], None, {'i': i}) for i in (4, 5, 6)]
+    batches = list(updates.scan(page=4, form='columns'))
+    assert [len(b['id']) for b in batches] == [4, 1, 2]
+    assert batches[1]['ts'][0] == np.datetime64('2020-01-01T00:00:02', 'ns')
+    assert np.isnan(batches[0]['duration']).all()
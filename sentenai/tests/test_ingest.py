@@ -0,0 +1,295 @@
+import numpy as np
+import pytest
+import pandas as pd
+from sentenai.stream.ingest import chunks
+
+
+def test_chunks_skip_missing_values_and_empty_events():
+    df = pd.DataFrame({
+        'start': np.array([0, 10, 10, 30], 'datetime64[ns]'),
+        'a': [1.0, np.nan, 2.0, 3.0],
+        'b': ['x', 'y', None, 'z'],
+    })
+    tmap = {'start': 'event', 'a': 'float', 'b': 'text'}
+    out = [c for a, c in chunks(df, tmap, np.datetime64(0, 'ns'), 2)]
+    # the second row lasts 0ns and is dropped; the last one lasts 1ns
+    assert out == [
+        {'start': [(0, 10)], 'a': [(0, 10, 1.0)], 'b': [(0, 10, 'x')]},
+        {'start': [(10, 20), (30, 1)], 'a': [(10, 20, 2.0), (30, 1, 3.0)], 'b': [(30, 1, 'z')]},
+    ]
+
+
+def test_chunks_convert_types_by_column():
+    df = pd.DataFrame({
+        'start': pd.to_datetime(['2020-01-01T00:00:00Z', '2020-01-01T00:00:01Z']),
+        'end': pd.to_datetime(['2020-01-01T00:00:01Z', '2020-01-01T00:00:03Z']),
+        'when': np.array(['2021-01-01', 'NaT'], 'datetime64[ns]'),
+        'took': pd.to_timedelta([1, 2], 's'),
+    })
+    origin = np.datetime64('2020-01-01')
+    (a, out), = chunks(df, {'when': 'datetime', 'took': 'timedelta'}, origin, 10)
+    assert out == {
+        'when': [(0, 10 ** 9, '2021-01-01T00:00:00.000000000Z')],
+        'took': [(0, 10 ** 9, 10 ** 9), (10 ** 9, 2 * 10 ** 9, 2 * 10 ** 9)],
+    }
+
+
+def test_setitem_uploads_columns(server, sentenai_client):
+    server.database('foo', 'x', {'a': 'float', 'b': 'text'})
+    df = pd.DataFrame({
+        'start': np.array([20, 0, 10], 'datetime64[ns]'),
+        'a': [3.0, 1.0, np.nan],
+        'b': ['z', 'x', 'y'],
+    })
+    sentenai_client['foo']['x':4:2] = df
+    # chunks of one stream may be sent concurrently
+    assert {k: sorted(v) for k, v in server.uploaded('foo').items()} == {
+        'x': [[0, 10], [10, 10], [20, 1]],
+        'x-a': [[0, 10, 1.0], [20, 1, 3.0]],
+        'x-b': [[0, 10, 'x'], [10, 10, 'y'], [20, 1, 'z']],
+    }
+
+
+def test_setitem_uploads_arrow_tables(server, sentenai_client):
+    pa = pytest.importorskip('pyarrow')
+    server.database('foo', 'x', {'a': 'float', 'b': 'text'})
+    t = pa.table({
+        'start': pa.array([20, 0, 10], pa.timestamp('ns', tz='Europe/Paris')),
+        'a': pa.array([3.0, 1.0, None]),
+        'b': ['z', 'x', 'y'],
+    })
+    sentenai_client['foo']['x'] = t
+    assert {k: sorted(v) for k, v in server.uploaded('foo').items()} == {
+        'x': [[0, 10], [10, 10], [20, 1]],
+        'x-a': [[0, 10, 1.0], [20, 1, 3.0]],
+        'x-b': [[0, 10, 'x'], [10, 10, 'y'], [20, 1, 'z']],
+    }
+
+
+def test_pipeline_blocks_producer_within_byte_budget():
+    import threading
+    import time
+    from sentenai.stream.ingest import pipeline
+    held, peak, lock = [0], [0], threading.Lock()
+    produced = []
+
+    def send(key, data):
+        with lock:
+            held[0] += len(data)
+            peak[0] = max(peak[0], held[0])
+        time.sleep(0.002)
+        with lock:
+            held[0] -= len(data)
+
+    def batches():
+        for i in range(50):
+            produced.append(i)
+            yield [('a', [(j, 1, 1.0) for j in range(100)])]
+
+    stats = pipeline(batches(), send, workers=2, depth=2, max_bytes=2000)
+    assert stats.send.items == 50 and stats.send.events == 5000
+    assert stats.convert.max_depth <= 2
+    # a single chunk is ~1kB: the budget allows two to be buffered or in flight
+    assert peak[0] <= 2000 + 2 * stats.send.bytes // 50
+
+
+def test_pipeline_reraises_send_errors():
+    from sentenai.stream.ingest import pipeline
+
+    def send(key, data):
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        pipeline(([('a', [(i, 1)])] for i in range(1000)), send, workers=4, depth=2)
+
+
+def test_ingest_returns_stats(server, sentenai_client):
+    server.database('foo', 'x', {'a': 'float'})
+    df = pd.DataFrame({'start': np.arange(10).astype('datetime64[ns]'), 'a': np.arange(10.0)})
+    stats = sentenai_client['foo'].ingest('x', df, chunksize=4)
+    assert (stats.convert.events, stats.encode.events, stats.send.events) == (20, 20, 20)
+    assert stats.send.items == 6
+    assert len(server.uploaded('foo')['x-a']) == 10
+
+
+@pytest.mark.parametrize('fmt', ['parquet', 'arrow', 'csv'])
+def test_load_streams_file_batches(server, sentenai_client, tmp_path, fmt):
+    pa = pytest.importorskip('pyarrow')
+    server.database('foo', 'x', {'a': 'float'})
+    df = pd.DataFrame({'start': np.arange(0, 100, 10).astype('datetime64[ns]'), 'a': np.arange(10.0)})
+    source = tmp_path / f'x.{fmt}'
+    if fmt == 'parquet':
+        df.to_parquet(source)
+    elif fmt == 'arrow':
+        import pyarrow.feather
+        pyarrow.feather.write_feather(df, source, chunksize=4)
+    else:
+        df.to_csv(source, index=False)
+    stats = sentenai_client['foo'].load('x', source, batch_rows=3)
+    assert stats.send.events == 20
+    # durations reach across batch boundaries; the last event lasts 1ns
+    assert sorted(server.uploaded('foo')['x-a']) == [[i * 10, 10 if i < 9 else 1, float(i)] for i in range(10)]
+
+
+def test_ingest_with_processes(server, sentenai_client):
+    server.database('foo', 'x', {'a': 'float', 'b': 'text'})
+    df = pd.DataFrame({
+        'start': np.arange(0, 100, 10).astype('datetime64[ns]'),
+        'a': np.where(np.arange(10) % 3, np.arange(10.0), np.nan),
+        'b': [f'v{i}' for i in range(10)],
+    })
+    stats = sentenai_client['foo'].ingest('x', df, chunksize=4, processes=2)
+    up = {k: sorted(v) for k, v in server.uploaded('foo').items()}
+    dur = [10] * 9 + [1]
+    assert up['x'] == [[i * 10, dur[i]] for i in range(10)]
+    assert up['x-a'] == [[i * 10, dur[i], float(i)] for i in range(10) if i % 3]
+    assert up['x-b'] == [[i * 10, dur[i], f'v{i}'] for i in range(10)]
+    assert stats.encode.events == 10 + 6 + 10
+
+
+def test_tuner_increases_additively_and_halves_on_errors():
+    from sentenai.stream.ingest import Tuner
+    now = [0.0]
+    t = Tuner(concurrency=4, chunk_bytes=100, min_chunk_bytes=10, chunk_step=10, window=1.0, clock=lambda: now[0])
+    for _ in range(3):
+        t.success(10, 1000)
+        now[0] += 1.0
+        t.success(10, 1000)
+    assert t.concurrency == 7 and t.chunk_bytes == 130
+    assert t.rows(4096) == 1
+    t.failure()
+    t.failure()
+    assert t.concurrency == 3 and t.chunk_bytes == 65 and t.errors == 2
+
+
+def test_ingest_tuned_retries_server_errors(server, sentenai_client):
+    server.database('foo', 'x', {'a': 'float'})
+    calls = []
+
+    def flaky(req):
+        calls.append(req)
+        return (503, {}, b'') if len(calls) <= 2 else (204, {}, b'')
+
+    server.route('POST', '/db/foo/nodes/x-a/types/float', flaky)
+    df = pd.DataFrame({'start': np.arange(10).astype('datetime64[ns]'), 'a': np.arange(10.0)})
+    stats = sentenai_client['foo'].ingest('x', df, chunksize=5, workers=8, tune=True)
+    assert stats.tuner.errors == 2 and stats.tuner.max_concurrency == 8
+    # both errors fall within one window, so concurrency is halved once
+    assert stats.tuner.concurrency == 2
+    assert sorted(r['body'] for r in calls[2:]) == sorted(set(r['body'] for r in calls))
+
+
+def test_ingest_resumes_from_journal(server, sentenai_client, tmp_path):
+    server.database('foo', 'x', {'a': 'float'})
+    calls = []
+
+    def failing(req):
+        calls.append(req)
+        return (400, {'Content-Type': 'application/json'}, b'{}') if len(calls) == 2 else (204, {}, b'')
+
+    server.route('POST', '/db/foo/nodes/x-a/types/float', failing)
+    df = pd.DataFrame({'start': np.arange(10).astype('datetime64[ns]'), 'a': np.arange(10.0)})
+    journal = tmp_path / 'x.journal'
+    with pytest.raises(Exception):
+        sentenai_client['foo'].ingest('x', df, chunksize=4, workers=1, journal=journal)
+
+    first = len(server.requests)
+    sentenai_client['foo'].ingest('x', df, chunksize=4, workers=1, journal=journal)
+    assert not [r for r in server.requests[first:] if r['method'] in ('DELETE', 'PUT')]
+    # only the chunks that were not acknowledged are sent again
+    server.requests.remove(calls[1])
+    up = server.uploaded('foo')
+    assert sorted(up['x']) == [[i, 1] for i in range(10)]
+    assert sorted(up['x-a']) == [[i, 1, float(i)] for i in range(10)]
+
+    server.requests.clear()
+    sentenai_client['foo'].ingest('x', df, chunksize=4, journal=journal)
+    assert not server.uploaded('foo')
+    with pytest.raises(ValueError):
+        sentenai_client['foo'].ingest('x', df.iloc[:5], journal=journal)
+
+
+def test_append_keeps_existing_columns(server, sentenai_client):
+    server.database('foo', 'x', {'a': 'float', 'b': 'int'}, existing=['a'])
+    df = pd.DataFrame({'start': np.arange(3).astype('datetime64[ns]'), 'a': [1.0, 2.0, 3.0], 'b': [4, 5, 6]})
+    sentenai_client['foo'].append('x', df)
+    written = [(r['method'], r['path']) for r in server.requests if r['method'] in ('PUT', 'DELETE')]
+    # only the new column is created; nothing is deleted
+    assert written == [('PUT', '/db/foo/paths/x/b'), ('PUT', '/db/foo/nodes/x-b/types/int')]
+    assert {k: len(v) for k, v in server.uploaded('foo').items()} == {'x': 3, 'x-a': 3, 'x-b': 3}
+
+
+def test_setitem_time_range_replaces_range(server, sentenai_client):
+    server.database('foo', 'x', {'a': 'float'}, existing=['a'])
+    df = pd.DataFrame({'start': np.arange(10, 13).astype('datetime64[ns]'), 'a': [1.0, 2.0, 3.0]})
+    t0, t1 = np.datetime64(10, 'ns'), np.datetime64(20, 'ns')
+    s = sentenai_client['foo']['x']
+    s[t0:t1] = df
+    deleted = {r['path']: r['query'] for r in server.requests if r['method'] == 'DELETE'}
+    bounds = {'start': '1970-01-01T00:00:00.000000010Z', 'end': '1970-01-01T00:00:00.000000020Z'}
+    assert deleted == {'/db/foo/nodes/x/types/event': bounds, '/db/foo/nodes/x-a/types/float': bounds}
+    assert sorted(server.uploaded('foo')['x-a']) == [[10, 1, 1.0], [11, 1, 2.0], [12, 1, 3.0]]
+    with pytest.raises(ValueError):
+        s[t0:np.datetime64(12, 'ns')] = df
+
+
+def test_coalesce_merges_runs_of_equal_values():
+    from sentenai.stream.ingest import coalesce
+    ts = np.arange(0, 80, 10)
+    dur = np.full(8, 10)
+    dur[4] = 5  # a gap after the fifth event
+    values = np.array([1.0, 1.0, 1.05, 1.2, 1.2, 1.2, 2.0, 2.0])
+    mask = np.ones(8, bool)
+    mask[7] = False
+    m, d = coalesce(ts, dur, values, mask)
+    assert ts[m].tolist() == [0, 20, 30, 50, 60] and d[m].tolist() == [20, 10, 15, 10, 10]
+    m, d = coalesce(ts, dur, values, mask, 0.1)
+    # within tolerance of the run's first value, not just of the previous one
+    assert ts[m].tolist() == [0, 30, 50, 60] and d[m].tolist() == [30, 15, 10, 10]
+
+
+def test_ingest_coalesce_reports_ratio(server, sentenai_client):
+    server.database('foo', 'x', {'a': 'bool', 'b': 'text'})
+    df = pd.DataFrame({
+        'start': np.arange(0, 100, 10).astype('datetime64[ns]'),
+        'a': [True] * 6 + [False] * 4,
+        'b': ['on'] * 10,
+    })
+    stats = sentenai_client['foo'].ingest('x', df, chunksize=4, coalesce=True)
+    up = {k: sorted(v) for k, v in server.uploaded('foo').items()}
+    assert up['x-a'] == [[0, 60, True], [60, 31, False]]
+    # a run spanning chunks is sent with the chunk holding its first row
+    assert up['x-b'] == [[0, 91, 'on']]
+    assert len(up['x']) == 10
+    assert (stats.runs.values, stats.runs.events, stats.runs.ratio) == (20, 3, 20 / 3)
+
+
+def test_coalesce_point_columns(server, sentenai_client):
+    from shapely.geometry import Point
+    from sentenai.stream.ingest import coalesce
+    ts, dur = np.arange(0, 40, 10), np.full(4, 10)
+    xy = np.array([[1.0, 2.0], [1.0, 2.0], [1.0, 2.05], [3.0, 2.0]])
+    m, d = coalesce(ts, dur, xy, np.ones(4, bool))
+    assert ts[m].tolist() == [0, 20, 30] and d[m].tolist() == [20, 10, 10]
+    m, d = coalesce(ts, dur, xy, np.ones(4, bool), 0.1)
+    assert ts[m].tolist() == [0, 30] and d[m].tolist() == [30, 10]
+
+    server.database('foo', 'x', {'p': 'point'})
+    df = pd.DataFrame({'start': np.arange(0, 40, 10).astype('datetime64[ns]'),
+                       'p': [Point(1, 2), Point(1, 2), Point(1, 2), Point(3, 4)]})
+    stats = sentenai_client['foo'].ingest('x', df, coalesce=True)
+    assert sorted(server.uploaded('foo')['x-p']) == [[0, 30, [1.0, 2.0]], [30, 1, [3.0, 4.0]]]
+    assert (stats.runs.values, stats.runs.events) == (4, 2)
+
+
+def test_append_and_replace_coalesce(server, sentenai_client):
+    server.database('foo', 'x', {'a': 'float'}, existing=['a'])
+    df = pd.DataFrame({'start': np.arange(10, 14).astype('datetime64[ns]'), 'a': [1.0, 1.0, 1.0, 2.0]})
+    db = sentenai_client['foo']
+    stats = db.append('x', df, coalesce=True)
+    assert sorted(server.uploaded('foo')['x-a']) == [[10, 3, 1.0], [13, 1, 2.0]]
+    assert stats.runs.ratio == 2.0
+    server.requests.clear()
+    stats = db.replace('x', np.datetime64(10, 'ns'), np.datetime64(20, 'ns'), df, coalesce=True)
+    assert sorted(server.uploaded('foo')['x-a']) == [[10, 3, 1.0], [13, 1, 2.0]]
+    assert stats.runs.ratio == 2.0
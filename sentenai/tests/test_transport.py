@@ -0,0 +1,134 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from sentenai.api import API, Credentials, Transport
+
+
+def test_credentials_key_transport():
+    a = API(Credentials("http://localhost:7280", None))
+    b = API(Credentials("http://localhost:7280", None), "db", "foo")
+    c = API(Credentials("http://localhost:7281", None))
+    assert a._session is b._session
+    assert a._session is not c._session
+
+
+def test_derived_handles_share_pool(server, sentenai_client):
+    server.route('GET', '/db/foo', (200, {'Content-Type': 'application/json'}, '{"origin": null}'))
+    db = sentenai_client['foo']
+    assert db._transport is sentenai_client._transport
+    for i in range(5):
+        sentenai_client.ping()
+    stats = sentenai_client.pool
+    assert stats.opened == 1
+    assert stats.reused == 5
+
+
+def test_close_releases_only_this_client(server):
+    from sentenai import Sentenai
+    a = Sentenai(host=server.host, port=server.port, check=False)
+    b = Sentenai(host=server.host, port=server.port, check=False)
+    t = a._transport
+    assert b._transport is t and t.clients == 2
+    a.close()
+    a.close()
+    assert Transport.for_credentials(b._credentials) is t and t.clients == 1
+    b.ping()
+    assert t.stats.opened == 1
+    b.close()
+    c = Sentenai(host=server.host, port=server.port, check=False)
+    try:
+        assert c._transport is not t and c._transport.clients == 1
+    finally:
+        c.close()
+
+
+def test_pool_waits_for_free_slot(server):
+    import time
+
+    def slow(req):
+        time.sleep(0.01)
+        return 200, {}, b''
+
+    server.route('GET', '/', slow)
+    t = Transport(Credentials(f"http://{server.host}:{server.port}", None), maxsize=2)
+    api = API(t.credentials)
+    api._transport, api._session = t, t.session
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        rs = list(pool.map(lambda _: api._get().status_code, range(32)))
+    assert rs == [200] * 32
+    assert t.stats.opened <= 2
+    assert t.stats.opened + t.stats.reused == 32
+    assert t.stats.waits > 0
+    t.close()
+
+
+def test_compressed_uploads(server):
+    import cbor2
+    from sentenai import Sentenai, Compression
+    server.route('GET', '/db/foo', (200, {'Content-Type': 'application/json'}, '{"origin": "1970-01-01T00:00:00Z"}'))
+    server.route('GET', '/db/foo/paths/x', (200, {'Content-Type': 'application/json'}, '{"node": "n1"}'))
+    server.route('GET', '/db/foo/nodes/n1/types', (200, {'Content-Type': 'application/json'}, '["float"]'))
+    server.route('POST', '/db/foo/nodes/n1/types/float', (204, {}, b''))
+    c = Sentenai(host=server.host, port=server.port, check=False, compression=Compression('gzip', threshold=100))
+    try:
+        events = [{'start': np.datetime64(i, 'ns'), 'end': np.datetime64(i + 1, 'ns'), 'value': 1.0} for i in range(500)]
+        c['foo']['x'].insert(events)
+        post = server.requests[-1]
+        assert post['headers']['Content-Encoding'] == 'gzip'
+        assert cbor2.loads(post['body']) == [[i, 1, 1.0] for i in range(500)]
+        assert c.compression.sent_wire == len(post['wire']) < c.compression.sent_raw
+        # small bodies are sent as is
+        assert 'Content-Encoding' not in server.requests[0]['headers']
+    finally:
+        c.close()
+
+
+def test_compressed_responses_and_fallback(server):
+    import cbor2
+    import gzip
+    from sentenai import Sentenai
+    body = cbor2.dumps([[i * 10, 10, 2.5] for i in range(1000)])
+    headers = {'Content-Type': 'application/cbor', 'type': 'float', 'Content-Encoding': 'gzip'}
+
+    def respond(req):
+        if 'Content-Encoding' in req['headers']:
+            return 415, {}, b''
+        return 200, headers, gzip.compress(body)
+
+    server.route('POST', '/tspl', respond)
+    c = Sentenai(host=server.host, port=server.port, check=False, compression='gzip')
+    try:
+        view = c.df('db/' + 'x' * 2000)
+        assert list(view[0:10000]['value']) == [2.5] * 1000
+        assert c.compression.rejected == {c._credentials.host}
+        assert [r['headers'].get('Content-Encoding') for r in server.requests if r['path'] == '/tspl'] == ['gzip', None]
+        assert c.compression.received_raw == len(body) > c.compression.received_wire
+        assert sum(len(b) for b in view.iter(batch=300)) == 1000
+    finally:
+        c.close()
+
+
+def test_compression_is_per_client(server):
+    from sentenai import Sentenai
+
+    def respond(req):
+        return (415, {}, b'') if 'Content-Encoding' in req['headers'] else server.cbor('float', [])
+
+    server.route('POST', '/tspl', respond)
+    rejected = Sentenai(host=server.host, port=server.port, check=False, compression='gzip')
+    other = Sentenai(host=server.host, port=server.port, check=False, compression='gzip')
+    plain = Sentenai(host=server.host, port=server.port, check=False)
+    try:
+        assert rejected._transport is other._transport is plain._transport
+        rejected.df('db/' + 'x' * 2000)[0:10]
+        assert rejected.compression.rejected and not other.compression.rejected
+        assert plain.compression is None
+        n = len(server.requests)
+        plain.df('db/' + 'x' * 2000)[0:10]
+        assert [r['headers'].get('Content-Encoding') for r in server.requests[n:]] == [None]
+        n = len(server.requests)
+        other.df('db/' + 'x' * 2000)[0:10]
+        assert [r['headers'].get('Content-Encoding') for r in server.requests[n:]] == ['gzip', None]
+    finally:
+        rejected.close()
+        other.close()
+        plain.close()
@@ -0,0 +1,179 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sentenai.columns import Columns
+
+
+EVENTS = [[i * 10, 10, float(i)] for i in range(25)]
+
+
+def test_iter_batches(server, sentenai_client):
+    server.route('POST', '/tspl', server.cbor('float', EVENTS))
+    batches = list(sentenai_client('db/x').iter(batch=10))
+    assert [len(b) for b in batches] == [10, 10, 5]
+    assert all(isinstance(b, Columns) for b in batches)
+    assert list(np.concatenate([b.value for b in batches])) == [float(i) for i in range(25)]
+
+
+def test_iter_dataframes_with_params(server, sentenai_client):
+    server.route('POST', '/tspl', server.cbor('float', EVENTS[:4]))
+    view = sentenai_client.df('db/x')
+    frames = list(view.iter(0, 1000, batch=3, limit=4))
+    assert [len(f) for f in frames] == [3, 1]
+    assert list(frames[0].columns) == ['start', 'end', 'duration', 'value']
+    assert server.requests[-1]['query'] == {'start': '0', 'end': '1000', 'limit': '4'}
+
+
+def test_iter_indefinite_array(server, sentenai_client):
+    import cbor2
+    body = b'\x9f' + b''.join(cbor2.dumps(e) for e in EVENTS) + b'\xff'
+    server.route('POST', '/tspl', (200, {'Content-Type': 'application/cbor', 'type': 'float'}, body))
+    batches = list(sentenai_client('db/x').iter(batch=7))
+    assert sum(len(b) for b in batches) == 25
+    assert batches[0].origin is None
+
+
+def test_iter_multi_column_rejected(sentenai_client):
+    with pytest.raises(ValueError):
+        next(sentenai_client.df(a='db/a', b='db/b').iter())
+
+
+LONG = [[0, 35, 1.0], [35, 10, 2.0], [45, 100, 3.0], [145, 5, 4.0], [150, 50, 5.0]]
+
+
+@pytest.mark.parametrize('clip', [False, True])
+def test_sharded_matches_single(server, sentenai_client, clip):
+    server.route('POST', '/tspl', server.windowed(LONG, clip))
+    view = sentenai_client.df('db/x')
+    expected = view[0:200]
+    result = view.sharded(7)[0:200]
+    pd.testing.assert_frame_equal(result, expected)
+    shards = [r for r in server.requests if r['path'] == '/tspl' and int(r['query']['end']) - int(r['query']['start']) > 2]
+    assert len(shards) == 8
+
+
+@pytest.mark.parametrize('clip', [False, True])
+@pytest.mark.parametrize('vtype', ['float', 'event'])
+def test_sharded_keeps_adjacent_equal_events(server, sentenai_client, clip, vtype):
+    events = [[0, 10, 1.0], [10, 10, 1.0], [20, 10, 2.0]]
+    if vtype == 'event':
+        events = [e[:2] for e in events]
+    server.route('POST', '/tspl', server.windowed(events, clip, vtype))
+    view = sentenai_client.df('db/x')
+    result = view.sharded(3)[0:30]
+    assert len(result) == 3
+    pd.testing.assert_frame_equal(result, view[0:30])
+
+
+@pytest.mark.parametrize('limit', [2, -2])
+def test_sharded_limit(server, sentenai_client, limit):
+    server.route('POST', '/tspl', server.windowed(LONG))
+    view = sentenai_client.df('db/x')
+    pd.testing.assert_frame_equal(view.sharded(4)[0:200:limit], view[0:200:limit])
+
+
+def test_sharded_open_range_uses_view_range(server, sentenai_client):
+    server.route('POST', '/tspl', server.windowed(LONG))
+    server.route('POST', '/tspl/range', (200, {'Content-Type': 'application/json'}, '{"start": 0, "end": 200, "type": "float"}'))
+    view = sentenai_client.df('db/x')
+    pd.testing.assert_frame_equal(view.sharded(3)[:], view[:])
+
+
+def test_columns_fetched_concurrently(server, sentenai_client):
+    import threading, time
+    active, peak = [0], [0]
+    lock = threading.Lock()
+
+    def respond(req):
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+        time.sleep(0.2)
+        with lock:
+            active[0] -= 1
+        return server.cbor('float', [[0, 10, 1.0]])
+
+    server.route('POST', '/tspl', respond)
+    cols = {f'c{i}': f'db/c{i}' for i in range(6)}
+    t0 = time.time()
+    df = sentenai_client.df(**cols)[0:10]
+    assert time.time() - t0 < 1.0
+    assert peak[0] > 1
+    assert list(df.columns) == ['start', 'end', 'duration'] + list(cols)
+
+
+def test_arrow_views(server, sentenai_client):
+    pa = pytest.importorskip("pyarrow")
+    server.route('POST', '/tspl', server.cbor('float', [[0, 10, 1.0], [10, 10, 2.0]]))
+    t = sentenai_client.arrow('db/x')[0:100]
+    assert isinstance(t, pa.Table)
+    assert t.schema.field('start').type == pa.timestamp('ns')
+    assert t.schema.field('duration').type == pa.duration('ns')
+    assert t.column('value').to_pylist() == [1.0, 2.0]
+
+    wide = sentenai_client.arrow(a='db/a', b='db/b')[0:100]
+    assert wide.column_names == ['start', 'end', 'duration', 'a', 'b']
+
+    batches = list(sentenai_client.arrow('db/x').iter(batch=1))
+    assert [b.num_rows for b in batches] == [1, 1]
+    assert isinstance(batches[0], pa.RecordBatch)
+
+
+def test_export_arrow(server, sentenai_client):
+    pa = pytest.importorskip("pyarrow")
+    json = {'Content-Type': 'application/json'}
+    server.route('GET', '/db/foo', (200, json, '{"origin": "1970-01-01T00:00:00Z"}'))
+    server.route('GET', '/db/foo/paths/x', (200, json, '{"node": "n1"}'))
+    server.route('GET', '/db/foo/nodes/n1/links', (200, json, '{"a": "n2", "b": "n3"}'))
+    server.route('POST', '/export', (200, json, '[["2020-01-01T00:00:00Z", "2020-01-01T00:00:01.5Z", 1.5, "x"], '
+                                                '["2020-01-01T00:00:02Z", "2020-01-01T00:00:03Z", null, "y"]]'))
+    t = sentenai_client['foo']['x'].export(arrow=True)
+    assert t.column_names == ['start', 'end', 'a', 'b']
+    assert t.schema.field('start').type == t.schema.field('end').type == pa.timestamp('ns')
+    assert t.column('end').to_pylist()[0] == pd.Timestamp('2020-01-01T00:00:01.5')
+    assert t.column('a').to_pylist() == [1.5, None] and t.column('b').to_pylist() == ['x', 'y']
+
+
+@pytest.mark.parametrize('clip', [False, True])
+def test_follow_extends_open_tail(server, sentenai_client, clip):
+    import cbor2
+    events = [[0, 10, 1.0], [10, 5, 2.0]]
+
+    def respond(req):
+        lo, hi = (int(np.datetime64(req['query'][k][:-1], 'ns').astype(np.int64)) for k in ('start', 'end'))
+        out = [[max(s, lo), min(s + d, hi) - max(s, lo), v] if clip else [s, d, v]
+               for s, d, v in events if s < hi and s + d > lo]
+        return 200, {'Content-Type': 'application/cbor', 'type': 'float', 'origin': '1970-01-01T00:00:00Z'}, cbor2.dumps(out)
+
+    server.route('POST', '/tspl', respond)
+    f = sentenai_client.df('db/x').follow(start=np.datetime64(0, 'ns'), retention=np.timedelta64(20, 'ns'))
+    assert list(f.refresh(until=np.datetime64(15, 'ns'))['value']) == [1.0, 2.0]
+    events[1:] = [[10, 20, 2.0], [30, 5, 3.0]]
+    new = f.refresh(until=np.datetime64(35, 'ns'))
+    assert list(new['value']) == [2.0, 3.0]
+    assert list(new['duration'].astype('int64')) == [20, 5]
+    # the event that ended at 10 is now outside the retention window
+    assert list(f.data['value']) == [2.0, 3.0]
+    assert [r['query']['start'] for r in server.requests] == ['1970-01-01T00:00:00.000000000Z', '1970-01-01T00:00:00.000000010Z']
+    assert len(f.refresh(until=np.datetime64(35, 'ns'))) == 0
+
+
+@pytest.mark.parametrize('clip', [False, True])
+def test_follow_keeps_adjacent_equal_events(server, sentenai_client, clip):
+    import cbor2
+    events = [[0, 10, 1.0], [10, 5, 1.0]]
+
+    def respond(req):
+        lo, hi = (int(np.datetime64(req['query'][k][:-1], 'ns').astype(np.int64)) for k in ('start', 'end'))
+        out = [[max(s, lo), min(s + d, hi) - max(s, lo), v] if clip else [s, d, v]
+               for s, d, v in events if s < hi and s + d > lo]
+        return 200, {'Content-Type': 'application/cbor', 'type': 'float', 'origin': '1970-01-01T00:00:00Z'}, cbor2.dumps(out)
+
+    server.route('POST', '/tspl', respond)
+    f = sentenai_client.df('db/x').follow(start=np.datetime64(0, 'ns'))
+    f.refresh(until=np.datetime64(15, 'ns'))
+    events[1] = [10, 8, 1.0]
+    new = f.refresh(until=np.datetime64(20, 'ns'))
+    assert list(new['duration'].astype('int64')) == [8]
+    assert list(f.data['duration'].astype('int64')) == [10, 8]
+    assert list(f.data['value']) == [1.0, 1.0]
@@ -0,0 +1,41 @@
+import time
+import cbor2
+import numpy as np
+import pytest
+from sentenai.stream.writer import StreamWriter
+
+
+def test_batches_by_size_and_latency():
+    sent = []
+    w = StreamWriter(sent.append, 'float', np.datetime64(0, 'ns'), max_batch=3, max_latency=0.05)
+    w.extend(np.arange(4).astype('datetime64[ns]'), np.arange(1, 5).astype('datetime64[ns]'), np.arange(4.0))
+    w.append(np.datetime64(10, 'ns'), np.datetime64(12, 'ns'), 7.5)
+    deadline = time.time() + 2
+    while w.acknowledged < 5 and time.time() < deadline:
+        time.sleep(0.01)
+    assert [cbor2.loads(b) for b in sent] == [[[0, 1, 0.0], [1, 1, 1.0], [2, 1, 2.0]], [[3, 1, 3.0], [10, 2, 7.5]]]
+    assert (w.batches, w.acknowledged) == (2, 5) and w.rate > 0
+    w.close()
+
+
+def test_send_errors_are_raised():
+    def send(data):
+        raise RuntimeError("boom")
+
+    w = StreamWriter(send, 'event', None, max_batch=1)
+    w.append(0, 5)
+    with pytest.raises(RuntimeError):
+        w.flush()
+
+
+def test_stream_writer(server, sentenai_client):
+    server.route('GET', '/db/foo', (200, {'Content-Type': 'application/json'}, '{"origin": "1970-01-01T00:00:00Z"}'))
+    server.route('GET', '/db/foo/paths/x', (200, {'Content-Type': 'application/json'}, '{"node": "n1"}'))
+    server.route('GET', '/db/foo/nodes/n1/types', (200, {'Content-Type': 'application/json'}, '["int"]'))
+    server.route('POST', '/db/foo/nodes/n1/types/int', (204, {}, b''))
+    with sentenai_client['foo']['x'].writer(max_batch=100) as w:
+        for i in range(250):
+            w.append(np.datetime64(i, 'ns'), np.datetime64(i + 1, 'ns'), i)
+    assert w.acknowledged == 250
+    assert sorted(server.uploaded('foo')['n1']) == [[i, 1, i] for i in range(250)]
+    assert len([r for r in server.requests if r['path'] == '/db/foo/nodes/n1/types']) == 1
@@ -30,7 +30,7 @@ setup(
     packages=['sentenai', 'sentenai.stream'],
 
     install_requires=['dateutils', 'pytz', 'requests', 'shapely', 'simplejson', 'numpy', 'treelib', 'tqdm', 'cbor2'],
-    extras_require={},
+    extras_require={'async': ['aiohttp'], 'arrow': ['pyarrow']},
     package_data={},
     data_files=[],
     entry_points={},